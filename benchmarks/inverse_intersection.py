@@ -0,0 +1,64 @@
+"""
+Benchmarks the throughput of `emblaze.utils.inverse_intersection` on a
+100k x 100 neighbor matrix, compared to a reference implementation that
+builds Python sets for each row.
+
+Usage:
+    python benchmarks/inverse_intersection.py [--rows N] [--neighbors K]
+"""
+
+import argparse
+import time
+import numpy as np
+from emblaze.utils import inverse_intersection, id_mask
+
+def set_inverse_intersection(seqs1, seqs2, mask_ids, outer):
+    """Reference implementation using per-row Python sets."""
+    distances = np.zeros(len(seqs1))
+    mask_ids = set(mask_ids)
+    for i in range(len(seqs1)):
+        set1 = set([n for n in seqs1[i] if (n in mask_ids) != outer])
+        set2 = set([n for n in seqs2[i] if (n in mask_ids) != outer])
+        if len(set1) or len(set2):
+            distances[i] = 1 / (1 + len(set1 & set2))
+    return distances
+
+def time_fn(fn, repeats):
+    """Returns the best wall-clock time over the given number of runs."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--neighbors", type=int, default=100)
+    parser.add_argument("--mask-size", type=int, default=1000)
+    parser.add_argument("--reference-rows", type=int, default=10000,
+                        help="Number of rows to time the set-based reference on")
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(0)
+    seqs1 = rng.integers(0, args.rows, size=(args.rows, args.neighbors), dtype=np.int32)
+    seqs2 = seqs1.copy()
+    # Perturb half of the neighbors in the second matrix
+    seqs2[:,args.neighbors // 2:] = rng.integers(0, args.rows, size=(args.rows, args.neighbors - args.neighbors // 2))
+    mask_ids = rng.choice(args.rows, size=args.mask_size, replace=False)
+    mask = id_mask(mask_ids, args.rows)
+    
+    inverse_intersection(seqs1[:10], seqs2[:10], mask, False) # compile
+    for outer in (False, True):
+        elapsed = time_fn(lambda: inverse_intersection(seqs1, seqs2, mask, outer), 3)
+        print("inverse_intersection (outer={}): {:.3f}s for {} x {} ({:,.0f} rows/s)".format(
+            outer, elapsed, args.rows, args.neighbors, args.rows / elapsed))
+    
+    n = min(args.reference_rows, args.rows)
+    elapsed = time_fn(lambda: set_inverse_intersection(seqs1[:n], seqs2[:n], mask_ids, False), 1)
+    print("set-based reference (outer=False): {:.3f}s for {} x {} ({:,.0f} rows/s)".format(
+        elapsed, n, args.neighbors, n / elapsed))
+    assert np.allclose(inverse_intersection(seqs1[:n], seqs2[:n], mask, False),
+                       set_inverse_intersection(seqs1[:n], seqs2[:n], mask_ids, False))
@@ -31,6 +31,51 @@ function decodeBase64String(base64String, arrayType) {
   }
 }
 
+/**
+ * Interprets a binary buffer sent from the backend (a DataView, typed array or
+ * ArrayBuffer) as an array of the given type. If arrayType is Array, the
+ * buffer should contain a UTF-8 JSON string. The buffer is used without
+ * copying when its offset is aligned to the element size.
+ */
+function decodeBuffer(buffer, arrayType) {
+  let arrayBuffer = ArrayBuffer.isView(buffer) ? buffer.buffer : buffer;
+  let byteOffset = ArrayBuffer.isView(buffer) ? buffer.byteOffset : 0;
+  let byteLength = buffer.byteLength;
+  if (arrayType === Array) {
+    return JSON.parse(
+      new TextDecoder().decode(
+        new Uint8Array(arrayBuffer, byteOffset, byteLength)
+      )
+    );
+  }
+  let bytesPerElement = arrayType.BYTES_PER_ELEMENT;
+  if (byteOffset % bytesPerElement != 0) {
+    arrayBuffer = arrayBuffer.slice(byteOffset, byteOffset + byteLength);
+    byteOffset = 0;
+  }
+  return new arrayType(arrayBuffer, byteOffset, byteLength / bytesPerElement);
+}
+
+/**
+ * Identifies the binary buffer format that decodeBuffer understands. The
+ * backend only sends binary buffers to bundles containing this string, so it
+ * must match BINARY_TRANSPORT_VERSION in emblaze/viewer.py.
+ */
+export const BINARY_TRANSPORT_VERSION = 'emblaze-binary-transport-1';
+
+/**
+ * Decodes an encoded array value, which may either be a base-64 string or a
+ * binary buffer (see decodeBase64String and decodeBuffer).
+ */
+function decodeArray(value, arrayType) {
+  if (typeof value === 'string') return decodeBase64String(value, arrayType);
+  if (value instanceof ArrayBuffer || ArrayBuffer.isView(value))
+    return decodeBuffer(value, arrayType);
+  throw new Error(
+    `Unsupported array encoding (expected a base-64 string or a ${BINARY_TRANSPORT_VERSION} buffer)`
+  );
+}
+
 function makeTypedReader(arrayType) {
   let base = new DataView(new ArrayBuffer(arrayType.BYTES_PER_ELEMENT));
   let result = {
@@ -116,7 +161,7 @@ export class ColumnarData {
         return;
       }
       let idType = selectArrayType(data['_idtype']);
-      let ids = decodeBase64String(data.ids.values, idType);
+      let ids = decodeArray(data.ids.values, idType);
       ids.forEach((id, i) => this.idMapping.set(id, i));
 
       // first read all compressed arrays from the input
@@ -129,7 +174,7 @@ export class ColumnarData {
         if (this.schema[col].nested) {
           // The value should contain an additional 'positions' key or an 'interval' key
           if (!!val.positions) {
-            this.nestPositionColumns[col] = decodeBase64String(
+            this.nestPositionColumns[col] = decodeArray(
               val.positions,
               Int32Array
             );
@@ -141,7 +186,7 @@ export class ColumnarData {
             }
           }
         }
-        this.columns[col] = decodeBase64String(
+        this.columns[col] = decodeArray(
           val.values,
           this.schema[col].array == 'id' ? idType : this.schema[col].array
         );
@@ -160,6 +160,10 @@ export class ValueHistory {
 }
 
 export function base64ToBlob(b64Data, contentType = '', sliceSize = 512) {
+  // Binary buffers sent from the backend can be used directly
+  if (typeof b64Data !== 'string')
+    return new Blob([b64Data], { type: contentType });
+
   const byteCharacters = atob(b64Data);
   const byteArrays = [];
 
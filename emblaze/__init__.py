@@ -215,6 +215,18 @@ to surface groups of points that change meaningfully from one frame to another.
 Check out the Suggested pane of the sidebar to see clustering recommendations
 relevant to the area of the plot you are currently looking at.
 
+The clusters for each pair of frames can be cached on disk, so that they are
+only recomputed for frames whose neighbors have changed. Caching is off by
+default; to enable it, set the Viewer's `suggestionCacheDir` property (or the
+`EMBLAZE_CACHE_DIR` environment variable) to a directory such as
+`~/.cache/emblaze/suggestions`. The least recently used entries are removed once
+the cache grows beyond 256 MB, and `Viewer.clear_suggestion_cache()` empties it.
+
+Suggestions, frame colors and alignment are recomputed once the selection,
+filter and current frame have stopped changing for `recomputeDebounceWindow`
+seconds (0.1 by default), and the time taken by each recompute is recorded in
+the Viewer's `recomputeTimings` property.
+
 ## Color Stripes
 
 To highlight variation between different frames, each
@@ -356,7 +368,7 @@ __pdoc__ = {
 
 from .viewer import Viewer
 from .datasets import Embedding, EmbeddingSet
-from .utils import ProjectionTechnique, Field, PreviewMode
+from .utils import ProjectionTechnique, Field, PreviewMode, NeighborAlgorithm
 from .thumbnails import Thumbnails, TextThumbnails, ImageThumbnails, CombinedThumbnails
 from ._version import __version__, version_info
 
@@ -39,14 +39,14 @@ class ColumnarData:
 
         self.length = length
         self.ids = np.array(ids) if ids is not None else np.arange(length)
-        self._id_index = {id: i for i, id in enumerate(self.ids)}
+        self._id_index = IDIndex(self.ids)
         
     def set_ids(self, new_ids):
         """
         Gives the ColumnarData a new set of ID numbers.
         """
         self.ids = np.array(new_ids) if new_ids is not None else np.arange(len(self))
-        self._id_index = {id: i for i, id in enumerate(self.ids)}
+        self._id_index = IDIndex(self.ids)
         
     def copy(self):
         return ColumnarData(self.data, self.ids)
@@ -74,16 +74,14 @@ class ColumnarData:
         """
         Returns whether the data has the given ID.
         """
-        return int(id_val) in self._id_index
+        return id_val in self._id_index
     
     def index(self, id_vals):
         """
-        Returns the index(es) of the given IDs.
+        Returns the index(es) of the given IDs. If a sequence of IDs is given,
+        returns an array of indexes. Raises a `KeyError` if any ID is missing.
         """
-        if isinstance(id_vals, (list, np.ndarray, set)):
-            return [self._id_index[int(id_val)] for id_val in id_vals]
-        else:
-            return self._id_index[int(id_vals)]
+        return self._id_index.lookup(id_vals)
 
     def has_field(self, field):
         return field in self.data
@@ -175,6 +173,8 @@ class Embedding(ColumnarData):
         self.metric = metric
         self.n_neighbors = n_neighbors
         self._distances = {}
+        self._neighbor_clfs = {}
+        self._spatial_index = None
         self.parent = parent # keep track of where this embedding came from
         self.neighbors = neighbors
 
@@ -200,15 +200,29 @@ class Embedding(ColumnarData):
         Returns a new `Embedding` with this `Embedding` and the given one
         stacked together. Must have the same set of fields, and a disjoint set of
         IDs.
+        
+        If this `Embedding` has a `Neighbors` and the other one does not, the
+        other's points are inserted into the neighbor set incrementally (see
+        [`Neighbors.insert`](neighbors.html#emblaze.neighbors.Neighbors.insert)),
+        so that neighbors do not need to be recomputed for all points.
         """
         assert set(self.data.keys()) == set(other.data.keys()), "Cannot concatenate Embedding objects with different sets of fields"
-        assert not (set(self.ids.tolist()) & set(other.ids.tolist())), "Cannot concatenate Embedding objects with overlapping ID values"
-        assert self.has_neighbors() == other.has_neighbors(), "Either both or neither Embedding object must have a Neighbors"
+        assert not np.intersect1d(self.ids, other.ids).size, "Cannot concatenate Embedding objects with overlapping ID values"
+        assert self.has_neighbors() or not other.has_neighbors(), "Cannot concatenate an Embedding with a Neighbors to one without"
         
+        if self.has_neighbors() and not other.has_neighbors():
+            neighbors = self.get_neighbors().insert(self.field(Field.POSITION),
+                                                    other.field(Field.POSITION),
+                                                    other.ids)
+        elif self.has_neighbors():
+            neighbors = self.get_neighbors().concat(other.get_neighbors())
+        else:
+            neighbors = None
+            
         return Embedding({k: np.concatenate([self.field(k), other.field(k)])
                           for k in self.data.keys()},
                          ids=np.concatenate([self.ids, other.ids]),
-                         neighbors=self.get_neighbors().concat(other.get_neighbors()) if self.has_neighbors() else None,
+                         neighbors=neighbors,
                          n_neighbors=max(self.n_neighbors, other.n_neighbors),
                          label=self.label, metric=self.metric)
     
@@ -310,10 +324,11 @@ class Embedding(ColumnarData):
         Computes a mapping from the IDs in this embedding to the positions
         in the other embedding (used for `AlignedUMAP`).
         """
-        return {self.index(id_val): other_emb.index(id_val)
-                for id_val in self.ids if id_val in other_emb}
+        other_indexes = other_emb._id_index.find(self.ids)
+        indexes = np.flatnonzero(other_indexes >= 0)
+        return dict(zip(indexes.tolist(), other_indexes[indexes].tolist()))
     
-    def compute_neighbors(self, n_neighbors=None, metric=None):
+    def compute_neighbors(self, n_neighbors=None, metric=None, algorithm=NeighborAlgorithm.EXACT, **params):
         """
         Computes and saves a set of nearest neighbors in this embedding according
         to the `Field.POSITION` values. This can be accessed after completing this
@@ -327,6 +342,11 @@ class Embedding(ColumnarData):
                 not provided, the default `n_neighbors` for this `Embedding` is used.
             metric: The distance metric to use to compute neighbors. If
                 not provided, the default `metric` for this `Embedding` is used.
+            algorithm: The algorithm to use to compute neighbors (see
+                [`Neighbors.compute`](neighbors.html#emblaze.neighbors.Neighbors.compute)).
+                When an approximate algorithm is used, the measured recall is
+                available in the `recall` property of the resulting `Neighbors`.
+            params: Additional keyword arguments for `Neighbors.compute`.
         """
         pos = self.field(Field.POSITION)
         # Save the metric and n_neighbors here so that they can be used to
@@ -336,7 +356,9 @@ class Embedding(ColumnarData):
         self.neighbors = Neighbors.compute(pos,
                                              ids=self.ids,
                                              metric=metric or self.metric,
-                                             n_neighbors=self.n_neighbors)
+                                             n_neighbors=self.n_neighbors,
+                                             algorithm=algorithm,
+                                             **params)
         
     def clear_neighbors(self):
         """
@@ -359,12 +381,37 @@ class Embedding(ColumnarData):
         """
         Returns the list of nearest neighbors for each of the given IDs and the
         distances to each of those points. This does NOT use the `Neighbors`
-        object, and is therefore based only on the locations of the points in 
-        this `Embedding` (not potentially on its parents).
+        objects of this `Embedding`'s parents, and is therefore based only on
+        the locations of the points in this `Embedding`. If this `Embedding`'s
+        own `Neighbors` stores distances for at least `n_neighbors` neighbors
+        using the same metric, they are used directly. Otherwise, the
+        `Neighbors`' fitted index is used if available, or a
+        `NearestNeighbors` model is fit once per metric and cached.
+        
+        Returns:
+            A matrix of neighbor indexes (excluding each point itself) and a
+            matrix of the corresponding distances.
         """
+        metric = metric or self.metric
+        neighbors = self.get_neighbors()
+        if (neighbors is not None and neighbors.distances is not None and
+            neighbors.metric == metric and
+            min(n_neighbors, len(self) - 1) <= neighbors.distances.shape[1]):
+            # Answer using the distances stored in this embedding's Neighbors
+            rows = neighbors.index(ids) if ids is not None else np.arange(len(neighbors))
+            num_columns = min(n_neighbors, len(self) - 1)
+            neigh_ids = np.asarray(neighbors.values[rows,:num_columns])
+            return self.index(neigh_ids.flatten()).reshape(neigh_ids.shape), np.asarray(neighbors.distances[rows,:num_columns])
+        
         pos = self.field(Field.POSITION, ids=ids)
-        neighbor_clf = NearestNeighbors(metric=metric or self.metric).fit(self.field(Field.POSITION))
-        neigh_distances, neigh_indexes = neighbor_clf.kneighbors(pos, n_neighbors=min(n_neighbors + 1, len(self)))
+        if (metric not in self._neighbor_clfs and neighbors is not None and
+            neighbors.metric == metric and neighbors.has_clf() and
+            getattr(neighbors.clf, 'n_samples_fit_', None) == len(self)):
+            # Reuse the fitted (possibly deserialized) index from the Neighbors
+            self._neighbor_clfs[metric] = neighbors.clf
+        if metric not in self._neighbor_clfs:
+            self._neighbor_clfs[metric] = NearestNeighbors(metric=metric).fit(self.field(Field.POSITION))
+        neigh_distances, neigh_indexes = self._neighbor_clfs[metric].kneighbors(pos, n_neighbors=min(n_neighbors + 1, len(self)))
         return neigh_indexes[:,1:], neigh_distances[:,1:]
         
     def distances(self, ids=None, comparison_ids=None, metric=None):
@@ -425,12 +472,26 @@ class Embedding(ColumnarData):
             A list of ID values corresponding to points within the bounding box.
         """
         assert self.dimension() == 2, "Non-2D embeddings are not supported by within_bbox()"
+        return self.ids[self.spatial_index().query(bbox)].tolist()
+    
+    def spatial_index(self):
+        """
+        Returns a `SpatialIndex` over the first two coordinates of this
+        embedding's positions. The index is built lazily and rebuilt whenever
+        the position field is replaced.
+        """
         positions = self.field(Field.POSITION)
-        return [id_val for id_val, pos in zip(self.ids, positions)
-                if (pos[0] >= bbox[0] and pos[0] <= bbox[1] and
-                    pos[1] >= bbox[2] and pos[1] <= bbox[3])]
+        if self._spatial_index is None or self._spatial_index.positions is not positions:
+            self._spatial_index = SpatialIndex(positions)
+        return self._spatial_index
+    
+    def set_field(self, field, values):
+        super().set_field(field, values)
+        if field == Field.POSITION:
+            self._spatial_index = None
+            self._neighbor_clfs = {}
 
-    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None):
+    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None, save_distances=False, index_dir=None, binary=False):
         """
         Converts this embedding into a JSON object. If the embedding is 2D, saves
         coordinates as separate x and y fields; otherwise, saves coordinates as
@@ -441,6 +502,17 @@ class Embedding(ColumnarData):
                 instead of as human-readable float arrays
             save_neighbors: If `True`, serialize the `Neighbors` object within
                 the embedding JSON.
+            num_neighbors: number of neighbors to write for each point
+            save_distances: If `True`, serialize the distances to each neighbor
+                stored in the `Neighbors` object.
+            index_dir: If provided, pickle the fitted neighbor search
+                structure to a file in this directory so that neighbors can be
+                queried after loading without refitting (see [`Neighbors.to_json`](neighbors.html#emblaze.neighbors.Neighbors.to_json)).
+            binary: If `True` (and `compressed` is `True`), store the IDs,
+                positions, alphas and radii as binary buffers for sending to
+                the widget frontend, instead of base64 strings (see
+                `utils.encode_numerical_array`). The result is then not
+                JSON-serializable.
                 
         Returns:
             A JSON-serializable dictionary representing the embedding.
@@ -461,19 +533,19 @@ class Embedding(ColumnarData):
             dtype, type_name = choose_integer_type(self.ids)
             result["_idtype"] = type_name
             result["_length"] = len(self)
-            result["ids"] = encode_numerical_array(self.ids, dtype)
+            result["ids"] = encode_numerical_array(self.ids, dtype, binary=binary)
             
             if self.dimension() == 2:
-                result["x"] = encode_numerical_array(positions[:,0])
-                result["y"] = encode_numerical_array(positions[:,1])
+                result["x"] = encode_numerical_array(positions[:,0], binary=binary)
+                result["y"] = encode_numerical_array(positions[:,1], binary=binary)
             else:
-                result["position"] = encode_numerical_array(positions, interval=self.dimension())
+                result["position"] = encode_numerical_array(positions, interval=self.dimension(), binary=binary)
                 
             result["color"] = encode_object_array(colors)
             if alphas is not None:
-                result["alpha"] = encode_numerical_array(alphas)
+                result["alpha"] = encode_numerical_array(alphas, binary=binary)
             if sizes is not None:
-                result["r"] = encode_numerical_array(sizes)
+                result["r"] = encode_numerical_array(sizes, binary=binary)
         else:
             result["points"] = {}
             for id_val, index in zip(self.ids, indexes):
@@ -492,13 +564,17 @@ class Embedding(ColumnarData):
                 result["points"][id_val] = obj
 
         if save_neighbors and self.has_neighbors():
-            result["neighbors"] = self.get_neighbors().to_json(compressed=compressed, num_neighbors=num_neighbors)
+            result["neighbors"] = self.get_neighbors().to_json(compressed=compressed,
+                                                               num_neighbors=num_neighbors,
+                                                               save_distances=save_distances,
+                                                               index_dir=index_dir,
+                                                               binary=binary)
         result["metric"] = self.metric
         result["n_neighbors"] = self.n_neighbors
         return standardize_json(result)
     
     @classmethod
-    def from_json(cls, data, label=None, parent=None):
+    def from_json(cls, data, label=None, parent=None, index_dir=None):
         """
         Builds an Embedding object from the given JSON object.
         
@@ -506,6 +582,9 @@ class Embedding(ColumnarData):
             data: The JSON-serializable dictionary representing the embedding.
             label: A string label to use to represent this embedding.
             parent: An `Embedding` to record as the new `Embedding`'s parent.
+            index_dir: A trusted directory from which to load the neighbor
+                search structure saved with the embedding, if any (see
+                [`Neighbors.from_json`](neighbors.html#emblaze.neighbors.Neighbors.from_json)).
             
         Returns:
             An `Embedding` instance loaded with the specified data.
@@ -549,7 +628,7 @@ class Embedding(ColumnarData):
                 mats[Field.RADIUS] = np.array([point_data[id_val]["r"] for id_val in ids])
 
         if "neighbors" in data:
-            neighbors = Neighbors.from_json(data["neighbors"])
+            neighbors = Neighbors.from_json(data["neighbors"], index_dir=index_dir)
         else:
             neighbors = None
         metric = data.get("metric", "euclidean")
@@ -704,7 +783,7 @@ class NeighborOnlyEmbedding(Embedding):
     def project(self, method=ProjectionTechnique.UMAP, **params):
         raise NotImplementedError
     
-    def compute_neighbors(self, n_neighbors=None, metric=None):
+    def compute_neighbors(self, n_neighbors=None, metric=None, algorithm=NeighborAlgorithm.EXACT, **params):
         raise NotImplementedError
         
     def clear_neighbors(self):
@@ -719,33 +798,40 @@ class NeighborOnlyEmbedding(Embedding):
     def within_bbox(self, bbox):
         raise NotImplementedError
 
-    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None):
+    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None, save_distances=False, index_dir=None, binary=False):
         """
         Converts this embedding into a (neighbor-only) JSON object.
         
         compressed: whether to format JSON objects using base64 strings
             instead of as human-readable float arrays
+        binary: whether to store the neighbors as binary buffers instead of
+            base64 strings (see `Embedding.to_json`)
         """
         result = {}
         result["_format"] = "neighbor_only"
         
         if save_neighbors and self.has_neighbors():
-            result["neighbors"] = self.get_neighbors().to_json(compressed=compressed, num_neighbors=num_neighbors)
+            result["neighbors"] = self.get_neighbors().to_json(compressed=compressed,
+                                                               num_neighbors=num_neighbors,
+                                                               save_distances=save_distances,
+                                                               index_dir=index_dir,
+                                                               binary=binary)
         result["metric"] = self.metric
         result["n_neighbors"] = self.n_neighbors
         return standardize_json(result)
     
     @classmethod
-    def from_json(cls, data, label=None, parent=None):
+    def from_json(cls, data, label=None, parent=None, index_dir=None):
         """
         Builds a neighbor-only Embedding object from the given JSON object.
+        See `Embedding.from_json` for the meaning of `index_dir`.
         """
         format = data.get("_format", "expanded")
         if format != "neighbor_only":
             raise ValueError("Cannot load NeighborOnlyEmbedding from JSON with format '{}'".format(data))
         
         assert "neighbors" in data
-        neighbors = Neighbors.from_json(data["neighbors"])
+        neighbors = Neighbors.from_json(data["neighbors"], index_dir=index_dir)
         metric = data.get("metric", "euclidean")
         n_neighbors = data.get("n_neighbors", 100)
         return cls(neighbors, label=label, metric=metric, n_neighbors=n_neighbors, parent=parent)
@@ -824,14 +910,16 @@ class EmbeddingSet:
 
         return EmbeddingSet(lo_ds, align=align and not pre_aligned)
     
-    def compute_neighbors(self, n_neighbors=100, metric=None):
+    def compute_neighbors(self, n_neighbors=100, metric=None, algorithm=NeighborAlgorithm.EXACT, **params):
         """
         Computes and saves a set of nearest neighbors in each embedding set according
         to the `Field.POSITION` values. This can be accessed after completing this
-        step by inspecting the `neighbors` property of the embedding.
+        step by inspecting the `neighbors` property of the embedding. See
+        [`Embedding.compute_neighbors`](#emblaze.datasets.Embedding.compute_neighbors)
+        for the supported `algorithm` values and keyword arguments.
         """
         for emb in self.embeddings:
-            emb.compute_neighbors(n_neighbors=n_neighbors, metric=metric)
+            emb.compute_neighbors(n_neighbors=n_neighbors, metric=metric, algorithm=algorithm, **params)
 
     def clear_neighbors(self):
         """
@@ -865,7 +953,7 @@ class EmbeddingSet:
         """
         return NeighborSet([emb.get_ancestor_neighbors() for emb in self.embeddings])
             
-    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None):
+    def to_json(self, compressed=True, save_neighbors=True, num_neighbors=None, save_distances=False, index_dir=None, binary=False):
         """
         Converts this set of embeddings into a JSON object.
         
@@ -876,16 +964,24 @@ class EmbeddingSet:
                 of each individual embedding
             num_neighbors: number of neighbors to write for each point (can considerably
                 save memory)
+            save_distances: If `True`, save the distances to each neighbor
+            index_dir: If provided, pickle the fitted neighbor search structures
+                to files in this directory (see `Embedding.to_json`)
+            binary: If `True`, store numerical arrays as binary buffers for
+                sending to the widget frontend (see `Embedding.to_json`)
         """
         return {
             "data": [emb.to_json(compressed=compressed,
                                  save_neighbors=save_neighbors,
-                                 num_neighbors=num_neighbors) for emb in self.embeddings],
+                                 num_neighbors=num_neighbors,
+                                 save_distances=save_distances,
+                                 index_dir=index_dir,
+                                 binary=binary) for emb in self.embeddings],
             "frameLabels": [emb.label or "Frame {}".format(i) for i, emb in enumerate(self.embeddings)]
         }
 
     @classmethod
-    def from_json(cls, data, parents=None):
+    def from_json(cls, data, parents=None, index_dir=None):
         """
         Builds an `EmbeddingSet` from a JSON object.
         
@@ -894,6 +990,8 @@ class EmbeddingSet:
                 such as that generated by [`EmbeddingSet.to_json`](#emblaze.datasets.EmbeddingSet.to_json).
             parents: An optional list of `Embedding` objects to use as parents
                 for each of the created embeddings.
+            index_dir: A trusted directory from which to load saved neighbor
+                search structures (see `Embedding.from_json`).
                 
         Returns:
             An initialized `EmbeddingSet` object.
@@ -905,7 +1003,8 @@ class EmbeddingSet:
             parents = [None for _ in range(len(embs))]
         elif len(parents) == 1:
             parents = [parents[0] for _ in range(len(embs))]
-        embs = [Embedding.from_json(frame, label=label, parent=parent) for frame, label, parent in zip(embs, labels, parents)]
+        embs = [Embedding.from_json(frame, label=label, parent=parent, index_dir=index_dir)
+                for frame, label, parent in zip(embs, labels, parents)]
         return cls(embs, align=False)
     
     def save(self, file_path_or_buffer, **kwargs):
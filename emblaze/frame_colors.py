@@ -6,11 +6,182 @@ points of interest.
 """
 import numpy as np
 from sklearn.cluster import AgglomerativeClustering
-from colormath.color_objects import LabColor, HSLColor
-from colormath.color_conversions import convert_color
 import itertools
-from numba.typed import List
-from .utils import Field, inverse_intersection
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from numba import jit, prange
+from .utils import Field, id_mask, compact_ids
+
+DEFAULT_COLOR_CACHE_SIZE = 128
+
+# Reference whites (2 degree observer) and conversion matrices, matching the
+# constants used by colormath for its L*a*b* -> sRGB conversion
+_D50_WHITE = np.array([0.96422, 1.00000, 0.82521])
+_D65_WHITE = np.array([0.95047, 1.00000, 1.08883])
+_BRADFORD = np.array([[0.8951, 0.2664, -0.1614],
+                      [-0.7502, 1.7135, 0.0367],
+                      [0.0389, -0.0685, 1.0296]])
+_XYZ_TO_SRGB = np.array([[3.24071, -1.53726, -0.498571],
+                         [-0.969258, 1.87599, 0.0415557],
+                         [0.0556352, -0.203996, 1.05707]])
+_CIE_E = 216.0 / 24389.0
+
+def _chromatic_adaptation_matrix(white_src, white_dst):
+    """
+    Returns the Bradford transformation matrix between two reference whites.
+    """
+    ratio = np.diag(_BRADFORD.dot(white_dst) / _BRADFORD.dot(white_src))
+    return np.linalg.pinv(_BRADFORD).dot(ratio).dot(_BRADFORD)
+
+_D50_TO_D65 = _chromatic_adaptation_matrix(_D50_WHITE, _D65_WHITE)
+
+def _lab_to_hsl(lab):
+    """
+    Converts colors from the CIE L*a*b* color space (D50 illuminant) to HSL
+    by way of sRGB.
+    
+    Args:
+        lab: An n x 3 array of L*, a*, b* values.
+        
+    Returns:
+        An n x 3 array of hue (degrees from 0 to 360), saturation (0 to 1),
+        and lightness (0 to 1).
+    """
+    lab = np.asarray(lab, dtype=np.float64).reshape(-1, 3)
+    
+    # L*a*b* -> XYZ
+    fy = (lab[:,0] + 16.0) / 116.0
+    f = np.stack([lab[:,1] / 500.0 + fy, fy, fy - lab[:,2] / 200.0], axis=1)
+    xyz = np.where(f ** 3 > _CIE_E, f ** 3, (f - 16.0 / 116.0) / 7.787) * _D50_WHITE
+    
+    # XYZ -> linear sRGB (adapted to D65) -> companded sRGB
+    linear = np.maximum(xyz.dot(_D50_TO_D65.T).dot(_XYZ_TO_SRGB.T), 0.0)
+    rgb = np.where(linear <= 0.0031308,
+                   linear * 12.92,
+                   1.055 * np.power(linear, 1 / 2.4) - 0.055)
+    
+    # sRGB -> HSL
+    r, g, b = rgb[:,0], rgb[:,1], rgb[:,2]
+    var_max = rgb.max(axis=1)
+    var_min = rgb.min(axis=1)
+    chroma = var_max - var_min
+    safe_chroma = np.where(chroma == 0, 1.0, chroma)
+    hue = np.select([chroma == 0, var_max == r, var_max == g],
+                    [0.0,
+                     (60.0 * ((g - b) / safe_chroma) + 360) % 360.0,
+                     60.0 * ((b - r) / safe_chroma) + 120],
+                    60.0 * ((r - g) / safe_chroma) + 240.0)
+    lightness = 0.5 * (var_max + var_min)
+    saturation = np.select([chroma == 0, lightness <= 0.5],
+                           [0.0, chroma / np.where(lightness == 0, 1.0, 2.0 * lightness)],
+                           chroma / np.where(lightness == 1, 1.0, 2.0 - 2.0 * lightness))
+    return np.stack([hue, saturation, lightness], axis=1)
+
+class FrameColorCache:
+    """
+    A bounded, thread-safe least-recently-used cache of frame colors. Entries
+    are keyed by a hash of the sorted set of IDs of interest along with the
+    identities of each frame, its position array, and its neighbor set, so the
+    cache is invalidated whenever a frame's positions or neighbors are replaced.
+    
+    The cache only holds weak references to these objects, so caching colors
+    never keeps frames or datasets alive. An entry whose objects have been
+    garbage-collected is treated as a miss and dropped, since their `id`s may
+    since have been reused.
+    """
+    def __init__(self, maxsize=DEFAULT_COLOR_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+    
+    def make_key(self, frames, ids_of_interest, scale_factor):
+        """
+        Builds a cache key for the given arguments to `compute_colors`. Also
+        returns weak references to the objects whose identities are part of
+        the key, which are used to verify that the key is still valid.
+        """
+        if ids_of_interest is not None and len(ids_of_interest):
+            sorted_ids = np.sort(np.asarray(list(ids_of_interest)))
+            id_hash = (len(sorted_ids), hashlib.sha1(sorted_ids.tobytes()).hexdigest())
+        else:
+            id_hash = None
+        referents = [obj
+                     for frame in frames
+                     for obj in (frame, frame.field(Field.POSITION), frame.get_recent_neighbors())]
+        frame_key = tuple(id(obj) for obj in referents)
+        refs = tuple(weakref.ref(obj) if obj is not None else None for obj in referents)
+        return (id_hash, frame_key, scale_factor), refs
+        
+    def get(self, key):
+        """
+        Returns the cached colors for the given key, or `None` if not present.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and any(ref is not None and ref() is None for ref in entry[1]):
+                # One of the keyed objects was freed, so its id may be reused
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return list(entry[0])
+    
+    def put(self, key, refs, colors):
+        """
+        Stores the given colors, evicting the least recently used entry if the
+        cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (list(colors), refs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            
+    def clear(self):
+        """
+        Removes all entries and resets the hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+        
+    def info(self):
+        """
+        Returns a dictionary of cache statistics, with keys "hits", "misses",
+        "size", and "maxsize".
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "maxsize": self.maxsize}
+
+_color_cache = FrameColorCache()
+
+def color_cache_info():
+    """
+    Returns hit/miss statistics for the cache used by `compute_colors`.
+    """
+    return _color_cache.info()
+
+def clear_color_cache():
+    """
+    Clears the cache used by `compute_colors` and resets its statistics.
+    """
+    _color_cache.clear()
 
 def _clustered_ordering(distances):
     """
@@ -60,14 +231,12 @@ def _arrange_around_circle(distances, offset, ordering):
         An n x 2 array representing locations around a circle.
     """
     # Find thetas first
-    thetas = [0.0]
+    ordering = np.asarray(ordering, dtype=int)
     theta_distances = distances ** 2
-    
-    for i in range(1, len(ordering)):
-        thetas.append(thetas[-1] + theta_distances[ordering[i],ordering[i - 1]])
+    thetas = np.concatenate([[0.0], np.cumsum(theta_distances[ordering[1:], ordering[:-1]])])
 
     last_theta = thetas[-1] + theta_distances[ordering[-1], ordering[0]]
-    thetas = np.array(thetas) * 2 * np.pi / last_theta # scale around the circle
+    thetas = thetas * 2 * np.pi / last_theta # scale around the circle
     thetas += offset
     # thetas += np.random.uniform(0.0, 2.0 * np.pi) # random offset
     
@@ -75,17 +244,115 @@ def _arrange_around_circle(distances, offset, ordering):
     # R = np.abs(theta_distances - np.mean(theta_distances)).mean() / np.max(theta_distances)
     # absolute distance-based measure
     # R = (distances.sum() / (len(distances.flatten()) - len(distances))) / max_dist
-    R = np.max([distances[i,j] for i in range(distances.shape[0]) for j in range(distances.shape[1]) if i != j])
+    R = np.max(distances[~np.eye(*distances.shape, dtype=bool)])
     R = 0.5 * np.log10(1 + 19 * R)
     
     # Create the points
     reduced = np.zeros((len(ordering), 2))
-    for index, theta in zip(ordering, thetas):
-        reduced[index] = [R * np.cos(theta), R * np.sin(theta)]
+    reduced[ordering] = np.stack([R * np.cos(thetas), R * np.sin(thetas)], axis=1)
     
     return reduced
 
-def compute_colors(frames, ids_of_interest=None, scale_factor=1.0):
+@jit(nopython=True, parallel=True, cache=True)
+def _pairwise_inverse_intersections(rows, mask, id_space):
+    """
+    Computes the inverse intersection size between corresponding rows for
+    every pair of neighbor matrices.
+    
+    Args:
+        rows: A U x S x K array of neighbor IDs for S points in each of U
+            distinct neighbor sets. Negative values are treated as padding.
+        mask: Boolean mask over ID space indicating the IDs of interest.
+        id_space: One more than the largest ID in rows.
+        
+    Returns:
+        Two U x U x S arrays, containing the inverse intersection sizes when
+        counting only IDs inside the mask ("inner") and only IDs outside the
+        mask ("outer").
+    """
+    num_sets, num_rows, _ = rows.shape
+    inner = np.zeros((num_sets, num_sets, num_rows))
+    outer = np.zeros((num_sets, num_sets, num_rows))
+    for a in prange(num_sets):
+        stamps = np.zeros(id_space, dtype=np.int64)
+        stamp = 0
+        for b in range(a, num_sets):
+            for s in range(num_rows):
+                # Each row gets a new stamp so the scratch array never needs
+                # to be cleared
+                stamp += 2
+                inner_nonempty = False
+                outer_nonempty = False
+                inner_count = 0
+                outer_count = 0
+                for x in rows[a, s]:
+                    if x < 0: continue
+                    stamps[x] = stamp
+                    if x < len(mask) and mask[x]:
+                        inner_nonempty = True
+                    else:
+                        outer_nonempty = True
+                for x in rows[b, s]:
+                    if x < 0: continue
+                    in_mask = x < len(mask) and mask[x]
+                    if in_mask:
+                        inner_nonempty = True
+                    else:
+                        outer_nonempty = True
+                    if stamps[x] == stamp:
+                        stamps[x] = stamp + 1
+                        if in_mask:
+                            inner_count += 1
+                        else:
+                            outer_count += 1
+                if inner_nonempty:
+                    inner[a, b, s] = inner[b, a, s] = 1 / (1 + inner_count)
+                if outer_nonempty:
+                    outer[a, b, s] = outer[b, a, s] = 1 / (1 + outer_count)
+    return inner, outer
+
+def _frame_distances(frames, distance_sample):
+    """
+    Computes the mean inner and outer inverse intersection between the
+    neighbors of the sampled points in every pair of frames. The neighbor
+    rows are extracted once per distinct `Neighbors` object, and all pairs
+    are computed in one batched pass. Since the inner and outer intersections
+    are each restricted to part of the ID space, a dedicated kernel is used
+    rather than the one-hot matrices from `neighbor_csr`.
+    
+    Returns:
+        Two F x F matrices of inner and outer distances between frames.
+    """
+    neighbor_sets = [frame.get_recent_neighbors() for frame in frames]
+    unique_sets = []
+    set_indexes = []
+    for neighbors in neighbor_sets:
+        matches = [i for i, other in enumerate(unique_sets) if other is neighbors]
+        if not matches:
+            unique_sets.append(neighbors)
+            matches = [len(unique_sets) - 1]
+        set_indexes.append(matches[0])
+        
+    sample = np.asarray(distance_sample, dtype=np.int64)
+    sample_rows = [np.asarray(neighbors[distance_sample], dtype=np.int64) for neighbors in unique_sets]
+    
+    # Compact the IDs so that the scratch arrays scale with the number of
+    # distinct IDs rather than the largest ID
+    width = max(r.shape[1] for r in sample_rows)
+    valid = np.zeros((len(unique_sets), len(sample), width), dtype=bool)
+    for i, r in enumerate(sample_rows):
+        valid[i,:,:r.shape[1]] = True
+    _, compact, id_space = compact_ids(np.concatenate([sample] + [r.ravel() for r in sample_rows]))
+    rows = -np.ones(valid.shape, dtype=np.int64)
+    rows[valid] = compact[len(sample):]
+    mask = id_mask(compact[:len(sample)], size=id_space)
+    
+    inner, outer = _pairwise_inverse_intersections(rows, mask, id_space)
+    set_indexes = np.array(set_indexes)
+    pair_indexes = np.ix_(set_indexes, set_indexes)
+    return inner.mean(axis=2)[pair_indexes], outer.mean(axis=2)[pair_indexes]
+
+def compute_colors(frames, ids_of_interest=None, scale_factor=1.0, use_cache=True):
     """
     Computes HSV colors for each frame.
     
@@ -96,33 +363,33 @@ def compute_colors(frames, ids_of_interest=None, scale_factor=1.0):
         scale_factor: Amount by which to scale the color wheel. Values larger
             than 1 effectively make the colors more saturated and appear more
             different.
+        use_cache: If True, look up and store the results in a bounded LRU
+            cache keyed by the ID set and frame identities (see
+            `color_cache_info`).
             
     Returns:
         A list of HSV colors, expressed as tuples of (hue, saturation, value).
     """
+    if use_cache:
+        key, refs = _color_cache.make_key(frames, ids_of_interest, scale_factor)
+        colors = _color_cache.get(key)
+        if colors is None:
+            colors = _compute_colors(frames, ids_of_interest, scale_factor)
+            _color_cache.put(key, refs, colors)
+        return colors
+    return _compute_colors(frames, ids_of_interest, scale_factor)
 
+def _compute_colors(frames, ids_of_interest=None, scale_factor=1.0):
     distance_sample = ids_of_interest or frames[0].ids.tolist()
     if len(distance_sample) > 1000:
         distance_sample = np.random.choice(distance_sample, size=1000, replace=False).tolist()
         
     # First compute a distance matrix for the IDs for each frame
-    outer_jaccard_distances = np.zeros((len(frames), len(frames)))
-    inner_jaccard_distances = np.zeros((len(frames), len(frames)))
-    for i in range(len(frames)):
-        frame_1_neighbors = frames[i].get_recent_neighbors()[distance_sample]
-        for j in range(len(frames)):
-            frame_2_neighbors = frames[j].get_recent_neighbors()[distance_sample]
-            # If the id set is the entire frame, there will be no outer neighbors
-            # so we can just leave this at zero
-            if ids_of_interest is not None and len(ids_of_interest):
-                outer_jaccard_distances[i,j] = np.mean(inverse_intersection(frame_1_neighbors,
-                                                                            frame_2_neighbors,
-                                                                            List(distance_sample),
-                                                                            True))
-            inner_jaccard_distances[i,j] = np.mean(inverse_intersection(frame_1_neighbors,
-                                                                        frame_2_neighbors,
-                                                                        List(distance_sample),
-                                                                        False))
+    inner_jaccard_distances, outer_jaccard_distances = _frame_distances(frames, distance_sample)
+    # If the id set is the entire frame, there will be no outer neighbors
+    # so we can just leave this at zero
+    if not (ids_of_interest is not None and len(ids_of_interest)):
+        outer_jaccard_distances = np.zeros((len(frames), len(frames)))
 
     if ids_of_interest is not None and len(ids_of_interest):
         if len(ids_of_interest) == 1:
@@ -149,12 +416,7 @@ def compute_colors(frames, ids_of_interest=None, scale_factor=1.0):
     reduced = _arrange_around_circle(distances, offset, ordering_indexes) #, max_dist=np.array(neighbor_dists).mean())
 
     # Generate colors in L*a*b* space and convert to HSL/HSV
-    colors = []
-    for point in reduced:
-        scaled_point = np.array([point[0] * 100.0 * scale_factor,
-                                point[1] * 100.0 * scale_factor])
-        lab = LabColor(70.0, scaled_point[1], scaled_point[0])
-        rgb = convert_color(lab, HSLColor)
-        colors.append((int(rgb.hsl_h), int(rgb.hsl_s * 100.0), int(rgb.hsl_l * 100.0)))
-
-    return colors
\ No newline at end of file
+    scaled = reduced * 100.0 * scale_factor
+    lab = np.stack([np.full(len(scaled), 70.0), scaled[:,1], scaled[:,0]], axis=1)
+    hsl = _lab_to_hsl(lab)
+    return [(int(h), int(s * 100.0), int(l * 100.0)) for h, s, l in hsl]
\ No newline at end of file
@@ -5,8 +5,215 @@ inherited across different `Embedding` objects.
 
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
+from sklearn.metrics.pairwise import paired_distances, PAIRED_DISTANCES
+from sklearn.base import clone
+from scipy.sparse import csr_matrix
+from concurrent.futures import as_completed
+import json
+import os
+import pickle
+import hashlib
+import shutil
+import tempfile
 from .utils import *
 
+# Default memory budget (in MB) for the working set of a single kNN query chunk
+DEFAULT_CHUNK_MEMORY = 1024
+
+class _NNDescentClassifier:
+    """
+    Wraps a `pynndescent.NNDescent` index so that it can be queried using the
+    same `kneighbors` interface as `sklearn.neighbors.NearestNeighbors`.
+    """
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+        
+    def kneighbors(self, pos, n_neighbors=None):
+        neigh_indexes, neigh_dists = self.index.query(pos, k=n_neighbors or self.index.n_neighbors)
+        return neigh_dists, neigh_indexes
+
+def _sampled_recall(pos, neigh_indexes, metric, sample_size):
+    """
+    Estimates the recall of an approximate neighbor matrix (including each point
+    itself in the first column) by computing exact neighbors for a random
+    sample of the points.
+    """
+    sample = np.random.choice(len(pos), size=min(sample_size, len(pos)), replace=False)
+    exact_clf = NearestNeighbors(metric=metric, algorithm='brute').fit(pos)
+    _, exact_indexes = exact_clf.kneighbors(pos[sample], n_neighbors=neigh_indexes.shape[1])
+    approx = neigh_indexes[sample,1:]
+    exact = exact_indexes[:,1:]
+    if approx.size == 0: return 1.0
+    hits = (approx[:,:,np.newaxis] == exact[:,np.newaxis,:]).any(axis=2)
+    return float(hits.mean())
+
+def _neighbor_id_dtype(ids):
+    """Returns the narrowest dtype among int32 and the IDs' own dtype that can
+    hold the given IDs."""
+    if np.issubdtype(ids.dtype, np.integer) and (len(ids) == 0 or
+        (ids.min() >= np.iinfo(np.int32).min and ids.max() <= np.iinfo(np.int32).max)):
+        return np.int32
+    return ids.dtype
+
+def _chunk_rows(num_points, n_neighbors, memory_mb):
+    """
+    Returns the number of query rows that can be processed at once while
+    keeping the distance workspace (one float64 distance per fitted point per
+    row, in the worst case of a brute-force search) and the returned distances
+    and indexes within the given memory budget.
+    """
+    bytes_per_row = 8 * num_points + 16 * (n_neighbors + 1)
+    return max(1, int(memory_mb * 2 ** 20) // bytes_per_row)
+
+_worker_clf = None
+_worker_pos = None
+
+def _init_kneighbors_worker(pos_path, clf_params):
+    """
+    Memory-maps the position matrix saved by `_chunked_kneighbors` read-only
+    and fits a `NearestNeighbors` model to it, so that each worker receives
+    only the model parameters rather than a pickled copy of the fitted model
+    and its training data.
+    """
+    global _worker_clf, _worker_pos
+    _worker_pos = np.load(pos_path, mmap_mode='r')
+    _worker_clf = NearestNeighbors(**clf_params).fit(_worker_pos)
+    
+def _kneighbors_worker(start, stop, n_neighbors):
+    neigh_dists, neigh_indexes = _worker_clf.kneighbors(_worker_pos[start:stop], n_neighbors=n_neighbors)
+    return start, neigh_dists.astype(np.float32), neigh_indexes.astype(np.int32)
+
+def _chunked_kneighbors(clf, pos, ids, n_neighbors, memory_mb=DEFAULT_CHUNK_MEMORY, n_jobs=1):
+    """
+    Queries the given fitted classifier for the neighbors of every row in pos,
+    processing blocks of rows so that each query stays within the memory budget.
+    The neighbors' IDs and distances (excluding each point itself, i.e. the
+    first column) are written directly into preallocated matrices.
+    
+    When using multiple processes, pos is written once to a temporary `.npy`
+    file that each worker memory-maps and fits its own copy of the model to
+    (so tree-based models are rebuilt in every worker, but the fitted model
+    is never pickled). Because workers are not forked, scripts that pass
+    n_jobs > 1 must guard their entry point with `if __name__ == "__main__":`.
+    
+    Args:
+        clf: A `NearestNeighbors` object fitted on pos.
+        pos: Matrix of n x D high-dimensional positions to query.
+        ids: Array of IDs corresponding to each row that `clf` was fit on.
+        n_neighbors: Number of neighbors to return per row (excluding itself).
+        memory_mb: Approximate memory budget in MB for each chunk.
+        n_jobs: Number of worker processes to spread chunks across. If 1 (or
+            if clf is not a `NearestNeighbors`), chunks are processed serially
+            in this process.
+            
+    Returns:
+        An n x n_neighbors matrix of neighbor IDs, and an n x n_neighbors
+        float32 matrix of distances to those neighbors.
+    """
+    values = np.empty((len(pos), n_neighbors), dtype=_neighbor_id_dtype(ids))
+    distances = np.empty((len(pos), n_neighbors), dtype=np.float32)
+    chunk_size = _chunk_rows(clf.n_samples_fit_, n_neighbors, memory_mb)
+    starts = range(0, len(pos), chunk_size)
+    if (n_jobs is None or n_jobs == 1 or len(starts) <= 1 or
+        not isinstance(clf, NearestNeighbors)):
+        for start in starts:
+            neigh_dists, neigh_indexes = clf.kneighbors(pos[start:start + chunk_size], n_neighbors=n_neighbors + 1)
+            values[start:start + len(neigh_indexes)] = ids[neigh_indexes[:,1:]]
+            distances[start:start + len(neigh_indexes)] = neigh_dists[:,1:]
+        return values, distances
+    
+    input_dir = tempfile.mkdtemp(prefix="emblaze-")
+    try:
+        pos_path = os.path.join(input_dir, "pos.npy")
+        np.save(pos_path, np.asarray(pos))
+        with process_pool_executor(n_jobs,
+                                   initializer=_init_kneighbors_worker,
+                                   initargs=(pos_path, clf.get_params())) as executor:
+            futures = [executor.submit(_kneighbors_worker, start, min(start + chunk_size, len(pos)), n_neighbors + 1)
+                       for start in starts]
+            for future in as_completed(futures):
+                start, neigh_dists, neigh_indexes = future.result()
+                values[start:start + len(neigh_indexes)] = ids[neigh_indexes[:,1:]]
+                distances[start:start + len(neigh_indexes)] = neigh_dists[:,1:]
+    finally:
+        shutil.rmtree(input_dir, ignore_errors=True)
+    return values, distances
+
+def _save_index_file(clf, index_dir):
+    """
+    Pickles the given neighbor index to a file in index_dir, named by the hash
+    of its contents so that indexes shared between objects are written once.
+    Returns the file name.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    data = pickle.dumps(clf)
+    file_name = "index-{}.pkl".format(hashlib.sha1(data).hexdigest())
+    path = os.path.join(index_dir, file_name)
+    if not os.path.exists(path):
+        with open(path, "wb") as file:
+            file.write(data)
+    return file_name
+
+class _FileIndexLoader:
+    """Loads a neighbor index from a pickle file."""
+    def __init__(self, path):
+        self.path = path
+        
+    def __call__(self):
+        with open(self.path, "rb") as file:
+            return pickle.load(file)
+
+def _merge_neighbors(dists_1, indexes_1, dists_2, indexes_2, n_neighbors):
+    """
+    Merges two sets of neighbor lists (each sorted by distance) into a single
+    list per row containing the n_neighbors closest entries.
+    """
+    dists = np.hstack([dists_1, dists_2])
+    indexes = np.hstack([indexes_1, indexes_2])
+    order = np.argsort(dists, axis=1, kind='stable')[:,:n_neighbors]
+    return np.take_along_axis(dists, order, axis=1), np.take_along_axis(indexes, order, axis=1)
+
+def neighbor_csr(neighbors, column_index=None, num_columns=None):
+    """
+    Builds a sparse one-hot adjacency matrix with one row per neighbor list,
+    and a one in the column corresponding to each neighbor ID in that row
+    (repeated IDs within a row are counted once).
+    
+    Args:
+        neighbors: A 2D array of neighbor IDs, or a CSR-style tuple
+            (indptr, ids) of variable-length neighbor lists.
+        column_index: An `IDIndex` mapping neighbor IDs to columns. If `None`,
+            each distinct neighbor ID is assigned its own column (see
+            `compact_ids`).
+        num_columns: The number of columns in the matrix. If `None`, the
+            length of `column_index` or the number of distinct IDs is used.
+            
+    Returns:
+        A `scipy.sparse.csr_matrix` with int32 entries.
+    """
+    if isinstance(neighbors, tuple):
+        indptr, values = neighbors
+        indptr = np.asarray(indptr)
+        values = np.asarray(values)
+    else:
+        neighbors = np.asarray(neighbors)
+        indptr = np.arange(len(neighbors) + 1) * (neighbors.shape[1] if neighbors.ndim == 2 else 0)
+        values = neighbors.ravel()
+    if column_index is not None:
+        indices = column_index.lookup(values)
+        if num_columns is None:
+            num_columns = len(column_index)
+    else:
+        _, indices, id_space = compact_ids(values)
+        if num_columns is None:
+            num_columns = id_space
+    mat = csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                     shape=(len(indptr) - 1, num_columns))
+    mat.sum_duplicates()
+    mat.data[:] = 1
+    return mat
+
 class Neighbors:
     """
     An object representing a serializable set of nearest neighbors within an
@@ -15,7 +222,7 @@ class Neighbors:
     order of proximity to each point. These neighbors can be accessed through the
     `values` property.
     """
-    def __init__(self, values, ids=None, metric='euclidean', n_neighbors=100, clf=None):
+    def __init__(self, values, ids=None, metric='euclidean', n_neighbors=100, clf=None, recall=None, distances=None):
         """
         This constructor should typically not be used - use [`Neighbors.compute`](#emblaze.neighbors.Neighbors.compute) instead.
         
@@ -25,19 +232,27 @@ class Neighbors:
             metric: Distance metric to use to compute neighbors (can be any supported
                 metric for `sklearn.neighbors.NearestNeighbors`)
             n_neighbors: Number of neighbors to compute and save
-            clf: The `NearestNeighbors` object (only used when loading a `Neighbors`
-                object from file)
+            clf: The fitted `NearestNeighbors` object (or an equivalent object
+                with a `kneighbors` method)
+            recall: The fraction of true nearest neighbors recovered, if the
+                neighbors were computed using an approximate algorithm
+            distances: If supplied, a matrix of the same shape as `values`
+                containing the distance from each point to each neighbor
         """
         super().__init__()
         self.values = values
         self.ids = ids
-        self._id_index = {id: i for i, id in enumerate(self.ids)}
+        self._id_index = IDIndex(self.ids)
         self.metric = metric
         self.n_neighbors = n_neighbors
         self.clf = clf
+        self.recall = recall
+        self.distances = distances
+        self._csr_cache = {}
+        self._fingerprint = None
     
     @classmethod
-    def compute(cls, pos, ids=None, metric='euclidean', n_neighbors=100):
+    def compute(cls, pos, ids=None, metric='euclidean', n_neighbors=100, algorithm=NeighborAlgorithm.EXACT, recall_sample_size=1000, chunk_memory=DEFAULT_CHUNK_MEMORY, n_jobs=1, store_distances=True, **params):
         """
         Compute a nearest-neighbor set using a given metric.
         
@@ -47,26 +262,137 @@ class Neighbors:
             metric: Distance metric to use to compute neighbors (can be any supported
                 metric for `sklearn.neighbors.NearestNeighbors`)
             n_neighbors: Number of neighbors to compute and save
+            algorithm: The algorithm used to find neighbors, one of the values
+                in [`utils.NeighborAlgorithm`](utils.html#emblaze.utils.NeighborAlgorithm).
+                `NeighborAlgorithm.EXACT` fits an exact `NearestNeighbors`
+                model, while `NeighborAlgorithm.NN_DESCENT` builds an approximate
+                nearest-neighbor graph using `pynndescent`, which is much faster
+                for large, high-dimensional datasets. This can also be a callable
+                that takes the position matrix, a `metric` and an `n_neighbors`
+                keyword argument (plus any additional keyword arguments passed
+                to this method), and returns an n x n_neighbors matrix of row
+                indexes in which the first column is each point itself.
+            recall_sample_size: For approximate algorithms, the number of points
+                for which to compute exact neighbors in order to measure recall.
+                The result is saved in the `recall` property of the returned
+                object.
+            chunk_memory: For the exact algorithm, the approximate amount of
+                memory (in MB) to use for each block of rows that is queried
+                at once.
+            n_jobs: For the exact algorithm, the number of worker processes
+                across which to spread blocks of rows (-1 uses all available
+                cores). The positions are shared with the workers through a
+                temporary memory-mapped file, and each worker fits its own
+                model. Workers are started with 'forkserver' or 'spawn', so
+                scripts that set this must guard their entry point with
+                `if __name__ == "__main__":`.
+            store_distances: If `True`, save a float32 matrix of the distances
+                to each neighbor in the `distances` property (when the
+                algorithm provides them).
+            params: Additional keyword arguments passed to the neighbor
+                algorithm (e.g. to `pynndescent.NNDescent`).
             
         Returns:
             An initialized `Neighbors` object containing computed neighbors.
         """
-        ids = ids if ids is not None else np.arange(len(pos))
-        neighbor_clf = NearestNeighbors(metric=metric,
-                                        n_neighbors=n_neighbors + 1).fit(pos)
-        _, neigh_indexes = neighbor_clf.kneighbors(pos)
+        ids = np.asarray(ids) if ids is not None else np.arange(len(pos))
+        if algorithm == NeighborAlgorithm.EXACT:
+            neighbor_clf = NearestNeighbors(metric=metric,
+                                            n_neighbors=n_neighbors + 1,
+                                            **params).fit(pos)
+            values, distances = _chunked_kneighbors(neighbor_clf, pos, ids, n_neighbors,
+                                                    memory_mb=chunk_memory, n_jobs=n_jobs)
+            return cls(values, ids=ids, metric=metric, n_neighbors=n_neighbors, clf=neighbor_clf,
+                       distances=distances if store_distances else None)
+
+        if algorithm == NeighborAlgorithm.NN_DESCENT:
+            import pynndescent
+            index = pynndescent.NNDescent(pos, metric=metric, n_neighbors=n_neighbors + 1, **params)
+            neigh_indexes, neigh_dists = index.neighbor_graph
+            neighbor_clf = _NNDescentClassifier(index)
+        elif callable(algorithm):
+            neigh_indexes = np.asarray(algorithm(pos, metric=metric, n_neighbors=n_neighbors + 1, **params))
+            neigh_dists = None
+            neighbor_clf = None
+        else:
+            raise ValueError("Unrecognized neighbor algorithm '{}'. Please choose from the constants listed in emblaze.NeighborAlgorithm, or pass a callable (see method docstring).".format(algorithm))
+        recall = _sampled_recall(pos, neigh_indexes, metric, recall_sample_size) if recall_sample_size else None
+        
+        distances = neigh_dists[:,1:].astype(np.float32) if store_distances and neigh_dists is not None else None
+        return cls(ids[neigh_indexes[:,1:]], ids=ids, metric=metric, n_neighbors=n_neighbors, clf=neighbor_clf, recall=recall, distances=distances)
+        
+    @property
+    def clf(self):
+        """
+        The fitted neighbor search structure used to query neighbors for new
+        positions. If the `Neighbors` was loaded with a serialized index, it
+        is deserialized the first time this property is accessed.
+        """
+        if self._clf is None and self._clf_loader is not None:
+            self._clf = self._clf_loader()
+            self._clf_loader = None
+        return self._clf
+    
+    @clf.setter
+    def clf(self, value):
+        self._clf = value
+        self._clf_loader = None
+        
+    def set_clf_loader(self, loader):
+        """
+        Sets a function that takes no arguments and returns the fitted neighbor
+        search structure, which will be called to populate `clf` the first
+        time it is needed.
+        """
+        self._clf = None
+        self._clf_loader = loader
         
-        return cls(ids[neigh_indexes[:,1:]], ids=ids, metric=metric, n_neighbors=n_neighbors, clf=neighbor_clf)
+    def has_clf(self):
+        """Returns `True` if a fitted neighbor search structure is available
+        (without loading it)."""
+        return self._clf is not None or self._clf_loader is not None
         
     def index(self, id_vals):
         """
-        Returns the index(es) of the given IDs.
+        Returns the index(es) of the given IDs. If a sequence of IDs is given,
+        returns an array of indexes. Raises a `KeyError` if any ID is missing.
         """
-        if isinstance(id_vals, (list, np.ndarray, set)):
-            return [self._id_index[int(id_val)] for id_val in id_vals]
-        else:
-            return self._id_index[int(id_vals)]
+        return self._id_index.lookup(id_vals)
+
+    def fingerprint(self):
+        """
+        Returns a hexadecimal digest of the metric, IDs and neighbor IDs in
+        this object, which can be used to recognize identical neighbor sets
+        across sessions. The digest is computed once and cached, so the
+        neighbor values should not be modified in place afterwards.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = array_fingerprint(self.metric, self.ids, self.values)
+        return self._fingerprint
 
+    def to_csr(self, num_neighbors=None):
+        """
+        Returns the nearest-neighbor graph as a sparse n x n adjacency matrix,
+        in which entry (i, j) is 1 if the point with ID `ids[j]` is one of the
+        nearest neighbors of the point with ID `ids[i]`. The matrix is cached,
+        so repeated calls are free.
+        
+        Args:
+            num_neighbors: The number of neighbors per point to include. If
+                `None`, all stored neighbors are included.
+                
+        Returns:
+            A `scipy.sparse.csr_matrix` with int32 entries.
+        """
+        num_columns = self.values.shape[1]
+        if num_neighbors is not None:
+            num_columns = min(num_neighbors, num_columns)
+        if num_columns not in self._csr_cache:
+            self._csr_cache[num_columns] = neighbor_csr(self.values[:,:num_columns],
+                                                        self._id_index,
+                                                        len(self))
+        return self._csr_cache[num_columns]
+        
     def __getitem__(self, ids):
         """ids can be a single ID or a sequence of IDs"""
         if ids is None: return self.values
@@ -75,6 +401,7 @@ class Neighbors:
     def __eq__(self, other):
         if isinstance(other, NeighborSet): return other == self
         if not isinstance(other, Neighbors): return False
+        if other is self: return True
         return np.allclose(self.ids, other.ids) and np.allclose(self.values, other.values)
     
     def __ne__(self, other):
@@ -88,7 +415,7 @@ class Neighbors:
             raise ValueError(
                 ("Cannot compute neighbors because the Neighbors was not "
                  "initialized with a neighbor classifier - was it deserialized "
-                 "from JSON without saving the original coordinates or "
+                 "from JSON without a trusted index directory (index_dir) or "
                  "concatenated to another Neighbors?"))
         neigh_dists, neigh_indexes = self.clf.kneighbors(pos, n_neighbors=n_neighbors or self.n_neighbors)
         if return_distance:
@@ -97,25 +424,121 @@ class Neighbors:
     
     def concat(self, other):
         """Concatenates the two Neighbors together, discarding the original 
-        classifier."""
-        assert not (set(self.ids.tolist()) & set(other.ids.tolist())), "Cannot concatenate Neighbors objects with overlapping ID values"
+        classifier. The neighbor lists of each object are not updated to
+        include the other's points (see [`Neighbors.insert`](#emblaze.neighbors.Neighbors.insert)
+        for that). If the objects store different numbers of neighbors, the
+        longer neighbor lists are truncated."""
+        assert not np.intersect1d(self.ids, other.ids).size, "Cannot concatenate Neighbors objects with overlapping ID values"
         assert self.metric == other.metric, "Cannot concatenate Neighbors objects with different metrics"
+        num_columns = min(self.values.shape[1], other.values.shape[1])
+        if self.distances is not None and other.distances is not None:
+            distances = np.concatenate([self.distances[:,:num_columns], other.distances[:,:num_columns]])
+        else:
+            distances = None
         return Neighbors(
-            np.concatenate(self.values, other.values),
-            ids=np.concatenate(self.ids, other.ids),
+            np.concatenate([self.values[:,:num_columns], other.values[:,:num_columns]]),
+            ids=np.concatenate([self.ids, other.ids]),
             metric=self.metric,
-            n_neighbors = max(self.n_neighbors, other.n_neighbors)
+            n_neighbors=min(self.n_neighbors, other.n_neighbors),
+            distances=distances
         )
     
-    def to_json(self, compressed=True, num_neighbors=None):
-        """Serializes the neighbors to a JSON object."""
+    def insert(self, pos, new_pos, new_ids):
+        """
+        Adds new points to this neighbor set without recomputing neighbors for
+        the entire dataset. The new points are queried against the existing
+        neighbor classifier (or an exact classifier fit on `pos`, if this
+        object has none), and only the existing points whose neighborhoods
+        now contain a new point are re-queried.
+        
+        Args:
+            pos: Matrix of n x D high-dimensional positions for the points that
+                are already in this `Neighbors`, in the same order as `ids`.
+            new_pos: Matrix of m x D high-dimensional positions for the points
+                to insert.
+            new_ids: List of m IDs for the new points, which must not overlap
+                with the existing IDs.
+                
+        Returns:
+            A new `Neighbors` object containing neighbors for all n + m points,
+            with a classifier fit on the combined positions.
+        """
+        new_ids = np.asarray(new_ids)
+        assert len(pos) == len(self), "Positions must be provided for every existing point"
+        assert len(new_pos) == len(new_ids), "Length mismatch: got {} new positions for {} IDs".format(len(new_pos), len(new_ids))
+        assert not np.intersect1d(self.ids, new_ids).size, "Cannot insert points with IDs that are already present"
+        
+        num_existing = len(pos)
+        num_columns = self.values.shape[1]
+        all_ids = np.concatenate([self.ids, new_ids])
+        clf = self.clf if self.clf is not None else NearestNeighbors(metric=self.metric).fit(pos)
+        new_clf = NearestNeighbors(metric=self.metric).fit(new_pos)
+        
+        values = np.empty((num_existing + len(new_ids), num_columns), dtype=_neighbor_id_dtype(all_ids))
+        values[:num_existing] = self.values
+        distances = np.empty(values.shape, dtype=np.float32) if self.distances is not None else None
+        if distances is not None:
+            distances[:num_existing] = self.distances
+        
+        # Neighbors of the new points, from among the existing points and each other
+        existing_dists, existing_indexes = clf.kneighbors(new_pos, n_neighbors=min(num_columns, num_existing))
+        fresh_dists, fresh_indexes = new_clf.kneighbors(new_pos, n_neighbors=min(num_columns + 1, len(new_pos)))
+        merged_dists, merged_indexes = _merge_neighbors(existing_dists, existing_indexes,
+                                                        fresh_dists[:,1:], fresh_indexes[:,1:] + num_existing,
+                                                        num_columns)
+        values[num_existing:] = all_ids[merged_indexes]
+        if distances is not None:
+            distances[num_existing:] = merged_dists
+        
+        # Find existing points for which a new point is closer than the furthest
+        # current neighbor, and patch their neighbor lists
+        nearest_new_dists, _ = new_clf.kneighbors(pos, n_neighbors=1)
+        if self.distances is not None:
+            furthest_dists = self.distances[:,-1]
+        elif self.metric in PAIRED_DISTANCES:
+            furthest_dists = paired_distances(pos, pos[self.index(self.values[:,-1])], metric=self.metric)
+        else:
+            furthest_dists = np.full(num_existing, np.inf)
+        displaced = np.flatnonzero(nearest_new_dists[:,0] < furthest_dists)
+        if len(displaced):
+            existing_dists, existing_indexes = clf.kneighbors(pos[displaced], n_neighbors=min(num_columns + 1, num_existing))
+            fresh_dists, fresh_indexes = new_clf.kneighbors(pos[displaced], n_neighbors=min(num_columns, len(new_pos)))
+            merged_dists, merged_indexes = _merge_neighbors(existing_dists[:,1:], existing_indexes[:,1:],
+                                                            fresh_dists, fresh_indexes + num_existing,
+                                                            num_columns)
+            values[displaced] = all_ids[merged_indexes]
+            if distances is not None:
+                distances[displaced] = merged_dists
+            
+        base_clf = clf if isinstance(clf, NearestNeighbors) else NearestNeighbors(metric=self.metric)
+        combined_clf = clone(base_clf).fit(np.vstack([pos, new_pos]))
+        return Neighbors(values, ids=all_ids, metric=self.metric, n_neighbors=self.n_neighbors, clf=combined_clf, distances=distances)
+    
+    def to_json(self, compressed=True, num_neighbors=None, save_distances=False, index_dir=None, binary=False):
+        """
+        Serializes the neighbors to a JSON object. If `save_distances` is `True`
+        and the `Neighbors` has stored distances, they are serialized as well.
+        If `index_dir` is provided, the fitted neighbor search structure is
+        pickled to a file in that directory, and the JSON only records the
+        file's name, so that neighbors can be queried after loading without
+        refitting (see [`Neighbors.from_json`](#emblaze.neighbors.Neighbors.from_json)).
+        If `binary` is `True` and `compressed` is `True`, the IDs, neighbors
+        and distances are stored as binary buffers for sending to the widget
+        frontend instead of base64 strings, so the result is not
+        JSON-serializable.
+        """
         result = {}
         result["metric"] = self.metric
         result["n_neighbors"] = self.n_neighbors
+        if self.recall is not None:
+            result["recall"] = self.recall
         
         neighbors = self.values
+        distances = self.distances if save_distances else None
         if num_neighbors is not None:
             neighbors = neighbors[:,:min(num_neighbors, neighbors.shape[1])]
+            if distances is not None:
+                distances = distances[:,:neighbors.shape[1]]
             
         if compressed:
             result["_format"] = "compressed"
@@ -125,36 +548,139 @@ class Neighbors:
             dtype, type_name = choose_integer_type(self.ids)
             result["_idtype"] = type_name
             result["_length"] = len(self)
-            result["ids"] = encode_numerical_array(self.ids, dtype)
+            result["ids"] = encode_numerical_array(self.ids, dtype, binary=binary)
             
             result["neighbors"] = encode_numerical_array(neighbors.flatten(),
                                                             astype=dtype,
-                                                            interval=neighbors.shape[1])
+                                                            interval=neighbors.shape[1],
+                                                            binary=binary)
+            if distances is not None:
+                result["distances"] = encode_numerical_array(distances.flatten(),
+                                                             interval=distances.shape[1],
+                                                             binary=binary)
         else:
             result["_format"] = "expanded"
             result["neighbors"] = {}
             indexes = self.index(self.ids)
             for id_val, index in zip(self.ids, indexes):
                 result["neighbors"][id_val] = neighbors[index].tolist()
+            if distances is not None:
+                result["distances"] = {}
+                for id_val, index in zip(self.ids, indexes):
+                    result["distances"][id_val] = distances[index].tolist()
+        if index_dir is not None and self.has_clf():
+            result["index"] = {
+                "_format": "pickle_file",
+                "path": _save_index_file(self.clf, index_dir)
+            }
         return result
     
     @classmethod
-    def from_json(cls, data):
+    def from_json(cls, data, index_dir=None):
+        """
+        Builds a `Neighbors` object from the given JSON object.
+        
+        Args:
+            data: A JSON-serializable dictionary generated using
+                [`Neighbors.to_json`](#emblaze.neighbors.Neighbors.to_json).
+            index_dir: If provided, the neighbor index file referenced by the
+                JSON (if any) is loaded lazily from this directory the first
+                time it is needed. Indexes are deserialized using `pickle`,
+                which can execute arbitrary code, so only pass a directory
+                written by a trusted source. If `None` (default), serialized
+                indexes are ignored and are refit when needed.
+        """
         if data.get("_format", "expanded") == "compressed":
             dtype = np.dtype(data["_idtype"])
             ids = decode_numerical_array(data["ids"], dtype)
             neighbors = decode_numerical_array(data["neighbors"], dtype)
+            distances = decode_numerical_array(data["distances"]) if "distances" in data else None
         else:
             neighbor_dict = data["neighbors"]
+            distance_dict = data.get("distances")
             try:
                 ids = [int(id_val) for id_val in list(neighbor_dict.keys())]
                 neighbor_dict = {int(k): v for k, v in neighbor_dict.items()}
+                if distance_dict is not None:
+                    distance_dict = {int(k): v for k, v in distance_dict.items()}
             except:
                 ids = list(neighbor_dict.keys())
             ids = sorted(ids)
             neighbors = np.array([neighbor_dict[id_val] for id_val in ids])
+            if distance_dict is not None:
+                distances = np.array([distance_dict[id_val] for id_val in ids], dtype=np.float32)
+            else:
+                distances = None
                 
-        return cls(neighbors, ids=ids, metric=data["metric"], n_neighbors=data["n_neighbors"])
+        result = cls(neighbors, ids=ids, metric=data["metric"], n_neighbors=data["n_neighbors"], recall=data.get("recall"), distances=distances)
+        index = data.get("index")
+        if index_dir is not None and index is not None:
+            if index.get("_format") == "pickle_file":
+                result.set_clf_loader(_FileIndexLoader(os.path.join(index_dir, os.path.basename(index["path"]))))
+            else:
+                print("Ignoring neighbor index embedded in JSON; re-save the comparison with index_dir to store it separately")
+        return result
+
+    def save(self, directory, save_index=False, save_distances=True):
+        """
+        Saves the neighbors to the given directory as raw `.npy` files, which
+        can be memory-mapped when loaded using [`Neighbors.load`](#emblaze.neighbors.Neighbors.load).
+        The directory is created if it does not exist.
+        
+        Args:
+            directory: Path to a directory in which to write the neighbor data.
+            save_index: If `True`, the fitted neighbor search structure is
+                pickled to the directory as well, and can be loaded lazily
+                by passing `load_index=True` to `Neighbors.load`.
+            save_distances: If `True` (default), the distances to each
+                neighbor are saved if available.
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "ids.npy"), np.asarray(self.ids))
+        np.save(os.path.join(directory, "neighbors.npy"), np.ascontiguousarray(self.values))
+        if save_distances and self.distances is not None:
+            np.save(os.path.join(directory, "distances.npy"), np.ascontiguousarray(self.distances))
+        if save_index and self.has_clf():
+            with open(os.path.join(directory, "index.pkl"), "wb") as file:
+                pickle.dump(self.clf, file)
+        metadata = {"metric": self.metric, "n_neighbors": self.n_neighbors}
+        if self.recall is not None:
+            metadata["recall"] = self.recall
+        with open(os.path.join(directory, "metadata.json"), "w") as file:
+            json.dump(standardize_json(metadata), file)
+            
+    @classmethod
+    def load(cls, directory, mmap=True, load_index=False):
+        """
+        Loads a `Neighbors` object that was saved using [`Neighbors.save`](#emblaze.neighbors.Neighbors.save).
+        
+        Args:
+            directory: Path to the directory containing the neighbor data.
+            mmap: If `True`, the neighbor matrix is memory-mapped read-only
+                instead of being read into memory, so that rows are only paged
+                in when they are accessed and the data can be shared between
+                processes through the page cache.
+            load_index: If `True` and the directory contains a saved neighbor
+                index, it is loaded lazily the first time it is needed. The
+                index is deserialized using `pickle`, so only set this for
+                directories written by a trusted source.
+                
+        Returns:
+            A `Neighbors` object backed by the files in the directory.
+        """
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, "metadata.json"), "r") as file:
+            metadata = json.load(file)
+        ids = np.load(os.path.join(directory, "ids.npy"))
+        neighbors = np.load(os.path.join(directory, "neighbors.npy"), mmap_mode=mmap_mode)
+        distance_path = os.path.join(directory, "distances.npy")
+        distances = np.load(distance_path, mmap_mode=mmap_mode) if os.path.exists(distance_path) else None
+        result = cls(neighbors, ids=ids, metric=metadata["metric"], n_neighbors=metadata["n_neighbors"],
+                     recall=metadata.get("recall"), distances=distances)
+        index_path = os.path.join(directory, "index.pkl")
+        if load_index and os.path.exists(index_path):
+            result.set_clf_loader(_FileIndexLoader(index_path))
+        return result
 
 class NeighborSet:
     """
@@ -186,16 +712,124 @@ class NeighborSet:
     def __ne__(self, other):
         return not (self == other)
     
-    def to_json(self, compressed=True, num_neighbors=None):
+    def to_json(self, compressed=True, num_neighbors=None, save_distances=False, index_dir=None, binary=False):
         """
         Serializes the list of Neighbors objects to JSON.
         """
-        return [n.to_json(compressed=compressed, num_neighbors=num_neighbors)
+        return [n.to_json(compressed=compressed, num_neighbors=num_neighbors,
+                          save_distances=save_distances, index_dir=index_dir,
+                          binary=binary)
                 for n in self]
         
     @classmethod
-    def from_json(cls, data):
-        return [Neighbors.from_json(d) for d in data]
+    def from_json(cls, data, index_dir=None):
+        return [Neighbors.from_json(d, index_dir=index_dir) for d in data]
+    
+    def save(self, directory, save_index=False, save_distances=True):
+        """
+        Saves the Neighbors objects to subdirectories of the given directory
+        in `.npy` format (see [`Neighbors.save`](#emblaze.neighbors.Neighbors.save)).
+        Neighbors objects that are shared between multiple frames are only
+        written once.
+        """
+        os.makedirs(directory, exist_ok=True)
+        frames = []
+        saved = {}
+        for n in self:
+            if id(n) not in saved:
+                saved[id(n)] = len(saved)
+                n.save(os.path.join(directory, str(saved[id(n)])), save_index=save_index, save_distances=save_distances)
+            frames.append(saved[id(n)])
+        with open(os.path.join(directory, "metadata.json"), "w") as file:
+            json.dump({"frames": frames}, file)
+            
+    @classmethod
+    def load(cls, directory, mmap=True, load_index=False):
+        """
+        Loads a `NeighborSet` that was saved using [`NeighborSet.save`](#emblaze.neighbors.NeighborSet.save).
+        If `mmap` is `True`, each neighbor matrix is memory-mapped rather than
+        read into memory, and frames that shared a Neighbors object when saved
+        share the same mapping. Saved neighbor indexes are only loaded if
+        `load_index` is `True` (see [`Neighbors.load`](#emblaze.neighbors.Neighbors.load)).
+        """
+        with open(os.path.join(directory, "metadata.json"), "r") as file:
+            frames = json.load(file)["frames"]
+        loaded = {}
+        for subdir in frames:
+            if subdir not in loaded:
+                loaded[subdir] = Neighbors.load(os.path.join(directory, str(subdir)), mmap=mmap, load_index=load_index)
+        return cls([loaded[subdir] for subdir in frames])
+    
+    def _frame_matrices(self, idx_1, idx_2, ids=None, num_neighbors=None):
+        """
+        Returns sparse adjacency matrices for the given two frames whose rows
+        correspond to the same points (the given IDs, or all points in common
+        between the frames) and whose columns correspond to the same IDs.
+        """
+        n1 = self[idx_1]
+        n2 = self[idx_2]
+        if n1 is n2 or np.array_equal(n1.ids, n2.ids):
+            mat_1 = n1.to_csr(num_neighbors)
+            mat_2 = n2.to_csr(num_neighbors)
+            if ids is not None:
+                rows = n1.index(ids)
+                mat_1 = mat_1[rows]
+                mat_2 = mat_2[rows]
+            return mat_1, mat_2
+        
+        # The frames contain different points, so compare the points they have
+        # in common using a shared ID space for the columns
+        row_ids = np.asarray(list(ids) if isinstance(ids, set) else ids) if ids is not None else np.intersect1d(n1.ids, n2.ids)
+        column_index = IDIndex(np.union1d(n1.ids, n2.ids))
+        return tuple(neighbor_csr(n[row_ids][:,:num_neighbors], column_index)
+                     for n in (n1, n2))
+    
+    def _overlap_sizes(self, idx_1, idx_2, ids=None, num_neighbors=None):
+        """Returns the per-point neighbor overlap between two frames, along
+        with the number of neighbors of each point in each frame."""
+        mat_1, mat_2 = self._frame_matrices(idx_1, idx_2, ids=ids, num_neighbors=num_neighbors)
+        overlap = np.asarray(mat_1.multiply(mat_2).sum(axis=1)).ravel()
+        return overlap, mat_1.getnnz(axis=1), mat_2.getnnz(axis=1)
+        
+    def overlap_counts(self, idx_1, idx_2, ids=None, num_neighbors=None):
+        """
+        Returns the number of neighbors that each point has in common between
+        two frames.
+        
+        Args:
+            idx_1: Index of the first frame in this `NeighborSet`.
+            idx_2: Index of the second frame in this `NeighborSet`.
+            ids: The IDs of the points to compare. If `None`, all points that
+                are present in both frames are compared.
+            num_neighbors: The number of neighbors per point to compare. If
+                `None`, all stored neighbors are used.
+                
+        Returns:
+            An array containing the overlap count for each point.
+        """
+        return self._overlap_sizes(idx_1, idx_2, ids=ids, num_neighbors=num_neighbors)[0]
+    
+    def jaccard_distances(self, idx_1, idx_2, ids=None, num_neighbors=None):
+        """
+        Returns the Jaccard distance between each point's neighbor sets in two
+        frames. See [`NeighborSet.overlap_counts`](#emblaze.neighbors.NeighborSet.overlap_counts)
+        for a description of the arguments.
+        """
+        overlap, size_1, size_2 = self._overlap_sizes(idx_1, idx_2, ids=ids, num_neighbors=num_neighbors)
+        return 1.0 - overlap / np.maximum(size_1 + size_2 - overlap, 1)
+    
+    def change_counts(self, idx_1, idx_2, ids=None, num_neighbors=None):
+        """
+        Returns the number of neighbors each point gains and loses going from
+        frame `idx_1` to frame `idx_2`. See [`NeighborSet.overlap_counts`](#emblaze.neighbors.NeighborSet.overlap_counts)
+        for a description of the arguments.
+        
+        Returns:
+            A tuple of two arrays, containing the number of gained neighbors and
+            the number of lost neighbors for each point.
+        """
+        overlap, size_1, size_2 = self._overlap_sizes(idx_1, idx_2, ids=ids, num_neighbors=num_neighbors)
+        return size_2 - overlap, size_1 - overlap
     
     def identical(self):
         """Returns True if all Neighbors objects within this NeighborSet are equal to each other."""
@@ -4,141 +4,1160 @@ consistent or noteworthy changes from one frame to another.
 """
 
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
-from .utils import Field, inverse_intersection, standardize_json
-from numba.typed import List
+from .utils import IDIndex, standardize_json, process_pool_executor, array_fingerprint, compact_ids
+from .neighbors import NeighborSet, neighbor_csr
 from scipy.sparse import csr_matrix
-import collections
+from scipy.sparse.csgraph import connected_components
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from numba import jit, types
+from numba.typed import Dict, List
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import json
+import os
+import shutil
+import sys
+import tempfile
 
 NUM_NEIGHBORS_FOR_SEARCH = 10
 
+# Average jaccard distances at which the cluster hierarchy is cut to produce
+# suggested selections at multiple granularities
+DEFAULT_CLUSTER_THRESHOLDS = (0.7, 0.8, 0.9)
+
+# Memory budget in bytes for clustering a connected group of points exactly
+# using a dense distance matrix, and the approximate peak number of bytes that
+# dense clustering uses per pair of points
+DENSE_CLUSTERING_MEMORY = 2 * 1024 ** 3
+DENSE_CLUSTERING_BYTES_PER_PAIR = 16
+# Connected groups of points larger than this (whose dense distance matrix
+# would not fit in the memory budget) are clustered using an approximate sparse
+# average-linkage algorithm
+DENSE_CLUSTERING_LIMIT = int(np.sqrt(DENSE_CLUSTERING_MEMORY / DENSE_CLUSTERING_BYTES_PER_PAIR))
+
+# Incremented whenever the clustering algorithm or cluster format changes, so
+# that stale entries in a suggestion cache are not reused
+SUGGESTION_CACHE_VERSION = 3
+
+# Environment variable that enables the suggestion cache in the viewer and
+# sets its directory
+CACHE_DIR_ENV_VAR = "EMBLAZE_CACHE_DIR"
+
+# Default maximum total size in bytes of the entries in a suggestion cache
+DEFAULT_SUGGESTION_CACHE_SIZE = 256 * 1024 ** 2
+
+@jit(nopython=True, cache=True)
+def _find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@jit(nopython=True, cache=True)
+def _sparse_average_linkage(indptr, indices, similarities, max_distance):
+    """
+    Performs average-linkage agglomerative clustering on a sparse similarity
+    graph, using the nearest-neighbor chain algorithm. Pairs of points without
+    an edge are treated as having a distance of 1, so the average distance
+    between two clusters is 1 minus the sum of their edge similarities divided
+    by the product of their sizes. Only merges below max_distance are
+    performed. Since pairs whose similarity was dropped from the graph count
+    as maximally distant, the result approximates average linkage on the full
+    distance matrix.
+    
+    Args:
+        indptr, indices, similarities: A symmetric CSR matrix of similarities
+            with no diagonal entries.
+        max_distance: Distance at or above which clusters are not merged.
+        
+    Returns:
+        Three arrays containing a representative point from each of the two
+        merged clusters and the distance at which they were merged.
+    """
+    n = len(indptr) - 1
+    parent = np.arange(n)
+    sizes = np.ones(n, dtype=np.int64)
+    weights = Dict.empty(key_type=types.int64, value_type=types.float64)
+    adjacency = List()
+    for i in range(n):
+        adjacency.append(indices[indptr[i]:indptr[i + 1]].astype(np.int64))
+        for p in range(indptr[i], indptr[i + 1]):
+            if i < indices[p]:
+                weights[i * n + indices[p]] = similarities[p]
+    
+    merge_a = np.empty(n, dtype=np.int64)
+    merge_b = np.empty(n, dtype=np.int64)
+    merge_heights = np.empty(n, dtype=np.float64)
+    num_merges = 0
+    chain = np.empty(n, dtype=np.int64)
+    finished = np.zeros(n, dtype=np.bool_)
+    for start in range(n):
+        if parent[start] != start or finished[start]:
+            continue
+        chain[0] = start
+        chain_len = 1
+        while chain_len > 0:
+            current = chain[chain_len - 1]
+            previous = chain[chain_len - 2] if chain_len > 1 else -1
+            
+            # Find the nearest neighbor of the cluster at the end of the chain,
+            # preferring the previous cluster in the chain to break ties
+            best = -1
+            best_distance = max_distance
+            for x in adjacency[current]:
+                x = _find_root(parent, x)
+                if x == current:
+                    continue
+                key = min(current, x) * n + max(current, x)
+                if key not in weights:
+                    continue
+                distance = 1.0 - weights[key] / (sizes[current] * sizes[x])
+                if distance < best_distance or (x == previous and distance == best_distance and best != -1):
+                    best = x
+                    best_distance = distance
+                    
+            if best == -1:
+                finished[current] = True
+                chain_len -= 1
+            elif best != previous:
+                chain[chain_len] = best
+                chain_len += 1
+            else:
+                # Merge the last two clusters in the chain, keeping the one
+                # with the larger adjacency list as the root
+                chain_len -= 2
+                root, other = current, previous
+                if len(adjacency[other]) > len(adjacency[root]):
+                    root, other = other, root
+                for x in adjacency[other]:
+                    x = _find_root(parent, x)
+                    if x == root or x == other:
+                        continue
+                    other_key = min(other, x) * n + max(other, x)
+                    if other_key in weights:
+                        root_key = min(root, x) * n + max(root, x)
+                        weights[root_key] = weights.get(root_key, 0.0) + weights.pop(other_key)
+                weights.pop(min(root, other) * n + max(root, other))
+                parent[other] = root
+                sizes[root] += sizes[other]
+                
+                combined = np.concatenate((adjacency[root], adjacency[other]))
+                for k in range(len(combined)):
+                    combined[k] = _find_root(parent, combined[k])
+                combined = np.unique(combined)
+                adjacency[root] = combined[combined != root]
+                adjacency[other] = np.empty(0, dtype=np.int64)
+                
+                merge_a[num_merges] = root
+                merge_b[num_merges] = other
+                merge_heights[num_merges] = best_distance
+                num_merges += 1
+                if chain_len == 0:
+                    # The merged cluster may come before start, so continue
+                    # the chain from it rather than leaving it unvisited
+                    chain[0] = root
+                    chain_len = 1
+    return merge_a[:num_merges], merge_b[:num_merges], merge_heights[:num_merges]
+
+@jit(nopython=True, cache=True)
+def _merge_roots(num_points, merge_a, merge_b, merge_heights, threshold):
+    parent = np.arange(num_points)
+    for k in range(len(merge_a)):
+        if merge_heights[k] < threshold:
+            parent[_find_root(parent, merge_b[k])] = _find_root(parent, merge_a[k])
+    for i in range(num_points):
+        parent[i] = _find_root(parent, i)
+    return parent
+
+def _cut_merges(num_points, merge_a, merge_b, merge_heights, threshold):
+    """
+    Returns cluster labels for the given number of points after applying all
+    merges whose height is below the given threshold.
+    """
+    roots = _merge_roots(num_points, merge_a, merge_b, merge_heights, threshold)
+    return np.unique(roots, return_inverse=True)[1].flatten()
+
+@jit(nopython=True, cache=True)
+def _neighbor_differences(rows_1, rows_2, id_space):
+    """
+    Computes the set differences between corresponding rows of two matrices
+    of non-negative integer IDs less than id_space. Returns CSR-style
+    (indptr, indices) arrays for the IDs in each row of rows_2 that are not
+    in rows_1 (gained), followed by those for the IDs in each row of rows_1
+    that are not in rows_2 (lost). Each ID appears at most once per row.
+    """
+    num_rows = rows_1.shape[0]
+    stamps_1 = np.zeros(id_space, dtype=np.int64)
+    stamps_2 = np.zeros(id_space, dtype=np.int64)
+    gained_indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    lost_indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    gained_indices = np.empty(num_rows * rows_2.shape[1], dtype=np.int64)
+    lost_indices = np.empty(num_rows * rows_1.shape[1], dtype=np.int64)
+    num_gained = 0
+    num_lost = 0
+    for i in range(num_rows):
+        # Stamps increase with each row, so the scratch arrays never need to
+        # be cleared
+        stamp = i + 1
+        for x in rows_1[i]:
+            stamps_1[x] = stamp
+        for x in rows_2[i]:
+            stamps_2[x] = stamp
+        for x in rows_2[i]:
+            if stamps_1[x] != stamp:
+                gained_indices[num_gained] = x
+                num_gained += 1
+                stamps_1[x] = stamp
+        for x in rows_1[i]:
+            if stamps_2[x] != stamp:
+                lost_indices[num_lost] = x
+                num_lost += 1
+                stamps_2[x] = stamp
+        gained_indptr[i + 1] = num_gained
+        lost_indptr[i + 1] = num_lost
+    return gained_indptr, gained_indices[:num_gained], lost_indptr, lost_indices[:num_lost]
+
+@jit(nopython=True, cache=True)
+def _cluster_inverse_intersections(positions_1, positions_2, labels):
+    """
+    Computes the inverse intersection size of each point's neighbor sets in
+    two frames, counting only neighbors in the same cluster as the point.
+    positions_1 and positions_2 contain the point indexes of each point's
+    neighbors in each frame (-1 for neighbors that are not clustered), and
+    labels contains the cluster of each point (-1 for points to skip).
+    """
+    num_points = positions_1.shape[0]
+    distances = np.zeros(num_points)
+    stamps = np.zeros(num_points, dtype=np.int64)
+    for i in range(num_points):
+        label = labels[i]
+        if label < 0:
+            continue
+        seen = 2 * i + 2
+        counted = 2 * i + 3
+        nonempty = False
+        num_intersection = 0
+        for p in positions_1[i]:
+            if p >= 0 and labels[p] == label:
+                stamps[p] = seen
+                nonempty = True
+        for p in positions_2[i]:
+            if p >= 0 and labels[p] == label:
+                nonempty = True
+                if stamps[p] == seen:
+                    num_intersection += 1
+                    stamps[p] = counted
+        if nonempty:
+            distances[i] = 1 / (1 + num_intersection)
+    return distances
+
+def _stack_csr_rows(csr_1, csr_2):
+    """
+    Concatenates the rows of two CSR-style (indptr, indices) tuples, either
+    of which may be `None`.
+    """
+    if csr_1 is None: return csr_2
+    if csr_2 is None: return csr_1
+    return (np.concatenate([csr_1[0], csr_1[0][-1] + csr_2[0][1:]]),
+            np.concatenate([csr_1[1], csr_2[1]]))
+
+def _take_csr_rows(indptr, indices, rows):
+    """
+    Returns a CSR-style (indptr, indices) tuple containing the given rows of
+    the given CSR-style arrays, in order.
+    """
+    lengths = np.diff(indptr)[rows]
+    new_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    positions = np.arange(new_indptr[-1]) - np.repeat(new_indptr[:-1], lengths) + np.repeat(indptr[rows], lengths)
+    return new_indptr, indices[positions]
+
+class _NeighborChanges:
+    """
+    The gained and lost neighbors of a set of points between a pair of frames,
+    and their pairwise jaccard similarities.
+    """
+    def __init__(self, ids, gained_ids, lost_ids, gained_sim, lost_sim):
+        super().__init__()
+        self.ids = ids
+        self.gained_ids = gained_ids
+        self.lost_ids = lost_ids
+        self.gained_sim = gained_sim
+        self.lost_sim = lost_sim
+
+class _WorkerFrame:
+    """
+    A minimal stand-in for an `Embedding` in cluster worker processes, holding
+    only the point IDs of a frame and its recent `Neighbors`.
+    """
+    def __init__(self, ids, neighbors):
+        super().__init__()
+        self.ids = ids
+        self._neighbors = neighbors
+        
+    def __len__(self):
+        return len(self.ids)
+    
+    def get_recent_neighbors(self):
+        return self._neighbors
+
+def _save_worker_inputs(embeddings, directory):
+    """
+    Saves the arrays that worker processes need to cluster frame pairs (the
+    point IDs of each frame and the IDs and values of its recent neighbors)
+    as `.npy` files in the given directory.
+    """
+    for i, emb in enumerate(embeddings):
+        np.save(os.path.join(directory, "ids-{}.npy".format(i)), np.asarray(emb.ids))
+    embeddings.get_recent_neighbors().save(os.path.join(directory, "neighbors"), save_distances=False)
+    with open(os.path.join(directory, "metadata.json"), "w") as file:
+        json.dump({"num_frames": len(embeddings)}, file)
+
+_worker_recommender = None
+_worker_directory = None
+
+def _init_cluster_worker(directory):
+    """
+    Memory-maps the inputs saved by `_save_worker_inputs` read-only, so that
+    worker processes share them through the page cache instead of each
+    receiving a pickled copy of the embeddings.
+    """
+    global _worker_recommender, _worker_directory
+    if directory == _worker_directory:
+        return
+    with open(os.path.join(directory, "metadata.json"), "r") as file:
+        num_frames = json.load(file)["num_frames"]
+    neighbor_set = NeighborSet.load(os.path.join(directory, "neighbors"), mmap=True)
+    frames = [_WorkerFrame(np.load(os.path.join(directory, "ids-{}.npy".format(i)), mmap_mode='r'), neighbors)
+              for i, neighbors in zip(range(num_frames), neighbor_set)]
+    _worker_recommender = SelectionRecommender(frames, lazy=True)
+    _worker_directory = directory
+    
+def _make_clusters_worker(pairs, **kwargs):
+    return _worker_recommender._make_clusters_for_pairs(pairs, **kwargs)
+
+def _init_and_make_clusters(directory, pairs, **kwargs):
+    _init_cluster_worker(directory)
+    return _make_clusters_worker(pairs, **kwargs)
+
+def _make_clusters_in_executor(recommender, pairs, **kwargs):
+    return recommender._make_clusters_for_pairs(pairs, **kwargs)
+
+class _ClusterIndex:
+    """
+    An inverted index from point IDs to the clusters that contain them, along
+    with per-cluster arrays of sizes and base scores. Clusters are numbered
+    globally in the order of the recommender's frame pairs.
+    """
+    def __init__(self, clusters):
+        super().__init__()
+        self.frame_keys = list(clusters.keys())
+        self.clusters = [c for key in self.frame_keys for c in clusters[key]]
+        counts = [len(clusters[key]) for key in self.frame_keys]
+        self.key_indexes = np.repeat(np.arange(len(self.frame_keys)), counts)
+        self.local_indexes = np.concatenate([np.arange(c) for c in counts]) if counts else np.zeros(0, dtype=int)
+        self.base_frames = np.array([key[0] for key in self.frame_keys], dtype=int)[self.key_indexes]
+        self.sizes = np.array([len(c['ids']) for c in self.clusters], dtype=np.int64)
+        self.base_scores = np.array([float(c['consistency']) + c['innerChange'] + c['gain'] + c['loss']
+                                     for c in self.clusters], dtype=np.float64) * np.log(self.sizes)
+        
+        member_ids = np.array([x for c in self.clusters for x in c['ids']])
+        member_clusters = np.repeat(np.arange(len(self.clusters)), self.sizes)
+        order = np.argsort(member_ids, kind='stable')
+        self.member_ids = member_ids[order]
+        self.member_clusters = member_clusters[order]
+        
+    def __len__(self):
+        return len(self.clusters)
+        
+    def overlap_counts(self, ids):
+        """
+        Returns an array containing the number of the given IDs that are
+        present in each cluster.
+        """
+        if ids is None or len(self.member_ids) == 0:
+            return np.zeros(len(self), dtype=np.int64)
+        ids = np.unique(np.asarray(list(ids)))
+        if len(ids) == 0:
+            return np.zeros(len(self), dtype=np.int64)
+        lo = np.searchsorted(self.member_ids, ids, side='left')
+        hi = np.searchsorted(self.member_ids, ids, side='right')
+        lengths = hi - lo
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(lo, lengths)
+        return np.bincount(self.member_clusters[positions], minlength=len(self))
+
+def default_suggestion_cache_dir():
+    """
+    Returns the directory in which suggested selections are cached by default:
+    the value of the `EMBLAZE_CACHE_DIR` environment variable if set, and
+    otherwise `None` (caching is disabled).
+    """
+    if os.environ.get(CACHE_DIR_ENV_VAR):
+        return os.path.expanduser(os.environ[CACHE_DIR_ENV_VAR])
+    return None
+
+class SuggestionCache:
+    """
+    A content-addressed on-disk cache of the clusters generated for individual
+    frame pairs. Each entry is keyed by the fingerprints of the two frames'
+    recent neighbor sets (along with the frame IDs and clustering parameters),
+    so clusters are reused across sessions whenever a frame pair's neighbors
+    are unchanged, and recomputed otherwise.
+    
+    Clusters are stored in one `.npz` file per frame pair as compact arrays:
+    the concatenated cluster member IDs, the offsets of each cluster within
+    them, and the scores of each cluster. When the total size of the entries
+    exceeds `max_size`, the least recently used entries are removed.
+    """
+    def __init__(self, directory, max_size=DEFAULT_SUGGESTION_CACHE_SIZE):
+        """
+        Args:
+            directory: Path to the directory in which to store cached clusters.
+                The directory is created the first time an entry is saved.
+            max_size: Maximum total size in bytes of the cached entries, or
+                `None` for no limit.
+        """
+        super().__init__()
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        
+    def make_key(self, embeddings, idx_1, idx_2, thresholds=DEFAULT_CLUSTER_THRESHOLDS):
+        """
+        Returns the cache key for the clusters of the given frame pair.
+        """
+        frame_1 = embeddings[idx_1]
+        frame_2 = embeddings[idx_2]
+        return array_fingerprint(SUGGESTION_CACHE_VERSION,
+                                 DENSE_CLUSTERING_LIMIT,
+                                 np.asarray(thresholds, dtype=np.float64),
+                                 frame_1.ids,
+                                 frame_1.get_recent_neighbors().fingerprint(),
+                                 frame_2.get_recent_neighbors().fingerprint())
+        
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+        
+    def load(self, key, idx_1, idx_2):
+        """
+        Returns the list of clusters stored under the given key, with their
+        frame indexes set to idx_1 and idx_2, or `None` if there is no entry
+        (or it cannot be read).
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                ids, indptr = data["ids"].tolist(), data["indptr"]
+                consistency, scores = data["consistency"], data["scores"]
+        except Exception as e:
+            print("Error reading cached suggestions from {}: {}".format(path, e))
+            return None
+        try:
+            # Mark the entry as recently used so it is evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        return [{
+            'ids': set(ids[indptr[i]:indptr[i + 1]]),
+            'frame': idx_1,
+            'previewFrame': idx_2,
+            'consistency': consistency[i],
+            'innerChange': scores[i, 0],
+            'gain': scores[i, 1],
+            'loss': scores[i, 2]
+        } for i in range(len(indptr) - 1)]
+        
+    def save(self, key, clusters):
+        """
+        Stores the given list of clusters under the given key. Entries are
+        written to a temporary file and then moved into place, so concurrent
+        readers never see a partially written file.
+        """
+        ids = np.array([x for c in clusters for x in sorted(c['ids'])])
+        if ids.dtype == object:
+            # Mixed ID types cannot be stored without pickling
+            return
+        if len(ids) == 0:
+            ids = ids.astype(np.int32)
+        elif (np.issubdtype(ids.dtype, np.integer) and
+              ids.min() >= np.iinfo(np.int32).min and ids.max() <= np.iinfo(np.int32).max):
+            ids = ids.astype(np.int32)
+        indptr = np.concatenate([[0], np.cumsum([len(c['ids']) for c in clusters])]).astype(np.int64)
+        # Consistency scores are stored with their own dtype
+        consistency = np.array([c['consistency'] for c in clusters])
+        scores = np.array([[c['innerChange'], c['gain'], c['loss']] for c in clusters],
+                          dtype=np.float64).reshape(-1, 3)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    np.savez(file, ids=ids, indptr=indptr, consistency=consistency, scores=scores)
+                os.replace(tmp_path, self._path(key))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self._evict()
+        except OSError as e:
+            print("Error saving suggestions to cache directory {}: {}".format(self.directory, e))
+            
+    def _evict(self):
+        """
+        Removes the least recently used entries until the total size of the
+        cache is at most `max_size`.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"): continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size: break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total_size -= size
+            
+    def clear(self):
+        """Removes all entries from the cache directory."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
 class SelectionRecommender:
     """
     Generates recommended selections based on a variety of inputs. The
     recommender works by pre-generating a list of clusters at various
     granularities, then sorting them by relevance to a given query.
+    
+    Clusters for each pair of frames are independent, so they can be generated
+    in parallel by passing `n_jobs` (the number of worker processes, or -1 to
+    use all processors) or an existing `concurrent.futures.Executor`. The
+    resulting clusters are the same and in the same order regardless of how
+    they are computed.
+    
+    When clusters are needed for both directions of a frame pair, the neighbor
+    changes and clustering are computed once and shared, since the gained
+    neighbors in one direction are the lost neighbors in the other.
+    
+    If a `cache` is provided (either a `SuggestionCache` or a directory path),
+    the clusters for each frame pair whose neighbors are unchanged since they
+    were last computed are loaded from the cache, and newly computed clusters
+    are saved to it. The cache is only used when clusters are computed for
+    all points (i.e. `filter_points` is `None`).
     """
-    def __init__(self, embeddings, clusters=None, progress_fn=None, frame_idx=None, preview_frame_idx=None, filter_points=None):
+    def __init__(self, embeddings, clusters=None, progress_fn=None, frame_idx=None, preview_frame_idx=None, filter_points=None, thresholds=DEFAULT_CLUSTER_THRESHOLDS, n_jobs=1, executor=None, cache=None, lazy=False, reuse_from=None):
+        """
+        Args:
+            embeddings: The `EmbeddingSet` for which to generate clusters.
+            clusters: An optional dictionary of precomputed clusters, keyed
+                by (frame, preview frame) tuples.
+            progress_fn: A function that is called with the fraction of frame
+                pairs completed each time a frame pair finishes.
+            frame_idx: If provided, only generate clusters for frame pairs
+                starting at this frame.
+            preview_frame_idx: If provided, only generate clusters for frame
+                pairs ending at this frame.
+            filter_points: If provided, only cluster these point IDs.
+            thresholds: Average jaccard distances at which to cut the cluster
+                hierarchy.
+            n_jobs: Number of worker processes to use to cluster frame pairs.
+            executor: An existing `concurrent.futures.Executor` to use instead
+                of creating a process pool.
+            cache: A `SuggestionCache` or a directory path in which to cache
+                clusters for each frame pair.
+            lazy: If `True`, the clusters are not computed in the constructor.
+                Instead, iterate over `iter_compute()` to compute them and
+                receive each frame pair as soon as its clusters are available.
+            reuse_from: A previous `SelectionRecommender` for the same
+                embeddings. If it was built for the same filter points, its
+                clusters are reused directly. Otherwise, its neighbor changes
+                and similarities for its filter points are reused, so that
+                when the filter points change only slightly, only the rows for
+                newly added points are computed (for frame pairs clustered in
+                this process).
+        """
         super().__init__()
         self.embeddings = embeddings
         self.clusters = clusters if clusters is not None else {}
+        self.thresholds = list(thresholds)
+        self.filter_points = list(filter_points) if filter_points is not None else None
         self.is_restricted = frame_idx is not None or preview_frame_idx is not None or filter_points is not None
         embs_first = [frame_idx] if frame_idx is not None else range(len(self.embeddings))
         embs_second = [preview_frame_idx] if preview_frame_idx is not None else range(len(self.embeddings))
-        total_num_embs = sum(1 for x in embs_first for y in embs_second if x != y)
-        for i in embs_first:
-            for j in embs_second:
-                if i == j or (i, j) in self.clusters: continue
-                self.clusters[(i, j)] = self._make_clusters(i, j, np.log10(len(self.embeddings[i])), filter_points=filter_points)
-                if progress_fn is not None:
-                    progress_fn(len(self.clusters) / total_num_embs)
-        
-    def _make_neighbor_mat(self, neighbors, num_columns):
-        """Converts a list of neighbor indexes into a one-hot encoded matrix."""
-        neighbor_mat = np.zeros((len(neighbors), num_columns + 1), dtype=np.uint8)
-        if isinstance(neighbors, list):
-            max_len = max(len(n) for n in neighbors)
-            neighbors_padded = -np.ones((len(neighbors), max_len), dtype=int)
-            for i, n in enumerate(neighbors):
-                neighbors_padded[i,:len(n)] = list(n)
-            neighbors = neighbors_padded
-
-        for i in range(neighbors.shape[1]):
-            neighbor_mat[np.arange(len(neighbors)), neighbors[:,i] + 1] = 1
-        return csr_matrix(neighbor_mat[:,1:])
-
-    def _pairwise_jaccard_distances(self, neighbors):
-        """Computes the jaccard distance between each row of the given set of neighbors."""
-        lengths = np.array([len(n) for n in neighbors], dtype=np.uint16)
-        if np.sum(lengths) == 0:
-            return np.zeros((len(neighbors), len(neighbors)))
-
-        # Make a one-hot matrix of neighbors
-        neighbor_mat = self._make_neighbor_mat(neighbors, max(np.max([n for x in neighbors for n in x]) + 1, len(neighbors)))
-        # Calculate intersection of sets using dot product
-        intersection = np.dot(neighbor_mat, neighbor_mat.T)
-        del neighbor_mat
+        if (reuse_from is not None and reuse_from.embeddings is embeddings and
+            reuse_from.thresholds == self.thresholds and reuse_from.filter_points == self.filter_points):
+            # Clusters computed for exactly the same points can be reused as-is
+            for pair in ((i, j) for i in embs_first for j in embs_second if i != j):
+                if pair in reuse_from.clusters and pair not in self.clusters:
+                    self.clusters[pair] = reuse_from.clusters[pair]
+        self._pending = {
+            'pairs': [(i, j) for i in embs_first for j in embs_second
+                      if i != j and (i, j) not in self.clusters],
+            'total': sum(1 for x in embs_first for y in embs_second if x != y),
+            'progress_fn': progress_fn,
+            'filter_points': filter_points,
+            'n_jobs': n_jobs,
+            'executor': executor,
+            'cache': cache
+        }
+        self._cluster_index = None
+        self._cluster_index_signature = None
+        if reuse_from is not None and reuse_from.embeddings is embeddings:
+            self._neighbor_change_cache = reuse_from._neighbor_change_cache
+        else:
+            self._neighbor_change_cache = {}
+        if not lazy:
+            for _ in self.iter_compute(): pass
+            
+    def __getstate__(self):
+        # Worker processes only need the embeddings and clusters
+        state = self.__dict__.copy()
+        state['_pending'] = None
+        state['_cluster_index'] = None
+        state['_cluster_index_signature'] = None
+        state['_neighbor_change_cache'] = {}
+        return state
+        
+    @property
+    def is_complete(self):
+        """`True` if the clusters for all requested frame pairs have been computed."""
+        return self._pending is None
+        
+    def iter_compute(self, cancel_token=None):
+        """
+        Computes the clusters for all frame pairs that have not been computed
+        yet, yielding each (frame, preview frame) pair as soon as its clusters
+        have been added to `clusters`. Pairs loaded from the cache are yielded
+        first, followed by computed pairs in order of completion. The
+        recommender can be queried between iterations to obtain suggestions
+        based on the clusters computed so far.
+        
+        If iteration is stopped early, the remaining pairs are computed the
+        next time this method is called (pairs that were already completed
+        are not yielded again). Once all pairs are complete, the
+        clusters are stored in the same order as if they had been computed
+        serially.
+        
+        Args:
+            cancel_token: An optional `utils.CancellationToken`. It is checked
+                between frame pairs (and between the steps of clustering each
+                frame pair, when clustering in this process), raising
+                `utils.TaskCancelled` once the token is cancelled. The
+                computation can be resumed by calling this method again.
+        """
+        if self._pending is None:
+            return
+        pending = self._pending
+        progress_fn = pending['progress_fn']
+        all_pairs = pending['pairs']
+        pairs = [pair for pair in all_pairs if pair not in self.clusters]
+        total_num_embs = pending['total']
+        num_completed = total_num_embs - len(pairs)
+        filter_points = pending['filter_points']
+        n_jobs = pending['n_jobs']
+        executor = pending['executor']
+        cache = pending['cache']
+        
+        def complete(pair, clusters):
+            nonlocal num_completed
+            self.clusters[pair] = clusters
+            num_completed += 1
+            if progress_fn is not None:
+                progress_fn(num_completed / total_num_embs)
+        
+        cache_keys = {}
+        if cache is not None and filter_points is None:
+            if not isinstance(cache, SuggestionCache):
+                cache = SuggestionCache(cache)
+            for i, j in pairs:
+                key = cache.make_key(self.embeddings, i, j, self.thresholds)
+                cached = cache.load(key, i, j)
+                if cached is None:
+                    cache_keys[(i, j)] = key
+                    continue
+                complete((i, j), cached)
+                yield (i, j)
+        
+        # Group each pair with its reverse so they can share computation
+        pair_set = set(pair for pair in pairs if pair not in self.clusters)
+        work_items = []
+        for i, j in pairs:
+            if (i, j) not in pair_set:
+                continue
+            if (j, i) in pair_set:
+                if i < j: work_items.append(((i, j), (j, i)))
+            else:
+                work_items.append(((i, j),))
+        cluster_kwargs = {'filter_points': filter_points, 'thresholds': self.thresholds}
+        
+        def store_results(item_results):
+            for pair, clusters in item_results:
+                if pair in cache_keys:
+                    cache.save(cache_keys[pair], clusters)
+                complete(pair, clusters)
+        
+        if executor is None and (n_jobs == 1 or len(work_items) <= 1):
+            for item in work_items:
+                if cancel_token is not None: cancel_token.check()
+                store_results(self._make_clusters_for_pairs(item, cancel_token=cancel_token, **cluster_kwargs))
+                yield from item
+        else:
+            # Farm out frame pairs to the executor. Worker processes read the
+            # neighbor arrays from memory-mapped files rather than receiving
+            # a pickled copy of the embeddings.
+            own_executor = executor is None
+            input_dir = None
+            if own_executor or isinstance(executor, ProcessPoolExecutor):
+                input_dir = tempfile.mkdtemp(prefix="emblaze-")
+                _save_worker_inputs(self.embeddings, input_dir)
+            if own_executor:
+                executor = process_pool_executor(n_jobs,
+                                                 initializer=_init_cluster_worker,
+                                                 initargs=(input_dir,))
+            futures = []
+            try:
+                if own_executor:
+                    futures = [executor.submit(_make_clusters_worker, item, **cluster_kwargs)
+                               for item in work_items]
+                elif input_dir is not None:
+                    futures = [executor.submit(_init_and_make_clusters, input_dir, item, **cluster_kwargs)
+                               for item in work_items]
+                else:
+                    futures = [executor.submit(_make_clusters_in_executor, self, item, **cluster_kwargs)
+                               for item in work_items]
+                for future in as_completed(futures):
+                    if cancel_token is not None: cancel_token.check()
+                    item_results = future.result()
+                    store_results(item_results)
+                    yield from (pair for pair, _ in item_results)
+            finally:
+                # Don't wait for the remaining pairs if iteration was stopped
+                for future in futures:
+                    future.cancel()
+                if own_executor:
+                    if sys.version_info >= (3, 9):
+                        executor.shutdown(wait=False, cancel_futures=True)
+                    else:
+                        executor.shutdown(wait=False)
+                if input_dir is not None:
+                    shutil.rmtree(input_dir, ignore_errors=True)
+                    
+        # Store the results in the same order as the pairs were enumerated
+        for pair in all_pairs:
+            self.clusters[pair] = self.clusters.pop(pair)
+        self._pending = None
+        
+    def _get_cluster_index(self):
+        """
+        Returns an inverted index over the current clusters, rebuilding it if
+        the clusters have changed since it was last built.
+        """
+        signature = tuple((key, id(clusters), len(clusters)) for key, clusters in self.clusters.items())
+        if self._cluster_index is None or signature != self._cluster_index_signature:
+            self._cluster_index = _ClusterIndex(self.clusters)
+            self._cluster_index_signature = signature
+        return self._cluster_index
+        
+    def _jaccard_similarity_rows(self, neighbor_mat, rows=None):
+        """
+        Computes the jaccard similarity between the given rows of a one-hot
+        neighbor matrix (from `neighbor_csr`) and every row of the
+        matrix. Only pairs of rows that share at least one neighbor are stored
+        in the returned sparse matrix; the similarity of all other pairs is
+        zero. Similarities are rounded to float16 precision.
+        """
+        lengths = np.asarray(neighbor_mat.sum(axis=1)).flatten()
+        row_mat = neighbor_mat if rows is None else neighbor_mat[rows]
+        row_lengths = lengths if rows is None else lengths[rows]
+        # Calculate intersection of sets using a sparse dot product
+        intersection = (row_mat @ neighbor_mat.T).tocoo()
         
         # Use set trick: len(x | y) = len(x) + len(y) - len(x & y)
-        length_sums = lengths[:,np.newaxis] + lengths[np.newaxis,:]
-        union = np.maximum(length_sums - intersection, np.array([1], dtype=np.uint16), casting='no')
-        del length_sums
-        result = np.zeros((len(neighbors), len(neighbors)), dtype=np.float16)
-        np.true_divide(intersection.todense(), union, out=result)
-        return np.array([1.0], dtype=np.float16) - result
+        union = np.maximum(row_lengths[intersection.row] + lengths[intersection.col] - intersection.data, 1)
+        similarities = (intersection.data / union).astype(np.float16).astype(np.float32)
+        return csr_matrix((similarities, (intersection.row, intersection.col)),
+                          shape=(row_mat.shape[0], neighbor_mat.shape[0]))
 
-    def _make_neighbor_changes(self, idx_1, idx_2, filter_points=None):
+    def _pairwise_jaccard_similarities(self, neighbors):
+        """
+        Computes the jaccard similarity between each row of the given set of
+        neighbors (in any format accepted by `neighbor_csr`), as a
+        sparse matrix of the form returned by `_jaccard_similarity_rows`.
+        """
+        return self._jaccard_similarity_rows(neighbor_csr(neighbors))
+    
+    def _jaccard_distance_submatrix(self, similarities, indexes=None):
         """
-        Computes the sets of gained IDs and lost IDs for the given pair of frames.
+        Converts a sparse jaccard similarity matrix (from
+        `_pairwise_jaccard_similarities`) into a dense float16 distance matrix,
+        optionally restricted to the given row indexes.
         """
-        frame_1 = self.embeddings[idx_1]
-        frame_2 = self.embeddings[idx_2]
-        frame_1_neighbors = frame_1.get_recent_neighbors()[filter_points or None]
-        frame_2_neighbors = frame_2.get_recent_neighbors()[filter_points or None]
-        gained_ids = [set(frame_2_neighbors[i]) - set(frame_1_neighbors[i]) for i in range(len(filter_points or frame_1))]
-        lost_ids = [set(frame_1_neighbors[i]) - set(frame_2_neighbors[i]) for i in range(len(filter_points or frame_1))]
+        if indexes is not None:
+            similarities = similarities[indexes][:,indexes]
+        return np.array([1.0], dtype=np.float16) - similarities.toarray().astype(np.float16)
 
-        return gained_ids, lost_ids
+    def _make_neighbor_changes(self, idx_1, idx_2, filter_points=None):
+        """
+        Computes the gained IDs and lost IDs for each point between the given
+        pair of frames.
+        
+        Returns:
+            Two CSR-style tuples (indptr, indices), containing the neighbor IDs
+            gained and lost by each point respectively.
+        """
+        frame_1_neighbors = self.embeddings[idx_1].get_recent_neighbors()[filter_points or None]
+        frame_2_neighbors = self.embeddings[idx_2].get_recent_neighbors()[filter_points or None]
+        unique_ids, compact, id_space = compact_ids(np.concatenate([frame_1_neighbors.ravel(),
+                                                                     frame_2_neighbors.ravel()]))
+        gained_indptr, gained_indices, lost_indptr, lost_indices = _neighbor_differences(
+            compact[:frame_1_neighbors.size].reshape(frame_1_neighbors.shape),
+            compact[frame_1_neighbors.size:].reshape(frame_2_neighbors.shape),
+            id_space)
+        if unique_ids is not None:
+            gained_indices = unique_ids[gained_indices]
+            lost_indices = unique_ids[lost_indices]
+        return (gained_indptr, gained_indices), (lost_indptr, lost_indices)
+        
+    def _neighbor_change_similarities(self, idx_1, idx_2, filter_points=None):
+        """
+        Computes the gained and lost neighbors of each point between the given
+        pair of frames (as returned by `_make_neighbor_changes`), along with
+        the sparse pairwise jaccard similarities of each.
+        
+        When filter_points is provided, the results are cached for the frame
+        pair (and its reverse). The next time this is called for the same
+        frame pair with a different set of filter points, the neighbor changes
+        and similarities of the points that were already present are reused,
+        and only the rows and columns for newly added points are computed.
+        
+        Returns:
+            A tuple (gained_ids, lost_ids, gained_sim, lost_sim).
+        """
+        if idx_1 > idx_2:
+            # Gained and lost neighbors swap roles in the reverse direction
+            lost_ids, gained_ids, lost_sim, gained_sim = self._neighbor_change_similarities(idx_2, idx_1, filter_points)
+            return gained_ids, lost_ids, gained_sim, lost_sim
+        if filter_points is None:
+            gained_ids, lost_ids = self._make_neighbor_changes(idx_1, idx_2)
+            return (gained_ids, lost_ids,
+                    self._pairwise_jaccard_similarities(gained_ids),
+                    self._pairwise_jaccard_similarities(lost_ids))
+        
+        ids = np.asarray(filter_points)
+        previous = self._neighbor_change_cache.get((idx_1, idx_2))
+        if previous is not None:
+            positions = IDIndex(previous.ids).find(ids)
+        else:
+            positions = np.full(len(ids), -1)
+        added = np.flatnonzero(positions < 0)
+        retained = np.flatnonzero(positions >= 0)
+        if len(added):
+            new_changes = self._make_neighbor_changes(idx_1, idx_2, filter_points=ids[added].tolist())
+        else:
+            empty = (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=ids.dtype))
+            new_changes = (empty, empty)
+        
+        # Rows are taken from the previous results for retained points, and
+        # from the new results for added points
+        sources = positions.copy()
+        sources[added] = np.arange(len(added)) + (len(previous.ids) if previous is not None else 0)
+        old_changes = (previous.gained_ids, previous.lost_ids) if previous is not None else (None, None)
+        results = []
+        for old, new, old_sim in zip(old_changes, new_changes,
+                                     (previous.gained_sim, previous.lost_sim) if previous is not None else (None, None)):
+            changes = _take_csr_rows(*_stack_csr_rows(old, new), sources)
+            
+            # Similarities among retained points are reused, and similarities
+            # involving added points are computed for both rows and columns
+            neighbor_mat = neighbor_csr(changes)
+            added_sim = self._jaccard_similarity_rows(neighbor_mat, added).tocoo()
+            is_added = np.zeros(len(ids), dtype=bool)
+            is_added[added] = True
+            mirrored = ~is_added[added_sim.col]
+            row_parts = [added[added_sim.row], added_sim.col[mirrored]]
+            col_parts = [added_sim.col, added[added_sim.row[mirrored]]]
+            data_parts = [added_sim.data, added_sim.data[mirrored]]
+            if old_sim is not None and len(retained):
+                retained_sim = old_sim[positions[retained]][:,positions[retained]].tocoo()
+                row_parts.append(retained[retained_sim.row])
+                col_parts.append(retained[retained_sim.col])
+                data_parts.append(retained_sim.data)
+            similarities = csr_matrix((np.concatenate(data_parts),
+                                       (np.concatenate(row_parts), np.concatenate(col_parts))),
+                                      shape=(len(ids), len(ids)))
+            results.append((changes, similarities))
+        
+        (gained_ids, gained_sim), (lost_ids, lost_sim) = results
+        self._neighbor_change_cache[(idx_1, idx_2)] = _NeighborChanges(ids, gained_ids, lost_ids, gained_sim, lost_sim)
+        return gained_ids, lost_ids, gained_sim, lost_sim
+        
+    def _consistency_scores(self, neighbor_columns, num_columns, labels, sizes):
+        """
+        Computes the consistency of each cluster, i.e. the average jaccard
+        similarity between the neighbors of each pair of distinct points in
+        the cluster.
+        
+        Args:
+            neighbor_columns: Matrix of the neighbors of each point in the
+                base frame, mapped to integers less than num_columns (see
+                `compact_ids`).
+            num_columns: The number of distinct neighbor values.
+            labels: Array of the cluster index of each point, or -1 for
+                points that are not in a cluster.
+            sizes: Array of the number of points in each cluster.
+        """
+        members = np.flatnonzero(labels >= 0)
+        member_labels = labels[members]
+        
+        # Offset the neighbor columns of each cluster so that only pairs of
+        # points in the same cluster can intersect
+        columns = member_labels[:,np.newaxis].astype(np.int64) * num_columns + neighbor_columns[members]
+        neighbor_mat = neighbor_csr(columns)
+        lengths = np.asarray(neighbor_mat.sum(axis=1)).flatten()
+        intersection = (neighbor_mat @ neighbor_mat.T).tocoo()
+        union = lengths[intersection.row] + lengths[intersection.col] - intersection.data
+        totals = np.bincount(member_labels[intersection.row],
+                             weights=intersection.data / union,
+                             minlength=len(sizes))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (totals - sizes) / (sizes * (sizes - 1))
+        
+    def _inner_change_scores(self, positions_1, positions_2, labels, sizes):
+        """
+        Computes the mean inverse intersection of the neighbor sets of the
+        points in each cluster in two frames, counting only neighbors within
+        the cluster.
+        
+        Args:
+            positions_1: Matrix of the indexes of each point's neighbors in
+                the base frame among the points (-1 for other neighbors).
+            positions_2: The same matrix for the preview frame.
+            labels: Array of the cluster index of each point, or -1 for
+                points that are not in a cluster.
+            sizes: Array of the number of points in each cluster.
+        """
+        distances = _cluster_inverse_intersections(positions_1, positions_2, labels)
+        members = labels >= 0
+        return np.bincount(labels[members], weights=distances[members], minlength=len(sizes)) / sizes
         
-    def _consistency_score(self, ids, frame):
+    def _change_scores(self, indptr, positions, columns, num_columns, labels, sizes, num_neighbors=10):
         """
-        Computes the consistency between the neighbors for the given set of IDs 
-        in the given frame.
+        Computes a score estimating the consistency in the changes for each
+        cluster: the average fraction of the cluster's points that gained (or
+        lost) each of the cluster's most common changed neighbors outside the
+        cluster.
+        
+        Args:
+            indptr: CSR-style offsets of the changed neighbors of each point.
+            positions: Array of the index of each changed neighbor among the
+                points (-1 for neighbors that are not one of the points).
+            columns: Array of each changed neighbor ID mapped to an integer
+                less than num_columns (see `compact_ids`).
+            num_columns: The number of distinct changed neighbor values.
+            labels: Array of the cluster index of each point, or -1 for
+                points that are not in a cluster.
+            sizes: Array of the number of points in each cluster.
+            num_neighbors: The number of most common changed neighbors to
+                average over.
         """
-        return (np.sum(1 - self._pairwise_jaccard_distances(frame.get_recent_neighbors()[ids])) - len(ids)) / (len(ids) * (len(ids) - 1))
+        entry_labels = np.repeat(labels, np.diff(indptr))
+        neighbor_labels = np.where(positions >= 0, labels[positions], -1)
+        keep = (entry_labels >= 0) & (neighbor_labels != entry_labels)
+        entry_labels = entry_labels[keep].astype(np.int64)
         
-    def _inner_change_score(self, ids, frame_1, frame_2):
+        # Count the occurrences of each changed neighbor in each cluster, then
+        # rank the counts within each cluster
+        keys, counts = np.unique(entry_labels * num_columns + columns[keep], return_counts=True)
+        key_labels = keys // max(num_columns, 1)
+        order = np.lexsort((-counts, key_labels))
+        key_labels = key_labels[order]
+        counts = counts[order]
+        ranks = np.arange(len(key_labels)) - np.searchsorted(key_labels, key_labels)
+        top = ranks < num_neighbors
+        totals = np.bincount(key_labels[top], weights=counts[top], minlength=len(sizes))
+        num_top = np.bincount(key_labels[top], minlength=len(sizes))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return totals / (num_top * sizes)
+        
+    def _cluster_neighbor_changes(self, gained_sim, lost_sim, thresholds, cancel_token=None):
         """
-        Computes the inverse intersection of the neighbor sets in the given
-        two frames.
+        Clusters points by the average jaccard distance between their gained
+        and lost neighbor sets, using average linkage. The jaccard similarities
+        are given as sparse matrices from `_pairwise_jaccard_similarities`.
+        
+        The average-linkage tree is built once and cut at every threshold, so
+        adding thresholds is cheap. Two groups of points can only be merged below a threshold if at least
+        one pair of points between them is closer than that threshold, so the
+        points are first split into connected components of the sparse graph
+        of pairs below the largest threshold. Components of up to
+        `DENSE_CLUSTERING_LIMIT` points (those whose dense distance matrix fits
+        within `DENSE_CLUSTERING_MEMORY`) are clustered exactly using their
+        dense distance matrix. Larger components are clustered approximately,
+        with a sparse average-linkage algorithm that treats pairs at or above
+        the largest threshold as having a distance of 1.
+        
+        If a `utils.CancellationToken` is given, it is checked before each
+        connected component is clustered.
+        
+        Returns:
+            A list of cluster label arrays, one for each threshold.
         """
-        return np.mean(inverse_intersection(frame_1.get_recent_neighbors()[ids],
-                                            frame_2.get_recent_neighbors()[ids],
-                                            List(ids),
-                                            False))
+        # Keep pairs whose combined distance falls below the largest threshold
+        # (with a margin for float16 rounding)
+        close_pairs = gained_sim + lost_sim
+        close_pairs.data = (close_pairs.data > 2 * (1 - np.max(thresholds)) - 1e-2).astype(np.int8)
+        close_pairs.eliminate_zeros()
+        num_components, component_labels = connected_components(close_pairs, directed=False)
+        
+        all_labels = [np.zeros(gained_sim.shape[0], dtype=int) for _ in thresholds]
+        next_labels = [0 for _ in thresholds]
+        component_order = np.argsort(component_labels, kind='stable')
+        component_bounds = np.cumsum(np.bincount(component_labels, minlength=num_components))
+        for members in np.split(component_order, component_bounds[:-1]):
+            if len(members) == 1:
+                for labels, i in zip(all_labels, range(len(thresholds))):
+                    labels[members] = next_labels[i]
+                    next_labels[i] += 1
+                continue
+            if cancel_token is not None: cancel_token.check()
+            if len(members) > DENSE_CLUSTERING_LIMIT:
+                similarities = (gained_sim[members][:,members] + lost_sim[members][:,members]) / 2
+                similarities.setdiag(0)
+                similarities.data[similarities.data <= 1 - np.max(thresholds)] = 0
+                similarities.eliminate_zeros()
+                merges = _sparse_average_linkage(similarities.indptr, similarities.indices,
+                                                 similarities.data.astype(np.float64), np.max(thresholds))
+                for i, threshold in enumerate(thresholds):
+                    labels = _cut_merges(len(members), *merges, threshold)
+                    all_labels[i][members] = labels + next_labels[i]
+                    next_labels[i] += labels.max() + 1
+                continue
+                
+            distances = (self._jaccard_distance_submatrix(gained_sim, members) +
+                         self._jaccard_distance_submatrix(lost_sim, members)) / 2
+            tree = linkage(squareform(distances, checks=False), method='average')
+            for i, threshold in enumerate(thresholds):
+                # Clusters are merged only strictly below the threshold
+                labels = fcluster(tree, np.nextafter(threshold, -np.inf), criterion='distance') - 1
+                all_labels[i][members] = labels + next_labels[i]
+                next_labels[i] += labels.max() + 1
+        return all_labels
         
-    def _change_score(self, change_set, ids, num_neighbors=10):
+    def _make_clusters_for_pairs(self, pairs, filter_points=None, thresholds=DEFAULT_CLUSTER_THRESHOLDS, cancel_token=None):
         """
-        Computes a score estimating the consistency in the changes for the given
-        set of IDs
+        Produces clusters for either a single frame pair or a frame pair and its
+        reverse, given as a tuple of one or two (frame, preview frame) tuples.
+        
+        Returns:
+            A list of tuples (pair, clusters).
         """
-        counter = collections.Counter([x for s in change_set for x in s if x not in ids])
-        return np.mean([x[1] / len(ids) for x in sorted(counter.items(), key=lambda x: x[1], reverse=True)[:num_neighbors]])
+        idx_1, idx_2 = pairs[0]
+        if len(pairs) == 1:
+            return [(pairs[0], self._make_clusters(idx_1, idx_2, np.log10(len(self.embeddings[idx_1])),
+                                                   filter_points=filter_points, thresholds=thresholds,
+                                                   cancel_token=cancel_token))]
+        assert pairs[1] == (idx_2, idx_1), "Second pair must be the reverse of the first"
+        forward, backward = self._make_clusters(idx_1, idx_2, np.log10(len(self.embeddings[idx_1])),
+                                                filter_points=filter_points, thresholds=thresholds,
+                                                reverse_min_cluster_size=np.log10(len(self.embeddings[idx_2])),
+                                                cancel_token=cancel_token)
+        return [(pairs[0], forward), (pairs[1], backward)]
         
-    def _make_clusters(self, idx_1, idx_2, min_cluster_size=1, filter_points=None):
+    def _describe_clusters(self, idx_1, idx_2, all_labels, all_ids, gained_ids, lost_ids, min_cluster_size, inner_changes=None):
         """
-        Produces clusters based on the pairwise distances between the given pair of frames.
+        Builds the cluster descriptions for the given frame pair from the cluster
+        labels at each threshold. If inner_changes is provided, it should be a
+        list of inner change scores for each cluster in the order they are
+        produced (the score is symmetric in the two frames). Returns the list
+        of clusters and the list of inner change scores.
         """
-        filter_points = list(filter_points) if filter_points is not None else None
-        all_ids = np.array(filter_points) if filter_points is not None else self.embeddings[idx_1].ids
+        # Resolve neighbor IDs once so they can be reused at every threshold
+        id_index = IDIndex(all_ids)
+        neighbors_1 = self.embeddings[idx_1].get_recent_neighbors()[all_ids]
+        _, neighbor_columns, num_neighbor_columns = compact_ids(neighbors_1)
+        if inner_changes is None:
+            positions_1 = id_index.find(neighbors_1)
+            positions_2 = id_index.find(self.embeddings[idx_2].get_recent_neighbors()[all_ids])
+        changes = []
+        for indptr, values in (gained_ids, lost_ids):
+            _, columns, num_columns = compact_ids(values)
+            changes.append((indptr, id_index.find(values), columns, num_columns))
         
-        gained_ids, lost_ids = self._make_neighbor_changes(idx_1, idx_2, filter_points=filter_points)
-        distances = (self._pairwise_jaccard_distances(gained_ids) + self._pairwise_jaccard_distances(lost_ids)) / 2
         clusters = []
-        
-        for threshold in np.arange(0.7, 0.91, 0.1):
-            clusterer = AgglomerativeClustering(n_clusters=None,
-                                                distance_threshold=threshold,
-                                                metric='precomputed',
-                                                linkage='average')
-            clusterer.fit(distances)
-            cluster_labels = clusterer.labels_
+        computed_inner_changes = []
+        for cluster_labels in all_labels:
+            _, inverse, counts = np.unique(cluster_labels, return_inverse=True, return_counts=True)
+            inverse = inverse.flatten()
+            # Number the clusters that are large enough consecutively, and
+            # leave out the remaining points
+            kept = counts >= min_cluster_size
+            labels = np.where(kept[inverse], (np.cumsum(kept) - 1)[inverse], -1)
+            sizes = counts[kept]
+            if len(sizes) == 0: continue
             
-            for label, count in zip(*np.unique(cluster_labels, return_counts=True)):
-                if count < min_cluster_size: continue
-                indexes = np.arange(len(cluster_labels))[cluster_labels == label]
-                ids = all_ids[cluster_labels == label].tolist()
-
+            consistencies = self._consistency_scores(neighbor_columns, num_neighbor_columns, labels, sizes)
+            if inner_changes is not None:
+                scores = inner_changes[len(computed_inner_changes):len(computed_inner_changes) + len(sizes)]
+            else:
+                scores = self._inner_change_scores(positions_1, positions_2, labels, sizes)
+            computed_inner_changes.extend(scores)
+            gains = self._change_scores(*changes[0], labels, sizes)
+            losses = self._change_scores(*changes[1], labels, sizes)
+            
+            members = np.flatnonzero(labels >= 0)
+            members = members[np.argsort(labels[members], kind='stable')]
+            member_ids = np.split(all_ids[members], np.cumsum(sizes)[:-1])
+            for i, ids in enumerate(member_ids):
                 clusters.append({
-                    'ids': set(ids),
+                    'ids': set(ids.tolist()),
                     'frame': idx_1,
                     'previewFrame': idx_2,
-                    'consistency': self._consistency_score(ids, self.embeddings[idx_1]), 
-                    'innerChange': self._inner_change_score(ids, self.embeddings[idx_1], self.embeddings[idx_2]),
-                    'gain': self._change_score([gained_ids[i] for i in indexes], ids), 
-                    'loss': self._change_score([lost_ids[i] for i in indexes], ids)
+                    'consistency': consistencies[i],
+                    'innerChange': scores[i],
+                    'gain': gains[i],
+                    'loss': losses[i]
                 })
-        return clusters
+        return clusters, computed_inner_changes
+    
+    def _make_clusters(self, idx_1, idx_2, min_cluster_size=1, filter_points=None, thresholds=DEFAULT_CLUSTER_THRESHOLDS, reverse_min_cluster_size=None, cancel_token=None):
+        """
+        Produces clusters based on the pairwise distances between the given pair
+        of frames, at each of the given distance thresholds.
+        
+        If reverse_min_cluster_size is provided, also produces clusters for the
+        reverse pair (idx_2, idx_1) from the same clustering, and returns a
+        tuple of the two cluster lists. If a `utils.CancellationToken` is
+        given, it is checked between each step.
+        """
+        filter_points = list(filter_points) if filter_points is not None else None
+        all_ids = np.array(filter_points) if filter_points is not None else self.embeddings[idx_1].ids
+        
+        gained_ids, lost_ids, gained_sim, lost_sim = self._neighbor_change_similarities(idx_1, idx_2, filter_points=filter_points)
+        if cancel_token is not None: cancel_token.check()
+        all_labels = self._cluster_neighbor_changes(gained_sim, lost_sim, thresholds, cancel_token=cancel_token)
+        if cancel_token is not None: cancel_token.check()
+        clusters, inner_changes = self._describe_clusters(idx_1, idx_2, all_labels, all_ids,
+                                                          gained_ids, lost_ids, min_cluster_size)
+        if reverse_min_cluster_size is None:
+            return clusters
+        
+        # Gained and lost neighbors swap roles in the reverse direction
+        if cancel_token is not None: cancel_token.check()
+        reverse_clusters, _ = self._describe_clusters(idx_2, idx_1, all_labels, all_ids,
+                                                      lost_ids, gained_ids, reverse_min_cluster_size,
+                                                      inner_changes=inner_changes if reverse_min_cluster_size == min_cluster_size else None)
+        return clusters, reverse_clusters
     
     def query(self, ids_of_interest=None, filter_ids=None, frame_idx=None, preview_frame_idx=None, bounding_box=None, num_results=10, id_type="selection"):
         """
@@ -179,67 +1198,105 @@ class SelectionRecommender:
         else:
             frames_to_check = [(i, j) for i in range(len(self.embeddings)) for j in range(len(self.embeddings)) if i != j]
             
-        interest_set = set(ids_of_interest) if ids_of_interest is not None else None
-        filter_set = set(filter_ids) if filter_ids is not None else None
-        
-        candidates = []
-        for frame_key in frames_to_check:
-            base_frame = self.embeddings[frame_key[0]]
-            if bounding_box is not None:
-                positions = base_frame.field(Field.POSITION)
-            else:
-                positions = None
-                
-            # Assemble a list of candidates
-            if ids_of_interest is not None:
-                neighbor_ids = set([n for n in self.embeddings[frame_key[0]].get_recent_neighbors()[ids_of_interest][:,:NUM_NEIGHBORS_FOR_SEARCH].flatten()])
+        index = self._get_cluster_index()
+        # Candidates are ranked by the order of frames_to_check, so that ties
+        # are broken in a consistent order
+        key_ranks = np.array([frames_to_check.index(key) if key in frames_to_check else -1
+                              for key in index.frame_keys], dtype=np.int64)
+        cluster_ranks = key_ranks[index.key_indexes] if len(index) else np.zeros(0, dtype=np.int64)
+        is_candidate = cluster_ranks >= 0
+        scores = index.base_scores.copy()
+        
+        if filter_ids is not None:
+            filter_counts = index.overlap_counts(filter_ids)
+            is_candidate &= filter_counts > 0
+            scores *= filter_counts / np.maximum(index.sizes, 1)
+            
+        # Each cluster is scored by the first of these criteria that it matches
+        reason_types = np.full(len(index), -1)
+        reason_counts = np.zeros(len(index), dtype=np.int64)
+        unmatched = is_candidate.copy()
+        if ids_of_interest is not None:
+            interest_counts = index.overlap_counts(ids_of_interest)
+            matches = unmatched & (interest_counts > 0)
+            scores[matches] = scores[matches] * interest_counts[matches] / index.sizes[matches]
+            reason_types[matches] = 0
+            reason_counts[matches] = interest_counts[matches]
+            unmatched &= ~matches
+            
+            # Look for clusters containing neighbors of the IDs of interest in
+            # each base frame
+            neighbor_counts = np.zeros(len(index), dtype=np.int64)
+            for base_frame_idx in np.unique(index.base_frames[unmatched]):
+                neighbor_ids = np.unique(self.embeddings[base_frame_idx].get_recent_neighbors()[ids_of_interest][:,:NUM_NEIGHBORS_FOR_SEARCH].flatten())
+                in_frame = index.base_frames == base_frame_idx
+                neighbor_counts[in_frame] = index.overlap_counts(neighbor_ids)[in_frame]
+            matches = unmatched & (neighbor_counts > 0)
+            scores[matches] = scores[matches] * 0.5 * neighbor_counts[matches] / index.sizes[matches]
+            reason_types[matches] = 1
+            reason_counts[matches] = neighbor_counts[matches]
+            unmatched &= ~matches
+            
+        if bounding_box is not None:
+            within_counts = np.zeros(len(index), dtype=np.int64)
+            for base_frame_idx in np.unique(index.base_frames[unmatched]):
+                base_frame = self.embeddings[base_frame_idx]
+                in_box = base_frame.spatial_index().query(bounding_box)
+                in_frame = index.base_frames == base_frame_idx
+                within_counts[in_frame] = index.overlap_counts(base_frame.ids[in_box])[in_frame]
+            matches = unmatched & (within_counts > 0)
+            scores[matches] = scores[matches] * np.log(within_counts[matches])
+            reason_types[matches] = 2
+            unmatched &= ~matches
+        elif ids_of_interest is None:
+            reason_types[unmatched] = 3
+            
+        candidates = np.flatnonzero(reason_types >= 0)
+        
+        def frame_labels(cluster):
+            return "{} &rarr; {}".format(self.embeddings[cluster['frame']].label or "Frame " + str(cluster['frame']),
+                                         self.embeddings[cluster['previewFrame']].label or "Frame " + str(cluster['previewFrame']))
+        def make_reason(candidate):
+            cluster = index.clusters[candidate]
+            if reason_types[candidate] == 0:
+                return "shares {} points with {} ({})".format(reason_counts[candidate], id_type, frame_labels(cluster))
+            elif reason_types[candidate] == 1:
+                return "shares {} points with neighbors of {} ({})".format(reason_counts[candidate], id_type, frame_labels(cluster))
+            elif reason_types[candidate] == 2:
+                return frame_labels(cluster)
+            if frame_idx is not None and preview_frame_idx is not None:
+                reason = "matches frames "
+            elif preview_frame_idx is not None:
+                reason = "matches preview frame "
             else:
-                neighbor_ids = None    
-
-            for cluster in self.clusters[frame_key]:
-                frame_labels = "{} &rarr; {}".format(self.embeddings[cluster['frame']].label or "Frame " + str(cluster['frame']),
-                                                     self.embeddings[cluster['previewFrame']].label or "Frame " + str(cluster['previewFrame']))
-                base_score = (cluster['consistency'] + cluster['innerChange'] + cluster['gain'] + cluster['loss']) * np.log(len(cluster['ids']))
-                if filter_set is not None:
-                    if not cluster['ids'] & filter_set:
-                        continue
-                    base_score *= len(cluster['ids'] & filter_set) / len(cluster['ids'])
-                
-                if interest_set is not None and cluster['ids'] & interest_set:
-                    candidates.append((cluster, 
-                                       base_score * len(cluster['ids'] & interest_set) / len(cluster['ids']),
-                                       "shares {} points with {} ({})".format(len(cluster['ids'] & interest_set), id_type, frame_labels)))
-                elif neighbor_ids is not None and cluster['ids'] & neighbor_ids:
-                    candidates.append((cluster,
-                                       base_score * 0.5 * len(cluster['ids'] & neighbor_ids) / len(cluster['ids']),
-                                      "shares {} points with neighbors of {} ({})".format(len(cluster['ids'] & neighbor_ids), id_type, frame_labels)))
-                elif bounding_box is not None:
-                    point_positions = positions[base_frame.index(np.array(list(cluster['ids'])))]
-                    num_within = np.sum((point_positions[:,0] >= bounding_box[0]) *
-                              (point_positions[:,0] <= bounding_box[1]) *
-                              (point_positions[:,1] >= bounding_box[2]) *
-                              (point_positions[:,1] <= bounding_box[3]))
-                    if num_within > 0:
-                        candidates.append((cluster, base_score * np.log(num_within), frame_labels))
-                elif ids_of_interest is None:
-                    if frame_idx is not None and preview_frame_idx is not None:
-                        reason = "matches frames "
-                    elif preview_frame_idx is not None:
-                        reason = "matches preview frame "
-                    else:
-                        reason = ""
-                    candidates.append((cluster,
-                                       base_score,
-                                       "{}{}".format(reason, ("(" + frame_labels + ")") if reason else frame_labels)))
+                reason = ""
+            return "{}{}".format(reason, ("(" + frame_labels(cluster) + ")") if reason else frame_labels(cluster))
         
-        # Sort candidates and make sure they don't include overlapping IDs
+        # Walk the candidates in order of decreasing score and make sure they
+        # don't include overlapping IDs. Only the top candidates are sorted,
+        # widening the pool if overlaps exhaust it.
         seen_ids = set()
         results = []
-        for cluster, _, reason in sorted(candidates, key=lambda x: x[1], reverse=True):
-            if cluster['ids'] & seen_ids: continue
-            results.append((cluster, reason))
-            seen_ids |= cluster['ids']
-            if len(results) >= num_results: break
+        # Clusters with undefined scores (e.g. from tiny inputs) rank last
+        scores[~np.isfinite(scores)] = -np.inf
+        pool_size = 4 * num_results + 16
+        num_visited = 0
+        while len(results) < num_results and num_visited < len(candidates):
+            pool_size = min(pool_size, len(candidates))
+            candidate_scores = scores[candidates]
+            # Include every candidate tied with the lowest score in the pool
+            cutoff = np.partition(candidate_scores, len(candidates) - pool_size)[len(candidates) - pool_size]
+            pool = candidates[candidate_scores >= cutoff]
+            pool = pool[np.lexsort((index.local_indexes[pool], cluster_ranks[pool], -scores[pool]))]
+            for candidate in pool[num_visited:]:
+                num_visited += 1
+                cluster = index.clusters[candidate]
+                if cluster['ids'] & seen_ids: continue
+                results.append((cluster, make_reason(candidate)))
+                seen_ids |= cluster['ids']
+                if len(results) >= num_results: break
+            if pool_size == len(candidates): break
+            pool_size *= 2
                 
         return results
     
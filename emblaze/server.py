@@ -56,6 +56,7 @@ def connect():
     if request.sid not in user_data:
         widget = Viewer(file=_get_all_datasets()[0],
                         thread_starter=socketio_thread_starter,
+                        binaryTransport=False,
                         allowsSavingSelections=not disable_save_selections)
         user_data[request.sid] = { "widget": widget, "dt": datetime.datetime.now(), "locks": {} }
     else:
@@ -21,9 +21,12 @@ class Thumbnails:
     def __init__(self, thumbnail_format):
         self.format = thumbnail_format
 
-    def to_json(self):
+    def to_json(self, binary=False):
         """
-        Converts this set of thumbnails into a JSON object.
+        Converts this set of thumbnails into a JSON object. If binary is True,
+        spritesheet images are stored as binary buffers for sending to the
+        widget frontend instead of base64 strings, so the result is not
+        JSON-serializable.
         """
         return {
             "format": self.format
@@ -118,8 +121,8 @@ class TextThumbnails(Thumbnails):
         """
         return self.data.field(Field.DESCRIPTION, ids=ids)
         
-    def to_json(self):
-        result = super().to_json()
+    def to_json(self, binary=False):
+        result = super().to_json(binary=binary)
         names = self.data.field(Field.NAME)
         descriptions = self.data.field(Field.DESCRIPTION)
         def _make_json_item(i, id_val):
@@ -275,8 +278,8 @@ class ImageThumbnails(Thumbnails):
     def get_spritesheets(self):
         return self.spritesheets
     
-    def to_json(self):
-        result = super().to_json()
+    def to_json(self, binary=False):
+        result = super().to_json(binary=binary)
         result["spritesheets"] = self.spritesheets
         if self.text_data is not None:
             names = self.text_data.field(Field.NAME)
@@ -290,7 +293,13 @@ class ImageThumbnails(Thumbnails):
                 } for i, id_val in enumerate(self.text_data.ids) if names[i] or descriptions[i]
             }
 
-        return standardize_json(result)
+        result = standardize_json(result)
+        if binary:
+            result["spritesheets"] = {
+                name: {**sheet, "image": memoryview(base64.b64decode(sheet["image"]))}
+                for name, sheet in result["spritesheets"].items()
+            }
+        return result
     
     @classmethod
     def from_json(cls, data, ids=None):
@@ -554,11 +563,11 @@ class CombinedThumbnails(Thumbnails):
     def get_spritesheets(self):
         return self.image_thumbnails.spritesheets if self.image_thumbnails else None
     
-    def to_json(self):
-        result = super().to_json()
+    def to_json(self, binary=False):
+        result = super().to_json(binary=binary)
         
         if self.image_thumbnails is not None:
-            result["spritesheets"] = self.image_thumbnails.to_json()["spritesheets"]
+            result["spritesheets"] = self.image_thumbnails.to_json(binary=binary)["spritesheets"]
         if self.text_thumbnails is not None:
             result["items"] = self.text_thumbnails.to_json()["items"]
             
@@ -1,12 +1,67 @@
 import sys
 import numpy as np
 from affine import Affine
-from numba import jit
+from numba import jit, prange, get_num_threads
 import json
 import datetime
 import platform
 import os
 import base64
+import hashlib
+import threading
+import traceback
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def _launch_numba_threads():
+    """
+    Starts numba's threading layer if called from the main thread (it is a
+    no-op once the threading layer is running). Parallel kernels are usually
+    launched from background threads, and some threading layers (notably TBB)
+    hang at interpreter exit if they are first started from a thread other
+    than the main thread, so this is called before starting background work.
+    """
+    if threading.current_thread() is threading.main_thread():
+        # Querying the number of threads launches the threading layer
+        get_num_threads()
+
+def process_pool_executor(n_jobs, initializer=None, initargs=()):
+    """
+    Creates a `ProcessPoolExecutor` whose workers are not forked from the
+    current process. Forking after numba's (or scikit-learn's) OpenMP or TBB
+    thread pools have started can crash or hang the workers, so they are
+    started with the 'forkserver' method where available and 'spawn'
+    otherwise. The initializer arguments are therefore pickled once per worker,
+    and scripts that create a pool must guard their entry point with
+    `if __name__ == "__main__":`.
+    
+    Args:
+        n_jobs: Number of worker processes, or -1 (or None) to use all
+            processors.
+        initializer: Optional function to call in each worker on startup.
+        initargs: Arguments to pass to the initializer.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=n_jobs if n_jobs is not None and n_jobs > 0 else None,
+                               mp_context=multiprocessing.get_context(method),
+                               initializer=initializer,
+                               initargs=initargs)
+
+def array_fingerprint(*values):
+    """
+    Returns a hexadecimal SHA-1 digest of the contents, dtypes and shapes of
+    the given arrays (or values that can be converted to arrays). Object
+    arrays are hashed by their string representations.
+    """
+    hasher = hashlib.sha1()
+    for value in values:
+        array = np.asarray(value)
+        if array.dtype == object:
+            array = array.astype(str)
+        hasher.update("{}{}".format(array.dtype.str, array.shape).encode('utf-8'))
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()
 
 class Field:
     """Standardized field names for embeddings and projections. These data can
@@ -27,6 +82,11 @@ class ProjectionTechnique:
     ALIGNED_UMAP = "aligned-umap"
     PCA = "pca"
     
+class NeighborAlgorithm:
+    """Names of algorithms used to compute nearest neighbor sets."""
+    EXACT = "exact"
+    NN_DESCENT = "nndescent"
+    
 class DataType:
     """Types of data, e.g. categorical vs continuous."""
     CATEGORICAL = "categorical"
@@ -90,31 +150,402 @@ def standardize_json(o, round_digits=4):
     if isinstance(o, (list, tuple)): return [standardize_json(x, round_digits) for x in o]
     return o
 
-@jit(nopython=True)
+def compact_ids(values):
+    """
+    Maps an array of IDs to non-negative integers that can be used as
+    indexes, so that arrays indexed by ID scale with the number of distinct
+    IDs rather than the largest ID. Returns the array of original ID values
+    corresponding to each compact value (or `None` if the IDs are already
+    suitable as indexes), the compact array, and the number of compact values.
+    """
+    values = np.asarray(values)
+    if (np.issubdtype(values.dtype, np.integer) and values.size and
+        values.min() >= 0 and values.max() < 2 * values.size):
+        return None, values, int(values.max()) + 1
+    unique_ids, compact = np.unique(values, return_inverse=True)
+    return unique_ids, compact.reshape(values.shape), len(unique_ids)
+
+def id_mask(mask_ids, size=None):
+    """
+    Builds a boolean mask over ID space, in which the entries at the given
+    (non-negative integer) IDs are True. This can be precomputed and passed to
+    `inverse_intersection` in place of a list of IDs. Since the mask is as long
+    as the largest ID, it is only suitable for IDs that are roughly contiguous
+    (otherwise, use `compact_ids` first or pass the IDs directly).
+    
+    Args:
+        mask_ids: Iterable of integer IDs to mark.
+        size: Length of the mask. If None, one more than the largest ID is used.
+    """
+    mask_ids = np.fromiter(mask_ids, dtype=np.int64) if not isinstance(mask_ids, np.ndarray) else mask_ids.astype(np.int64)
+    if size is None:
+        size = int(mask_ids.max()) + 1 if len(mask_ids) else 0
+    mask = np.zeros(size, dtype=np.bool_)
+    mask[mask_ids] = True
+    return mask
+
+@jit(nopython=True, parallel=True, cache=True)
+def _inverse_intersection_kernel(seqs1, seqs2, mask, outer, id_space, num_blocks):
+    """
+    Computes the inverse intersection size of corresponding rows of two
+    non-negative integer matrices, counting only the entries x for which
+    `(x < len(mask) and mask[x]) != outer`. Rows are split into blocks that
+    are processed in parallel. Each block marks the entries of each row in a
+    scratch array over ID space, so no sets are allocated.
+    """
+    num_rows = seqs1.shape[0]
+    distances = np.zeros(num_rows)
+    block_size = (num_rows + num_blocks - 1) // num_blocks
+    for block in prange(num_blocks):
+        stamps = np.zeros(id_space, dtype=np.int64)
+        for i in range(block * block_size, min(num_rows, (block + 1) * block_size)):
+            # Stamps increase with each row, so the scratch array never needs
+            # to be cleared
+            seen = 2 * i + 2
+            counted = 2 * i + 3
+            nonempty = False
+            num_intersection = 0
+            for x in seqs1[i]:
+                if (x < len(mask) and mask[x]) != outer:
+                    stamps[x] = seen
+                    nonempty = True
+            for x in seqs2[i]:
+                if (x < len(mask) and mask[x]) != outer:
+                    nonempty = True
+                    if stamps[x] == seen:
+                        num_intersection += 1
+                        stamps[x] = counted
+            if nonempty:
+                distances[i] = 1 / (1 + num_intersection)
+    return distances
+
 def inverse_intersection(seqs1, seqs2, mask_ids, outer):
     """
     Computes the inverse intersection size of the two lists of sets.
     
     Args:
-        seqs1: A list of iterables
-        seqs2: Another list of iterables - must be the same length as seqs1
-        mask_ids: Iterable containing objects that should be EXCLUDED if outer
-            is True, and INCLUDED if outer is False
+        seqs1: An n x k matrix of integer IDs (e.g. neighbor IDs)
+        seqs2: Another matrix of integer IDs with the same number of rows as seqs1
+        mask_ids: Iterable containing IDs that should be EXCLUDED if outer
+            is True, and INCLUDED if outer is False. This can also be a
+            boolean mask over ID space generated using `id_mask`, which avoids
+            rebuilding the mask when it is reused across calls (in this case
+            all IDs must be non-negative).
         outer: Determines the behavior of mask_ids
         
     Returns:
         A numpy array of inverse intersection sizes between each element in
         seqs1 and seqs2.
     """
-    distances = np.zeros(len(seqs1))
-    mask_ids = set(mask_ids)
-    for i in range(len(seqs1)):
-        set1 = set([n for n in seqs1[i] if (n in mask_ids) != outer])
-        set2 = set([n for n in seqs2[i] if (n in mask_ids) != outer])
-        num_intersection = len(set1 & set2)
-        if len(set1) or len(set2):
-            distances[i] = 1 / (1 + num_intersection)
-    return distances
+    seqs1 = np.ascontiguousarray(seqs1)
+    seqs2 = np.ascontiguousarray(seqs2)
+    if len(seqs1) == 0:
+        return np.zeros(0)
+    # Compact the IDs so that the scratch arrays scale with the number of
+    # distinct IDs rather than the largest ID
+    if isinstance(mask_ids, np.ndarray) and mask_ids.dtype == np.bool_:
+        unique_ids, compact, id_space = compact_ids(np.concatenate([seqs1.ravel(), seqs2.ravel()]))
+        mask = mask_ids
+        if unique_ids is not None:
+            in_range = (unique_ids >= 0) & (unique_ids < len(mask))
+            mask = in_range & mask[np.where(in_range, unique_ids, 0)]
+    else:
+        mask_ids = np.fromiter(mask_ids, dtype=np.int64)
+        _, compact, id_space = compact_ids(np.concatenate([seqs1.ravel(), seqs2.ravel(), mask_ids]))
+        mask = id_mask(compact[seqs1.size + seqs2.size:], size=id_space)
+    seqs1 = compact[:seqs1.size].reshape(seqs1.shape)
+    seqs2 = compact[seqs1.size:seqs1.size + seqs2.size].reshape(seqs2.shape)
+    num_blocks = max(1, min(len(seqs1), get_num_threads()))
+    return _inverse_intersection_kernel(seqs1, seqs2, mask, outer, id_space, num_blocks)
+
+class IDIndex:
+    """
+    Maps ID values to the row indexes at which they are stored. When the IDs
+    are contiguous integers (such as `np.arange(n)`), indexes are computed
+    directly from an offset; otherwise, lookups use binary search over a
+    sorted copy of the IDs. Sequences of IDs are resolved in a single
+    vectorized operation, while single IDs use a dictionary that is built
+    the first time one is looked up.
+    """
+    def __init__(self, ids):
+        super().__init__()
+        ids = np.asarray(ids)
+        self.length = len(ids)
+        self._integer_ids = np.issubdtype(ids.dtype, np.integer)
+        self.is_contiguous = (self._integer_ids and
+                              (len(ids) == 0 or
+                               np.array_equal(ids, np.arange(len(ids)) + ids[0])))
+        self.offset = int(ids[0]) if self.is_contiguous and len(ids) else 0
+        self.is_identity = self.is_contiguous and self.offset == 0
+        self._scalar_index = None
+        if self.is_contiguous:
+            self._order = None
+            self._sorted_ids = None
+        else:
+            self._order = np.argsort(ids, kind='stable')
+            self._sorted_ids = ids[self._order]
+
+    def _normalize(self, id_vals):
+        """Converts the given IDs to an array that can be compared against the
+        stored IDs. Raises a `ValueError` if the stored IDs are integers and
+        any of the given IDs are non-integral numbers."""
+        if isinstance(id_vals, set):
+            id_vals = list(id_vals)
+        id_vals = np.asarray(id_vals)
+        if id_vals.dtype.kind in 'fb' and (self.is_contiguous or self._sorted_ids.dtype.kind in 'iu'):
+            if id_vals.dtype.kind == 'f' and not np.all(np.mod(id_vals, 1) == 0):
+                raise ValueError("Cannot look up non-integral IDs in an index of integer IDs")
+            id_vals = id_vals.astype(np.int64)
+        return id_vals
+    
+    def _positions(self, id_vals):
+        """Returns the row indexes for the given normalized array of IDs, and
+        a boolean mask indicating which IDs were found."""
+        if self.is_contiguous:
+            positions = id_vals - self.offset if self.offset else id_vals
+            found = (positions >= 0) & (positions < self.length)
+            return np.where(found, positions, 0).astype(np.intp), found
+        if self.length == 0:
+            return np.zeros(id_vals.shape, dtype=np.intp), np.zeros(id_vals.shape, dtype=bool)
+        sorted_positions = np.minimum(np.searchsorted(self._sorted_ids, id_vals), self.length - 1)
+        found = self._sorted_ids[sorted_positions] == id_vals
+        return self._order[sorted_positions], found
+    
+    def _scalar_position(self, id_val):
+        """Returns the row index of a single integer ID, or -1 if it is not
+        present, without converting it to an array."""
+        if self.is_contiguous:
+            position = int(id_val) - self.offset
+            return position if 0 <= position < self.length else -1
+        if self._scalar_index is None:
+            # Iterate in reverse so that duplicate IDs map to their first row,
+            # as in the vectorized lookup
+            self._scalar_index = dict(zip(self._sorted_ids[::-1].tolist(), self._order[::-1].tolist()))
+        return self._scalar_index.get(int(id_val), -1)
+        
+    def lookup(self, id_vals):
+        """
+        Returns an array of row indexes for the given sequence of IDs, or a
+        single integer index if a scalar ID is given. Raises a `KeyError` if
+        any of the IDs are not present.
+        """
+        if isinstance(id_vals, (int, np.integer)) and not isinstance(id_vals, bool) and self._integer_ids:
+            position = self._scalar_position(id_vals)
+            if position < 0:
+                raise KeyError("IDs not found: {}".format(id_vals))
+            return position
+        scalar = not isinstance(id_vals, (list, tuple, np.ndarray, set))
+        id_vals = self._normalize(id_vals)
+        positions, found = self._positions(id_vals)
+        if not np.all(found):
+            missing = np.atleast_1d(id_vals)[~np.atleast_1d(found)]
+            raise KeyError("IDs not found: {}{}".format(", ".join(str(x) for x in missing[:10]),
+                                                         "..." if len(missing) > 10 else ""))
+        return int(positions) if scalar else positions
+
+    def find(self, id_vals):
+        """
+        Returns an array of row indexes for the given sequence of IDs, in
+        which IDs that are not present are given an index of -1.
+        """
+        positions, found = self._positions(self._normalize(id_vals))
+        return np.where(found, positions, -1)
+
+    def __contains__(self, id_val):
+        if isinstance(id_val, (int, np.integer)) and not isinstance(id_val, bool) and self._integer_ids:
+            return self._scalar_position(id_val) >= 0
+        try:
+            return bool(np.all(self._positions(self._normalize(id_val))[1]))
+        except (TypeError, ValueError):
+            return False
+    
+    def __len__(self):
+        return self.length
+
+class SpatialIndex:
+    """
+    A uniform grid over the first two coordinates of a set of points, used to
+    answer bounding box queries without scanning every point. Points are
+    bucketed into cells in row-major order, so the cells spanned by each row of
+    a bounding box form a single contiguous slice of the sorted points.
+    """
+    def __init__(self, positions, points_per_cell=16):
+        super().__init__()
+        self.positions = positions
+        pos = np.asarray(positions, dtype=np.float64)[:,:2]
+        finite = np.all(np.isfinite(pos), axis=1)
+        point_indexes = np.flatnonzero(finite)
+        self.grid_size = max(1, int(np.sqrt(len(point_indexes) / points_per_cell)))
+        if len(point_indexes):
+            self._mins = pos[finite].min(axis=0)
+            extent = pos[finite].max(axis=0) - self._mins
+        else:
+            self._mins = np.zeros(2)
+            extent = np.ones(2)
+        self._cell_size = np.where(extent > 0, extent / self.grid_size, 1.0)
+        
+        cell_x = self._cell_coordinate(pos[point_indexes,0], 0)
+        cell_y = self._cell_coordinate(pos[point_indexes,1], 1)
+        cell_ids = cell_y * self.grid_size + cell_x
+        order = np.argsort(cell_ids, kind='stable')
+        self._sorted_indexes = point_indexes[order]
+        self._sorted_positions = pos[self._sorted_indexes]
+        self._cell_starts = np.concatenate([[0], np.cumsum(np.bincount(cell_ids, minlength=self.grid_size ** 2))])
+        
+    def _cell_coordinate(self, values, axis):
+        cells = np.floor((np.asarray(values, dtype=np.float64) - self._mins[axis]) / self._cell_size[axis])
+        return np.clip(cells, 0, self.grid_size - 1).astype(np.int64)
+        
+    def query(self, bbox):
+        """
+        Returns the sorted row indexes of the points within the given bounding
+        box, specified as (xmin, xmax, ymin, ymax). Bounds are inclusive, and
+        infinite bounds leave that side of the box open. A box with a NaN
+        bound contains no points.
+        """
+        xmin, xmax, ymin, ymax = bbox
+        if (np.isnan(np.asarray(bbox, dtype=np.float64)).any() or xmin > xmax or ymin > ymax or
+            len(self._sorted_indexes) == 0):
+            return np.zeros(0, dtype=np.int64)
+        cx0, cx1 = self._cell_coordinate([xmin, xmax], 0)
+        cy0, cy1 = self._cell_coordinate([ymin, ymax], 1)
+        rows = np.arange(cy0, cy1 + 1) * self.grid_size
+        starts = self._cell_starts[rows + cx0]
+        lengths = self._cell_starts[rows + cx1 + 1] - starts
+        candidates = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        candidate_pos = self._sorted_positions[candidates]
+        within = ((candidate_pos[:,0] >= xmin) & (candidate_pos[:,0] <= xmax) &
+                  (candidate_pos[:,1] >= ymin) & (candidate_pos[:,1] <= ymax))
+        return np.sort(self._sorted_indexes[candidates[within]])
+
+class TaskCancelled(Exception):
+    """
+    Raised at a cancellation checkpoint when the background task that is
+    running has been superseded by a newer task of the same kind.
+    """
+    pass
+
+class CancellationToken:
+    """
+    Identifies a background task by its kind and generation, and records
+    whether it has been cancelled. Long-running code should call `check()` at
+    convenient points to stop early once the task is cancelled.
+    """
+    def __init__(self, kind=None, generation=0):
+        super().__init__()
+        self.kind = kind
+        self.generation = generation
+        self._cancelled = False
+        
+    @property
+    def cancelled(self):
+        """`True` if the task has been cancelled."""
+        return self._cancelled
+        
+    def cancel(self):
+        """Marks the task as cancelled."""
+        self._cancelled = True
+        
+    def check(self):
+        """Raises `TaskCancelled` if the task has been cancelled."""
+        if self._cancelled:
+            raise TaskCancelled("{} task (generation {}) was cancelled".format(self.kind, self.generation))
+
+class BackgroundTaskScheduler:
+    """
+    Runs background tasks on a bounded number of workers, which are started
+    using a thread starter function (such as `viewer.default_thread_starter`).
+    
+    Tasks are grouped by kind, and only the latest task of each kind is run:
+    submitting a task replaces any task of the same kind that has not started
+    yet, and cancels the token of the one that is running (if any). Tasks of
+    the same kind never run concurrently, so a new task starts only once the
+    cancelled task reaches a checkpoint and returns.
+    """
+    def __init__(self, thread_starter, max_workers=2):
+        """
+        Args:
+            thread_starter: A function that takes a function and runs it in
+                the background.
+            max_workers: The maximum number of tasks to run at once.
+        """
+        super().__init__()
+        self.thread_starter = thread_starter
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._running = {}
+        self._generations = {}
+        self._num_workers = 0
+        
+    def submit(self, kind, fn, args=(), kwargs=None):
+        """
+        Schedules a task of the given kind. The function is called with the
+        given arguments plus a `cancel_token` keyword argument containing the
+        task's `CancellationToken`; if it raises `TaskCancelled`, the task
+        ends quietly.
+        
+        Returns:
+            The `CancellationToken` for the new task.
+        """
+        with self._lock:
+            generation = self._generations.get(kind, 0) + 1
+            self._generations[kind] = generation
+            token = CancellationToken(kind, generation)
+            if kind in self._pending:
+                self._pending[kind][-1].cancel()
+            self._pending[kind] = (fn, args, kwargs or {}, token)
+            if kind in self._running:
+                self._running[kind].cancel()
+            start_worker = self._num_workers < self.max_workers
+            if start_worker:
+                self._num_workers += 1
+        if start_worker:
+            _launch_numba_threads()
+            self.thread_starter(self._work)
+        return token
+    
+    def generation(self, kind):
+        """Returns the generation number of the latest task of the given kind."""
+        with self._lock:
+            return self._generations.get(kind, 0)
+    
+    def is_busy(self):
+        """Returns `True` if any tasks are pending or running."""
+        with self._lock:
+            return bool(self._pending) or bool(self._running)
+        
+    def _next_task(self):
+        """
+        Removes and returns the next pending task whose kind is not already
+        running, or returns `None` (and retires the calling worker) if there
+        is none.
+        """
+        with self._lock:
+            for kind, task in self._pending.items():
+                if kind not in self._running:
+                    del self._pending[kind]
+                    self._running[kind] = task[-1]
+                    return kind, task
+            self._num_workers -= 1
+            return None
+        
+    def _work(self):
+        while True:
+            next_task = self._next_task()
+            if next_task is None:
+                return
+            kind, (fn, args, kwargs, token) = next_task
+            try:
+                fn(*args, cancel_token=token, **kwargs)
+            except TaskCancelled:
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    if self._running.get(kind) is token:
+                        del self._running[kind]
 
 class LoggingHelper:
     """
@@ -186,7 +617,7 @@ def _detect_numerical_sequence(arr):
         return (arr[0], arr[-1] + step, step)
     return None
     
-def encode_numerical_array(arr, astype=np.float32, positions=None, interval=None):
+def encode_numerical_array(arr, astype=np.float32, positions=None, interval=None, binary=False):
     """
     Encodes the given numpy array into a base64 representation for fast transfer
     to the widget frontend. The array will be encoded as a sequence of numbers
@@ -198,16 +629,29 @@ def encode_numerical_array(arr, astype=np.float32, positions=None, interval=None
     
     If interval is not None, it is passed into the result object directly (and
     signifies the same as positions, but with a regularly spaced interval).
+    
+    If binary is True, the values (and positions) are stored as memoryviews
+    over the array data instead of base64 strings, along with the 'dtype' and
+    'shape' of the values. The widget sends these as binary buffers, but the
+    result cannot be written to a JSON file.
     """
     # TODO support saving arrays as numerical sequence metadata
     # sequence_info = _detect_numerical_sequence(arr)
     # if sequence_info is not None:
     #     result = { ""}
-    if not arr.flags['C_CONTIGUOUS']:
-        arr = arr.copy(order='C')
-    result = { "values": base64.b64encode(arr.astype(astype)).decode('ascii') }
-    if positions is not None:
-        result["positions"] = base64.b64encode(positions.astype(np.int32)).decode('ascii')
+    arr = np.ascontiguousarray(arr, dtype=astype)
+    if binary:
+        result = {
+            "values": memoryview(arr).cast('B'),
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape)
+        }
+        if positions is not None:
+            result["positions"] = memoryview(np.ascontiguousarray(positions, dtype=np.int32)).cast('B')
+    else:
+        result = { "values": base64.b64encode(arr).decode('ascii') }
+        if positions is not None:
+            result["positions"] = base64.b64encode(positions.astype(np.int32)).decode('ascii')
     if interval is not None:
         result["interval"] = interval
     return result
@@ -221,17 +665,28 @@ def encode_object_array(arr):
         
     return { "values": base64.b64encode(json.dumps(standardize_json(arr)).encode("utf-8")).decode('ascii') }
 
+def _decode_buffer(value):
+    """
+    Returns the bytes of the given base64 string, or the given buffer itself
+    if it is already binary.
+    """
+    if isinstance(value, str):
+        return base64.decodebytes(value.encode('ascii'))
+    return value
+
 def decode_numerical_array(obj, astype=np.float32):
     """
     Decodes the given compressed dict into an array of the given dtype. The 
     dict should contain a 'values' key (base64 string) and optionally a
     'positions' key (base64 string to be turned into an int32 array, defining
     the shape of a 2d matrix) or an 'interval' key (integer defining the number
-    of columns in the 2d matrix).
+    of columns in the 2d matrix). Binary values and positions produced by
+    `encode_numerical_array(..., binary=True)` are also accepted, in which case
+    the 'dtype' key of the dict takes precedence over astype.
     """
-    values = np.frombuffer(base64.decodebytes(obj["values"].encode('ascii')), dtype=astype)
+    values = np.frombuffer(_decode_buffer(obj["values"]), dtype=obj.get("dtype", astype))
     if "positions" in obj:
-        positions = np.frombuffer(base64.decodebytes(obj["positions"].encode('ascii')), dtype=np.int32)
+        positions = np.frombuffer(_decode_buffer(obj["positions"]), dtype=np.int32)
         deltas = positions[1:] - positions[:-1]
         assert np.allclose(deltas, deltas[0]), "cannot currently decode numerical arrays with non-standard positions array"
         values = values.reshape(-1, deltas[0])
@@ -8,23 +8,36 @@
 Defines the main Emblaze visualization class, `emblaze.Viewer`.
 """
 
-from traitlets import Integer, Unicode, Dict, Bool, List, Float, Bytes, Instance, Set, observe, Any
+from traitlets import Integer, Unicode, Dict, Bool, List, Float, Bytes, Instance, Set, observe, default, validate, Any
 from .frame_colors import compute_colors
 from .datasets import EmbeddingSet, NeighborOnlyEmbedding, Embedding
 from .thumbnails import Thumbnails
-from .utils import Field, LoggingHelper, SidebarPane, matrix_to_affine, affine_to_matrix, DataType, PreviewMode
-from .recommender import SelectionRecommender
+from .utils import Field, LoggingHelper, SidebarPane, matrix_to_affine, affine_to_matrix, DataType, PreviewMode, BackgroundTaskScheduler, TaskCancelled
+from .recommender import SelectionRecommender, SuggestionCache, default_suggestion_cache_dir
 from datetime import datetime
 import json
 import glob
 import tqdm
 import threading
+import time
 import numpy as np
 import anywidget
 import pathlib
 
 PERFORMANCE_SUGGESTIONS_RECOMPUTE = 1000
 PERFORMANCE_SUGGESTIONS_ENABLE = 10000
+# Minimum number of seconds between updates to the suggested selections while
+# the recommender is still computing clusters
+SUGGESTIONS_PUBLISH_INTERVAL = 1.0
+# Maximum number of background tasks to run at once
+BACKGROUND_WORKERS = 2
+# Default number of seconds to wait for further selection, filter or frame
+# changes before recomputing colors, alignment and suggestions
+RECOMPUTE_DEBOUNCE_WINDOW = 0.1
+# Number of seconds between checks for newer changes while debouncing
+RECOMPUTE_POLL_INTERVAL = 0.02
+# Maximum number of recompute timings to keep in Viewer.recomputeTimings
+RECOMPUTE_TIMINGS_LIMIT = 100
 
 # from `npx vite`
 DEV_ESM_URL = "http://localhost:5173/src/widget-main.js?anywidget"
@@ -32,13 +45,16 @@ DEV_CSS_URL = ""
 
 # from `npx vite build`
 BUNDLE_DIR = pathlib.Path(__file__).parent / "static"
+# Marker string contained in widget bundles that can decode binary buffers
+# (see BINARY_TRANSPORT_VERSION in client/src/visualization/models/frames.js)
+BINARY_TRANSPORT_VERSION = "emblaze-binary-transport-1"
 
 def default_thread_starter(fn, args=[], kwargs={}):
     thread = threading.Thread(target=fn, args=args, kwargs=kwargs)
     thread.start()
     
 def synchronous_thread_starter(fn, args=[], kwargs={}):
-    fn(args, kwargs)
+    fn(*args, **kwargs)
 
 class Viewer(anywidget.AnyWidget):
     """
@@ -56,6 +72,12 @@ class Viewer(anywidget.AnyWidget):
     name = Unicode().tag(sync=True)
     
     thread_starter = Any(default_thread_starter)
+    # Runs recomputes in the background, cancelling superseded ones
+    _background_tasks = Instance(BackgroundTaskScheduler)
+    # Stages waiting to be recomputed and the traits that requested them
+    _recompute_stages = Set()
+    _recompute_triggers = Set()
+    _recompute_lock = Any()
     _autogenerate_embeddings = Bool(True) # only set this if caching embedding data
 
     #: An [`EmbeddingSet`](datasets.html#emblaze.datasets.EmbeddingSet) containing
@@ -66,6 +88,12 @@ class Viewer(anywidget.AnyWidget):
     data = Dict(None, allow_none=True).tag(sync=True)
     #: A file path or file-like object from which to read an embedding comparison (see [`save_comparison`](viewer.html#emblaze.viewer.Viewer.save_comparison)).
     file = Any(allow_none=True).tag(sync=True)
+    #: A directory from which to load the neighbor search structures referenced
+    #: by `file`, if it was saved with an `index_dir` (see [`comparison_to_json`](viewer.html#emblaze.viewer.Viewer.comparison_to_json)).
+    #: The indexes are deserialized using `pickle`, so only set this to a
+    #: directory written by a trusted source. If `None`, indexes are refit when
+    #: needed.
+    indexDir = Unicode(None, allow_none=True)
     #: Padding around the plot in data coordinates.
     plotPadding = Float(10.0).tag(sync=True)
     
@@ -126,6 +154,15 @@ class Viewer(anywidget.AnyWidget):
     #: dictionary corresponding to each `Embedding`. You should not need to
     #: modify this variable.
     neighborData = List([]).tag(sync=True)
+    #: If `True`, numerical arrays (IDs, positions, neighbors and spritesheet
+    #: images) in `data`, `neighborData` and `thumbnailData` are sent to the
+    #: frontend as binary buffers rather than base64 strings, which is faster
+    #: and smaller for large comparisons in Jupyter. The trait values are then
+    #: no longer JSON-serializable, so this cannot be used with the standalone
+    #: server. Must be set during initialization, and is only enabled if the
+    #: installed widget bundle supports the binary format (otherwise a warning
+    #: is printed and base64 strings are used).
+    binaryTransport = Bool(False)
 
     #: Boolean marking that the current state of the visualization should be
     #: saved to file. The current values of [`selectionName`](#emblaze.viewer.Viewer.selectionName)
@@ -166,6 +203,27 @@ class Viewer(anywidget.AnyWidget):
     #: If `True`, recompute suggestions fully but only when less than `PERFORMANCE_SUGGESTIONS_RECOMPUTE`
     #: points are visible.
     performanceSuggestionsMode = Bool(False).tag(sync=True)
+    #: Directory in which the clusters for each frame pair are cached across
+    #: sessions, so that suggested selections are only recomputed for frame
+    #: pairs whose neighbors have changed (for example, `~/.cache/emblaze/suggestions`).
+    #: Defaults to the value of the `EMBLAZE_CACHE_DIR` environment variable
+    #: if set, and otherwise `None`, which disables caching. The least recently
+    #: used entries are removed once the cache exceeds 256 MB (see
+    #: `recommender.SuggestionCache`); call `clear_suggestion_cache` to empty it.
+    suggestionCacheDir = Unicode(None, allow_none=True)
+    #: Number of seconds to wait after a change to the selection, filter,
+    #: alignment or current frame before recomputing frame colors, alignment
+    #: and suggested selections, so that bursts of changes (such as while
+    #: lasso-selecting) result in a single recompute. Set to 0 to recompute
+    #: after every change.
+    recomputeDebounceWindow = Float(RECOMPUTE_DEBOUNCE_WINDOW)
+    #: Timings of the most recent recomputes, for monitoring. Each entry is a
+    #: dictionary with the `timestamp` at which the recompute started, the
+    #: `triggers` (names of the traits that changed), the number of seconds
+    #: spent in each stage (`colors`, `alignment` and `suggestions`, if run),
+    #: and the `total` number of seconds. Recomputes that were superseded by a
+    #: newer change before finishing are marked with `cancelled`.
+    recomputeTimings = List([])
     
     #: A list of recent selections, represented in the same format as saved
     #: and suggested selections (including the `selectedIDs` and `currentFrame`)
@@ -246,6 +304,8 @@ class Viewer(anywidget.AnyWidget):
             embeddings: An `EmbeddingSet` object.
             thumbnails: A `ThumbnailSet` object.
             file: A file path or file-like object from which to read a comparison JSON file.
+            indexDir: A trusted directory containing neighbor indexes saved
+                with the comparison file.
         """
         try:
             self._esm = DEV_ESM_URL if kwargs.get('dev', False) else (BUNDLE_DIR / "widget-main.js").read_text()
@@ -255,7 +315,7 @@ class Viewer(anywidget.AnyWidget):
 
         super(Viewer, self).__init__(*args, **kwargs)
         if self.file:
-            self.load_comparison(self.file)
+            self.load_comparison(self.file, index_dir=self.indexDir)
         if len(self.embeddings) == 0:
             raise ValueError("Must have at least one embedding.")
         if not all(emb.dimension() == 2 for emb in self.embeddings):
@@ -372,7 +432,7 @@ class Viewer(anywidget.AnyWidget):
     @observe("file")
     def _observe_file(self, change):
         if change.new is not None:
-            self.load_comparison(change.new)
+            self.load_comparison(change.new, index_dir=self.indexDir)
         
     @observe("embeddings")
     def _observe_embeddings(self, change):
@@ -387,8 +447,9 @@ class Viewer(anywidget.AnyWidget):
                     n_neighbors = self.storedNumNeighbors 
                 else:
                     n_neighbors = self._select_stored_num_neighbors(embeddings)
-                self.data = embeddings.to_json(save_neighbors=False)
-                self.neighborData = embeddings.get_ancestor_neighbors().to_json(num_neighbors=n_neighbors)
+                self.data = embeddings.to_json(save_neighbors=False, binary=self.binaryTransport)
+                self.neighborData = embeddings.get_ancestor_neighbors().to_json(num_neighbors=n_neighbors,
+                                                                                binary=self.binaryTransport)
                 self.isLoading = False
             else:
                 self.neighborData = []
@@ -405,44 +466,102 @@ class Viewer(anywidget.AnyWidget):
         self.previewMode = self.detect_preview_mode()
         self._update_selection_unit(embeddings[0])
         
-        self._update_suggested_selections()
+        self._update_suggested_selections("embeddings")
 
     @observe("currentFrame")
     def _observe_current_frame(self, change):
         self._update_selection_unit(self.embeddings[change.new])
-        self._update_suggested_selections()
+        self._schedule_recompute("currentFrame", "suggestions")
 
     @observe("previewFrame")
     def _observe_preview_frame(self, change):
-        self._update_suggested_selections()
+        self._schedule_recompute("previewFrame", "suggestions")
 
     @observe("thumbnails")
     def _observe_thumbnails(self, change):
         if self._autogenerate_embeddings or self.thumbnailData is None or len(self.thumbnailData) == 0:
             if change.new is not None:
-                self.thumbnailData = change.new.to_json()
+                self.thumbnailData = change.new.to_json(binary=self.binaryTransport)
             else:
                 self.thumbnailData = {} 
   
     @observe("alignedIDs")
     def _observe_alignment_ids(self, change):
         """Align to the currently selected points and their neighbors."""
-        if not change.new:
-            self.align_to_points(None, None)
-        else:
-            ids_of_interest = change.new
-            self.thread_starter(self.align_to_points, args=(change.new, list(set(ids_of_interest)),))
+        self._schedule_recompute("alignedIDs", "alignment")
     
     @observe("selectedIDs")
     def _observe_selected_ids(self, change):
         """Change the color scheme to match the arrangement of the selected IDs."""
-        self.update_frame_colors()
-        self._update_suggested_selections()
+        self._schedule_recompute("selectedIDs", "colors", "suggestions")
             
     @observe("filterIDs")
     def _observe_filter_ids(self, change):
         """Update suggestions when the filter changes."""
-        self._update_suggested_selections()
+        self._schedule_recompute("filterIDs", "suggestions")
+        
+    @default("_recompute_lock")
+    def _default_recompute_lock(self):
+        return threading.Lock()
+        
+    def _schedule_recompute(self, trigger, *stages):
+        """
+        Marks the given stages ("colors", "alignment" and/or "suggestions") as
+        needing to be recomputed because the given trait changed, and schedules
+        a recompute after `recomputeDebounceWindow` seconds. Any changes that
+        arrive in the meantime restart the window and are handled by the same
+        recompute.
+        """
+        with self._recompute_lock:
+            self._recompute_stages.update(stages)
+            self._recompute_triggers.add(trigger)
+        self._background_tasks.submit("recompute", self._debounced_recompute)
+        
+    def _debounced_recompute(self, cancel_token=None):
+        """
+        Waits for the debounce window to elapse (stopping early if a newer
+        change cancels this task), then recomputes the stages that have been
+        marked as needing it and records the time spent in `recomputeTimings`.
+        """
+        deadline = time.time() + self.recomputeDebounceWindow
+        while time.time() < deadline:
+            if cancel_token is not None: cancel_token.check()
+            time.sleep(min(RECOMPUTE_POLL_INTERVAL, max(deadline - time.time(), 0)))
+        if cancel_token is not None: cancel_token.check()
+        
+        with self._recompute_lock:
+            stages = set(self._recompute_stages)
+            triggers = sorted(self._recompute_triggers)
+            self._recompute_stages.clear()
+            self._recompute_triggers.clear()
+        # Aligning also updates the frame colors
+        if "alignment" in stages:
+            stages.discard("colors")
+            
+        timing = {"timestamp": time.time(), "triggers": triggers}
+        stage_fns = [
+            ("alignment", lambda: self.align_to_points(self.alignedIDs or None, None, cancel_token=cancel_token)),
+            ("colors", self.update_frame_colors),
+            ("suggestions", lambda: self._update_suggested_selections_background(cancel_token=cancel_token)),
+        ]
+        start_time = time.time()
+        try:
+            for stage, fn in stage_fns:
+                if stage not in stages: continue
+                stage_start = time.time()
+                fn()
+                timing[stage] = time.time() - stage_start
+                stages.discard(stage)
+        except TaskCancelled:
+            # Leave the remaining stages for the recompute that superseded this one
+            with self._recompute_lock:
+                self._recompute_stages.update(stages)
+                self._recompute_triggers.update(triggers)
+            timing["cancelled"] = True
+            raise
+        finally:
+            timing["total"] = time.time() - start_time
+            self.recomputeTimings = (self.recomputeTimings + [timing])[-RECOMPUTE_TIMINGS_LIMIT:]
 
     def reset_state(self):
         """Resets the view state of the widget."""
@@ -462,7 +581,7 @@ class Viewer(anywidget.AnyWidget):
         self.alignedFrame = 0
         self.update_frame_colors()
         
-    def align_to_points(self, point_ids, peripheral_points):
+    def align_to_points(self, point_ids, peripheral_points, cancel_token=None):
         """
         Re-align the projections to minimize motion for the given point IDs.
         Uses currentFrame as the base frame. Updates the 
@@ -471,6 +590,9 @@ class Viewer(anywidget.AnyWidget):
         Args:
             point_ids: Iterable of point IDs to use for alignment.
             peripheral_points: Unused.
+            cancel_token: An optional `utils.CancellationToken`, checked before
+                aligning each frame so that a newer alignment can supersede
+                this one.
         """
         if point_ids is None:
             self.reset_alignment()
@@ -481,6 +603,7 @@ class Viewer(anywidget.AnyWidget):
         base_transform = matrix_to_affine(np.array(self.frameTransformations[self.alignedFrame]))
 
         for emb in self.embeddings:
+            if cancel_token is not None: cancel_token.check()
             transformations.append(affine_to_matrix(emb.align_to(
                 self.embeddings[self.alignedFrame], 
                 ids=list(set(point_ids)),
@@ -488,6 +611,7 @@ class Viewer(anywidget.AnyWidget):
                 return_transform=True,
                 allow_flips=False)).tolist())
 
+        if cancel_token is not None: cancel_token.check()
         self.frameTransformations = transformations
         self.update_frame_colors()
 
@@ -533,6 +657,7 @@ class Viewer(anywidget.AnyWidget):
         
         hi_d = self.embeddings[frame].find_ancestor_neighbor_embedding()
         order, distances = hi_d.neighbor_distances(ids=[centerID], n_neighbors=self.selectionOrderCount)
+        order = hi_d.ids[order]
         
         self.selectionOrder = [(int(x), np.round(y, 4)) for x, y in np.vstack([
             order.flatten(),
@@ -542,26 +667,43 @@ class Viewer(anywidget.AnyWidget):
     @observe("visibleSidebarPane")
     def _observe_sidebar_pane(self, change):
         if change.new == SidebarPane.SUGGESTED:
-            self._update_suggested_selections()
+            self._update_suggested_selections("visibleSidebarPane")
         elif change.new == SidebarPane.SAVED:
             self.refresh_saved_selections()
 
     def _get_filter_points(self, selection, in_frame=None):
         """Returns a list of points that should be visible if the given selection
         is highlighted."""
-        filtered_points = set()
-        for id_val in selection:
-            filtered_points.add(id_val)
+        filtered_points = [np.asarray(list(selection))]
         for frame in self.embeddings.embeddings if in_frame is None else [in_frame]:
-            filtered_points |= set(frame.get_ancestor_neighbors()[selection][:,:self.numNeighbors].flatten().tolist())
-        return list(filtered_points)
+            # Read only the selection's rows, since building the full neighbor
+            # graph would load every row of the (possibly memory-mapped) values
+            filtered_points.append(frame.get_ancestor_neighbors()[selection][:,:self.numNeighbors].ravel())
+        return np.unique(np.concatenate(filtered_points)).tolist()
     
     @observe("recomputeSuggestionsFlag")
     def _observe_suggestion_flag(self, change):
         """Recomputes suggestions when recomputeSuggestionsFlag is set to True."""
-        if change.new and not self.loadingSuggestions:
-            self._update_suggested_selections()
+        if change.new:
+            self._update_suggested_selections("recomputeSuggestionsFlag")
     
+    @default("_background_tasks")
+    def _default_background_tasks(self):
+        return BackgroundTaskScheduler(self.thread_starter, max_workers=BACKGROUND_WORKERS)
+        
+    @validate("binaryTransport")
+    def _validate_binary_transport(self, proposal):
+        if proposal.value and self._esm != DEV_ESM_URL and BINARY_TRANSPORT_VERSION not in self._esm:
+            print(("The installed widget bundle cannot decode binary buffers, so "
+                   "binaryTransport is disabled. Rebuild the bundle by running "
+                   "npx vite build from the client directory."))
+            return False
+        return proposal.value
+        
+    @default("suggestionCacheDir")
+    def _default_suggestion_cache_dir(self):
+        return default_suggestion_cache_dir()
+        
     def _update_performance_suggestions_mode(self):
         """Determines whether to use the performance mode for computing suggestions."""
         if len(self.embeddings) <= 1:
@@ -569,7 +711,7 @@ class Viewer(anywidget.AnyWidget):
         else:
             self.performanceSuggestionsMode = len(self.embeddings[0]) * len(self.embeddings) >= PERFORMANCE_SUGGESTIONS_ENABLE
         
-    def precompute_suggested_selections(self):
+    def precompute_suggested_selections(self, n_jobs=1):
         """
         Computes the suggested selections for all points in the embeddings. This
         is useful to get quick recommendations later, though it may take time to
@@ -577,25 +719,41 @@ class Viewer(anywidget.AnyWidget):
         [`recommender`](#emblaze.viewer.Viewer.recommender) property will be a
         fully loaded `SelectionRecommender` that can be queried for suggestions
         relative to an area of the plot, selection, or set of frames.
+        
+        Args:
+            n_jobs: Number of worker processes to use to cluster frame pairs in
+                parallel (-1 to use all processors).
         """
         bar = tqdm.tqdm(total=len(self.embeddings) * (len(self.embeddings) - 1), desc='Clustering')
         def progress_fn(progress):
             bar.update(1)
-        self.recommender = SelectionRecommender(self.embeddings, progress_fn=progress_fn)
+        self.recommender = SelectionRecommender(self.embeddings, progress_fn=progress_fn, n_jobs=n_jobs,
+                                                cache=self.suggestionCacheDir)
         bar.close()
         
-    def _update_suggested_selections_background(self):
-        """Function that runs in the background to recompute suggested selections."""
-        self.recomputeSuggestionsFlag = False
-        if self.loadingSuggestions: 
-            return
+    def clear_suggestion_cache(self):
+        """
+        Removes all cached suggested selections from `suggestionCacheDir`
+        (if caching is enabled).
+        """
+        if self.suggestionCacheDir is not None:
+            SuggestionCache(self.suggestionCacheDir).clear()
         
-
+    def _update_suggested_selections_background(self, cancel_token=None):
+        """
+        Function that runs in the background to recompute suggested selections.
+        If a `utils.CancellationToken` is given, the computation stops at the
+        next checkpoint after the token is cancelled (leaving the recommender
+        to be resumed by the next update).
+        """
+        self.recomputeSuggestionsFlag = False
         filter_points = None
         self._update_performance_suggestions_mode()
         if len(self.embeddings) == 1:
             # We cannot generate suggested selections when there is only one embedding
             self.suggestedSelections = []
+            # A cancelled task may have left the loading state set
+            self.loadingSuggestions = False
             return
         if self.performanceSuggestionsMode and (not self.recommender or self.recommender.is_restricted):
             # Check if sufficiently few points are visible to show suggestions
@@ -611,6 +769,7 @@ class Viewer(anywidget.AnyWidget):
                 not filter_points or
                 len(filter_points) > PERFORMANCE_SUGGESTIONS_RECOMPUTE):
                 self.suggestedSelections = []
+                self.loadingSuggestions = False
                 return
             # Add the vicinity around these points just to be safe
             filter_points = self._get_filter_points(filter_points, in_frame=self.embeddings[self.currentFrame])
@@ -626,55 +785,82 @@ class Viewer(anywidget.AnyWidget):
                     progress_fn=progress_fn,
                     frame_idx=self.currentFrame if self.performanceSuggestionsMode else None,
                     preview_frame_idx=self.previewFrame if self.performanceSuggestionsMode and self.previewFrame >= 0 and self.previewFrame != self.currentFrame else None,
-                    filter_points=filter_points if self.performanceSuggestionsMode else None)
-
+                    filter_points=filter_points if self.performanceSuggestionsMode else None,
+                    cache=self.suggestionCacheDir,
+                    lazy=True,
+                    reuse_from=self.recommender)
+                
+            if not self.recommender.is_complete:
+                # Publish suggestions as soon as clusters relevant to the
+                # current frame(s) are available, then at most once per interval
+                last_published = None
+                for idx_1, idx_2 in self.recommender.iter_compute(cancel_token=cancel_token):
+                    if idx_1 != self.currentFrame: continue
+                    if self.previewFrame >= 0 and self.previewFrame != self.currentFrame and idx_2 != self.previewFrame: continue
+                    if last_published is None or time.time() - last_published >= SUGGESTIONS_PUBLISH_INTERVAL:
+                        self._publish_suggested_selections(cancel_token=cancel_token)
+                        last_published = time.time()
         
-            # Only compute suggestions when pane is open
-            if self.previewFrame >= 0 and self.previewFrame != self.currentFrame:
-                preview_frame_idx = self.previewFrame
-            else:
-                preview_frame_idx = None
-              
-            if self.selectedIDs:
-                ids_of_interest = self.selectedIDs
-                id_type = "selection"  
-            elif self.filterIDs and not self.performanceSuggestionsMode:
-                ids_of_interest = self.filterIDs
-                id_type = "visible points"
-            else:
-                ids_of_interest = None
-                id_type = "visible points" if self.performanceSuggestionsMode else None
+            self._publish_suggested_selections(cancel_token=cancel_token)
+        finally:
+            # A superseding task is responsible for the loading state
+            if cancel_token is None or not cancel_token.cancelled:
+                self.loadingSuggestions = False
+            
+    def _publish_suggested_selections(self, cancel_token=None):
+        """
+        Queries the recommender using the current selection, frames and
+        visible area, and updates `suggestedSelections` with the results
+        (unless the given `utils.CancellationToken` is cancelled first).
+        """
+        if self.previewFrame >= 0 and self.previewFrame != self.currentFrame:
+            preview_frame_idx = self.previewFrame
+        else:
+            preview_frame_idx = None
+          
+        if self.selectedIDs:
+            ids_of_interest = self.selectedIDs
+            id_type = "selection"  
+        elif self.filterIDs and not self.performanceSuggestionsMode:
+            ids_of_interest = self.filterIDs
+            id_type = "visible points"
+        else:
+            ids_of_interest = None
+            id_type = "visible points" if self.performanceSuggestionsMode else None
 
-            suggestions = []
-            results = self.recommender.query(ids_of_interest=ids_of_interest,
-                                             filter_ids=self.filterIDs or None,
-                                             frame_idx=self.currentFrame,
-                                             preview_frame_idx=preview_frame_idx,
-                                             bounding_box=self.suggestedSelectionWindow or None,
-                                             num_results=25,
-                                             id_type=id_type)
-            for result, reason in results:
-                ids = list(result["ids"])
-                suggestions.append({
-                    "selectionName": "",
-                    "selectionDescription": reason,
-                    "currentFrame": result["frame"],
-                    "selectedIDs": ids,
-                    "alignedIDs": ids,
-                    "filterIDs": self._get_filter_points(ids),
-                    "frameColors": compute_colors(self.embeddings, ids)
-                })
-            self.suggestedSelections = suggestions
-                
-            self.loadingSuggestions = False
-        except Exception as e:
-            print(e)
-            self.loadingSuggestions = False
-            raise e
+        suggestions = []
+        results = self.recommender.query(ids_of_interest=ids_of_interest,
+                                         filter_ids=self.filterIDs or None,
+                                         frame_idx=self.currentFrame,
+                                         preview_frame_idx=preview_frame_idx,
+                                         bounding_box=self.suggestedSelectionWindow or None,
+                                         num_results=25,
+                                         id_type=id_type)
+        for result, reason in results:
+            if cancel_token is not None: cancel_token.check()
+            ids = list(result["ids"])
+            suggestions.append({
+                "selectionName": "",
+                "selectionDescription": reason,
+                "currentFrame": result["frame"],
+                "selectedIDs": ids,
+                "alignedIDs": ids,
+                "filterIDs": self._get_filter_points(ids),
+                "frameColors": compute_colors(self.embeddings, ids)
+            })
+        if cancel_token is not None: cancel_token.check()
+        self.suggestedSelections = suggestions
+        
+    def _update_suggested_selections(self, trigger=None):
+        """
+        Recomputes the suggested selections in the background, cancelling any
+        recomputation that is already in progress.
         
-    def _update_suggested_selections(self):
-        """Recomputes the suggested selections."""
-        self.thread_starter(self._update_suggested_selections_background)
+        Args:
+            trigger: The name of the trait whose change requires the
+                suggestions to be updated, recorded in `recomputeTimings`.
+        """
+        self._schedule_recompute(trigger or "suggestions", "suggestions")
 
     @observe("saveInteractionsFlag")
     def _save_interactions(self, change):
@@ -687,7 +873,7 @@ class Viewer(anywidget.AnyWidget):
             self.interactionHistory = []
             self.saveInteractionsFlag = False
             
-    def comparison_to_json(self, compressed=True, ancestor_data=True, suggestions=False):
+    def comparison_to_json(self, compressed=True, ancestor_data=True, suggestions=False, save_distances=False, index_dir=None):
         """
         Saves the data used to produce this comparison to a JSON object. This
         includes the `EmbeddingSet` and the `Thumbnails` that are visualized, as
@@ -705,6 +891,14 @@ class Viewer(anywidget.AnyWidget):
                 select tool will not work if ancestor data is not saved.
             suggestions: If `True` and the viewer has a `recommender` associated
                 with it, the recommender will also be serialized.
+            save_distances: If `True`, the distances to each neighbor will be
+                stored alongside the neighbor IDs where available.
+            index_dir: If provided, the fitted neighbor search structures will
+                be pickled to files in this directory, and the JSON will only
+                reference them by name, so that tools that query neighbors
+                (such as the high-dimensional radius select) do not need to
+                refit them when the comparison is loaded with the same
+                `index_dir` (see [`load_comparison_from_json`](viewer.html#emblaze.viewer.Viewer.load_comparison_from_json)).
         
         Returns:
             A JSON-serializable dictionary representing the comparison, including
@@ -719,7 +913,9 @@ class Viewer(anywidget.AnyWidget):
         
         result["_format"] = "emblaze.Viewer.SaveData"
         result["embeddings"] = self.embeddings.to_json(compressed=compressed,
-                                                       save_neighbors=True)
+                                                       save_neighbors=True,
+                                                       save_distances=save_distances,
+                                                       index_dir=index_dir)
         result["thumbnails"] = self.thumbnails.to_json()
         
         # Save recent neighbors (those used for frame colors and recommendations)
@@ -736,10 +932,14 @@ class Viewer(anywidget.AnyWidget):
         ancestors = EmbeddingSet([emb.find_ancestor_neighbor_embedding() for emb in self.embeddings], align=False)
         if ancestor_data:
             if ancestors.identical():
-                result["ancestor_data"] = [ancestors[0].to_json(compressed=compressed)]
+                result["ancestor_data"] = [ancestors[0].to_json(compressed=compressed,
+                                                                save_distances=save_distances,
+                                                                index_dir=index_dir)]
             else:
                 result["ancestor_data"] = [
-                    anc.to_json(compressed=compressed)
+                    anc.to_json(compressed=compressed,
+                                save_distances=save_distances,
+                                index_dir=index_dir)
                     for anc in ancestors
                 ]
         elif neighbors != ancestor_neighbors:
@@ -755,7 +955,7 @@ class Viewer(anywidget.AnyWidget):
             result["suggestions"] = self.recommender.to_json()
         return result
     
-    def load_comparison_from_json(self, data):
+    def load_comparison_from_json(self, data, index_dir=None):
         """
         Loads comparison information from a JSON object, including the
         `EmbeddingSet`, `Thumbnails`, and `NeighborSet`.
@@ -763,6 +963,11 @@ class Viewer(anywidget.AnyWidget):
         Args:
             data: A JSON-serializable dictionary generated using
                 [`Viewer.comparison_to_json`](#emblaze.viewer.Viewer.comparison_to_json).
+            index_dir: The directory that was passed to `comparison_to_json`
+                to save the neighbor search structures, if any. The indexes
+                are deserialized using `pickle`, which can execute arbitrary
+                code, so only pass a directory written by a trusted source.
+                If `None` (default), saved indexes are ignored.
                 
         Returns:
             The populated `Viewer` object.
@@ -778,9 +983,9 @@ class Viewer(anywidget.AnyWidget):
         # Load neighbors first, to create mock parent embeddings
         parents = None
         if "ancestor_data" in data:
-            parents = [Embedding.from_json(item) for item in data["ancestor_data"]]
+            parents = [Embedding.from_json(item, index_dir=index_dir) for item in data["ancestor_data"]]
         elif "ancestor_neighbors" in data:
-            parents = [NeighborOnlyEmbedding.from_json(item) for item in data["ancestor_neighbors"]]
+            parents = [NeighborOnlyEmbedding.from_json(item, index_dir=index_dir) for item in data["ancestor_neighbors"]]
             
         if "recent_neighbors" in data:
             # The neighbors to display will come from these, so put them in between
@@ -790,10 +995,10 @@ class Viewer(anywidget.AnyWidget):
                 recent_parents = [None for _ in range(len(self.embeddings))]
             elif len(parents) == 1:
                 recent_parents = [recent_parents[0] for _ in range(len(self.embeddings))]
-            parents = [NeighborOnlyEmbedding.from_json(item, parent=p)
+            parents = [NeighborOnlyEmbedding.from_json(item, parent=p, index_dir=index_dir)
                        for item, p in zip(data["recent_neighbors"], recent_parents)]
         
-        self.embeddings = EmbeddingSet.from_json(data["embeddings"], parents=parents)
+        self.embeddings = EmbeddingSet.from_json(data["embeddings"], parents=parents, index_dir=index_dir)
         self.thumbnails = Thumbnails.from_json(data["thumbnails"])
         
         if "suggestions" in data:
@@ -825,7 +1030,7 @@ class Viewer(anywidget.AnyWidget):
             # File object
             json.dump(self.comparison_to_json(**kwargs), file_path_or_buffer)
             
-    def load_comparison(self, file_path_or_buffer):
+    def load_comparison(self, file_path_or_buffer, index_dir=None):
         """
         Load the comparison data from the given file path or
         file-like object containing JSON data.
@@ -833,11 +1038,14 @@ class Viewer(anywidget.AnyWidget):
         Args:
             file_path_or_buffer: A file path or file-like object from which to
                 load the comparison.
+            index_dir: A trusted directory containing the neighbor search
+                structures saved with the comparison (see
+                [`Viewer.load_comparison_from_json`](#emblaze.viewer.Viewer.load_comparison_from_json)).
         """
         if isinstance(file_path_or_buffer, str):
             # File path
             with open(file_path_or_buffer, 'r') as file:
-                return self.load_comparison_from_json(json.load(file))
+                return self.load_comparison_from_json(json.load(file), index_dir=index_dir)
         else:
             # File object
-            return self.load_comparison_from_json(json.load(file_path_or_buffer))
+            return self.load_comparison_from_json(json.load(file_path_or_buffer), index_dir=index_dir)
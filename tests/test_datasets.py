@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from emblaze.datasets import Embedding
+from emblaze.utils import Field
+
+
+def test_neighbor_distances_follow_position_changes():
+    rng = np.random.RandomState(0)
+    emb = Embedding({Field.POSITION: rng.randn(50, 2), Field.COLOR: np.zeros(50)})
+    assert emb.get_neighbors() is None
+    emb.neighbor_distances(n_neighbors=5)
+    assert emb._neighbor_clfs
+
+    emb.set_field(Field.POSITION, rng.randn(50, 2))
+    assert not emb._neighbor_clfs
+    indexes, distances = emb.neighbor_distances(n_neighbors=5)
+    expected_distances, expected_indexes = NearestNeighbors().fit(emb.field(Field.POSITION)).kneighbors(n_neighbors=5)
+    assert np.array_equal(indexes, expected_indexes)
+    assert np.allclose(distances, expected_distances)
+
+
+def test_get_relations_matches_scalar_lookups():
+    rng = np.random.RandomState(0)
+    ids = rng.permutation(100)[:40] * 3
+    other_ids = np.concatenate([ids[::-2], [1000, 1001]])
+    emb = Embedding({Field.POSITION: rng.randn(40, 2), Field.COLOR: np.zeros(40)}, ids=ids)
+    other = Embedding({Field.POSITION: rng.randn(len(other_ids), 2), Field.COLOR: np.zeros(len(other_ids))},
+                      ids=other_ids)
+    expected = {emb.index(id_val): other.index(id_val) for id_val in ids if id_val in other}
+    assert len(expected) == 20
+    assert emb.get_relations(other) == expected
+
+
+def test_concat_inserts_neighbors_like_full_recompute():
+    rng = np.random.RandomState(1)
+    pos = rng.randn(90, 3)
+    ids = rng.permutation(300)[:90] * 7 - 50
+    emb = Embedding({Field.POSITION: pos[:70], Field.COLOR: np.zeros(70)}, ids=ids[:70], n_neighbors=5)
+    emb.compute_neighbors()
+    other = Embedding({Field.POSITION: pos[70:], Field.COLOR: np.zeros(20)}, ids=ids[70:], n_neighbors=5)
+    combined = emb.concat(other)
+
+    expected = Embedding({Field.POSITION: pos, Field.COLOR: np.zeros(90)}, ids=ids, n_neighbors=5)
+    expected.compute_neighbors()
+    assert np.array_equal(combined.ids, expected.ids)
+    assert np.array_equal(combined.get_neighbors().values, expected.get_neighbors().values)
+    assert np.array_equal(combined.get_neighbors()[ids[::9]], expected.get_neighbors()[ids[::9]])
+
+    duplicate = Embedding({Field.POSITION: pos[:2], Field.COLOR: np.zeros(2)}, ids=ids[68:70])
+    with pytest.raises(AssertionError):
+        emb.concat(duplicate)
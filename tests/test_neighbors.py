@@ -0,0 +1,239 @@
+import base64
+import json
+import os
+import pickle
+
+import numpy as np
+
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+import emblaze.neighbors as neighbors_module
+from emblaze.neighbors import Neighbors, NeighborSet, neighbor_csr
+from emblaze.utils import IDIndex, NeighborAlgorithm
+
+
+class _Exploit:
+    def __reduce__(self):
+        return (os.system, ("echo unpickled",))
+
+
+def _make_neighbors():
+    rng = np.random.RandomState(0)
+    return Neighbors.compute(rng.randn(40, 3), n_neighbors=5)
+
+
+def test_index_is_saved_to_separate_file(tmp_path):
+    neighbors = _make_neighbors()
+    assert "index" not in neighbors.to_json()
+
+    index_dir = str(tmp_path / "indexes")
+    data = json.loads(json.dumps(neighbors.to_json(index_dir=index_dir)))
+    assert data["index"]["path"] in os.listdir(index_dir)
+    assert "values" not in data["index"]
+
+    # Indexes are only loaded from a directory the caller trusts
+    assert not Neighbors.from_json(data).has_clf()
+    loaded = Neighbors.from_json(data, index_dir=index_dir)
+    assert loaded.has_clf()
+    pos = np.random.RandomState(1).randn(5, 3)
+    assert np.array_equal(loaded.calculate_neighbors(pos, return_distance=False),
+                          neighbors.calculate_neighbors(pos, return_distance=False))
+
+
+def test_index_embedded_in_json_is_never_unpickled(tmp_path, capfd):
+    data = _make_neighbors().to_json()
+    data["index"] = {"_format": "pickle",
+                     "values": base64.b64encode(pickle.dumps(_Exploit())).decode('ascii')}
+    for index_dir in (None, str(tmp_path)):
+        loaded = Neighbors.from_json(data, index_dir=index_dir)
+        assert not loaded.has_clf()
+    assert "unpickled" not in capfd.readouterr().out
+
+
+def test_saved_index_requires_load_index(tmp_path):
+    neighbors = _make_neighbors()
+    directory = str(tmp_path / "neighbors")
+    neighbors.save(directory)
+    assert not os.path.exists(os.path.join(directory, "index.pkl"))
+
+    neighbors.save(directory, save_index=True)
+    assert not Neighbors.load(directory).has_clf()
+    assert Neighbors.load(directory, load_index=True).has_clf()
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_chunked_kneighbors_matches_single_query(n_jobs):
+    rng = np.random.RandomState(0)
+    pos = rng.randn(300, 4)
+    ids = np.arange(300) * 5 + 7
+    clf = NearestNeighbors(n_neighbors=6).fit(pos)
+    expected_dists, expected_indexes = clf.kneighbors(pos, n_neighbors=6)
+    # A tiny memory budget splits the queries into many chunks
+    memory_mb = 20 * (8 * len(pos)) / 2 ** 20
+    assert neighbors_module._chunk_rows(len(pos), 5, memory_mb) < len(pos) // 10
+    values, distances = neighbors_module._chunked_kneighbors(clf, pos, ids, 5, memory_mb=memory_mb, n_jobs=n_jobs)
+    assert np.array_equal(values, ids[expected_indexes[:,1:]])
+    assert np.allclose(distances, expected_dists[:,1:], atol=1e-6)
+
+
+def _dense_one_hot(rows, columns):
+    dense = np.zeros((len(rows), len(columns)), dtype=np.int32)
+    column_positions = {c: i for i, c in enumerate(columns)}
+    for i, row in enumerate(rows):
+        for value in row:
+            dense[i, column_positions[value]] = 1
+    return dense
+
+
+def test_neighbor_csr_matches_dense_one_hot():
+    rng = np.random.RandomState(0)
+    ids = rng.choice(10000, size=30, replace=False)
+    rows = [rng.choice(ids, size=rng.randint(0, 8)).tolist() for _ in range(20)]
+    indptr = np.concatenate([[0], np.cumsum([len(r) for r in rows])])
+    values = np.array([x for r in rows for x in r], dtype=np.int64)
+    mat = neighbor_csr((indptr, values))
+    # Columns are assigned to the distinct IDs in sorted order
+    columns = np.unique(values)
+    assert mat.shape == (len(rows), len(columns))
+    assert np.array_equal(mat.toarray(), _dense_one_hot(rows, columns))
+
+    square = rng.choice(ids, size=(20, 6))
+    mat = neighbor_csr(square, IDIndex(ids))
+    assert np.array_equal(mat.toarray(), _dense_one_hot(square.tolist(), ids))
+
+
+def _make_neighbor_set():
+    rng = np.random.RandomState(2)
+    ids = np.arange(60) * 3 + 11
+    frames = []
+    for keep in (np.arange(60), rng.permutation(60)[:45]):
+        frame_ids = ids[np.sort(keep)]
+        values = np.array([rng.choice(frame_ids, size=8, replace=False) for _ in frame_ids])
+        frames.append(Neighbors(values, ids=frame_ids, n_neighbors=8))
+    return NeighborSet(frames)
+
+
+def test_to_csr_matches_dense_adjacency():
+    neighbors = _make_neighbor_set()[0]
+    for num_neighbors in (None, 3):
+        rows = neighbors.values[:,:num_neighbors].tolist()
+        assert np.array_equal(neighbors.to_csr(num_neighbors).toarray(),
+                              _dense_one_hot(rows, neighbors.ids))
+
+
+def test_neighbor_set_comparisons_match_brute_force():
+    neighbor_set = _make_neighbor_set()
+    n1, n2 = neighbor_set[0], neighbor_set[1]
+    common = np.intersect1d(n1.ids, n2.ids)
+    for ids, num_neighbors in ((None, None), (common[::4], 5)):
+        row_ids = common if ids is None else ids
+        sets_1 = [set(row[:num_neighbors]) for row in n1[row_ids].tolist()]
+        sets_2 = [set(row[:num_neighbors]) for row in n2[row_ids].tolist()]
+        overlap = np.array([len(a & b) for a, b in zip(sets_1, sets_2)])
+        jaccard = np.array([1 - len(a & b) / len(a | b) for a, b in zip(sets_1, sets_2)])
+        gained = np.array([len(b - a) for a, b in zip(sets_1, sets_2)])
+        lost = np.array([len(a - b) for a, b in zip(sets_1, sets_2)])
+
+        assert np.array_equal(neighbor_set.overlap_counts(0, 1, ids=ids, num_neighbors=num_neighbors), overlap)
+        assert np.allclose(neighbor_set.jaccard_distances(0, 1, ids=ids, num_neighbors=num_neighbors), jaccard)
+        assert all(np.array_equal(result, expected) for result, expected in
+                   zip(neighbor_set.change_counts(0, 1, ids=ids, num_neighbors=num_neighbors), (gained, lost)))
+
+
+def _brute_force_neighbors(pos, metric='euclidean', n_neighbors=10):
+    return NearestNeighbors(metric=metric, algorithm='brute').fit(pos).kneighbors(pos, n_neighbors=n_neighbors)[1]
+
+
+@pytest.mark.parametrize("algorithm", [NeighborAlgorithm.NN_DESCENT, _brute_force_neighbors])
+def test_approximate_neighbors_report_recall(algorithm):
+    if algorithm == NeighborAlgorithm.NN_DESCENT:
+        pytest.importorskip("pynndescent")
+    rng = np.random.RandomState(0)
+    np.random.seed(0)
+    pos = rng.randn(300, 8)
+    ids = np.arange(300) * 2 + 5
+    exact = Neighbors.compute(pos, ids=ids, n_neighbors=10)
+    assert exact.recall is None
+
+    approx = Neighbors.compute(pos, ids=ids, n_neighbors=10, algorithm=algorithm, recall_sample_size=100)
+    assert 0 <= approx.recall <= 1
+    assert approx.values.shape == exact.values.shape
+    assert np.array_equal(approx.ids, exact.ids)
+    if approx.distances is not None:
+        assert approx.distances.shape == exact.distances.shape
+    if algorithm == NeighborAlgorithm.NN_DESCENT:
+        assert approx.recall > 0.9
+        assert approx.has_clf()
+        assert approx.calculate_neighbors(pos[:5], return_distance=False).shape == (5, 10)
+    else:
+        # An exact backend recovers every true neighbor
+        assert approx.recall == pytest.approx(1.0)
+        assert np.array_equal(np.sort(approx.values, axis=1), np.sort(exact.values, axis=1))
+
+
+def test_sampled_recall_measures_missing_neighbors():
+    rng = np.random.RandomState(1)
+    pos = rng.randn(50, 3)
+    exact_indexes = _brute_force_neighbors(pos, n_neighbors=5)
+    assert neighbors_module._sampled_recall(pos, exact_indexes, 'euclidean', 50) == 1.0
+    # Replacing one of four neighbors with a point that is not a neighbor
+    # loses a quarter of the recall
+    degraded = exact_indexes.copy()
+    for row in range(len(pos)):
+        degraded[row, -1] = next(i for i in range(len(pos)) if i not in exact_indexes[row])
+    assert neighbors_module._sampled_recall(pos, degraded, 'euclidean', 50) == pytest.approx(0.75)
+
+
+def test_save_and_load_memory_maps_neighbors(tmp_path):
+    rng = np.random.RandomState(3)
+    pos = rng.randn(50, 3)
+    neighbors = Neighbors.compute(pos, ids=np.arange(50) * 4 + 1, metric='cosine', n_neighbors=6)
+    other = Neighbors.compute(rng.randn(50, 3), ids=neighbors.ids, metric='cosine', n_neighbors=6)
+    directory = str(tmp_path / "neighbors")
+    neighbors.save(directory)
+    loaded = Neighbors.load(directory)
+    assert isinstance(loaded.values, np.memmap) and isinstance(loaded.distances, np.memmap)
+    assert np.array_equal(loaded.values, neighbors.values)
+    assert np.array_equal(loaded.ids, neighbors.ids)
+    assert np.allclose(loaded.distances, neighbors.distances)
+    assert loaded.metric == 'cosine' and loaded.n_neighbors == 6
+    assert not isinstance(Neighbors.load(directory, mmap=False).values, np.memmap)
+
+    neighbor_set = NeighborSet([neighbors, other, neighbors])
+    directory = str(tmp_path / "neighbor_set")
+    neighbor_set.save(directory, save_distances=False)
+    assert sorted(os.listdir(directory)) == ["0", "1", "metadata.json"]
+    loaded_set = NeighborSet.load(directory)
+    assert loaded_set == neighbor_set
+    assert loaded_set[0] is loaded_set[2]
+    assert all(n.distances is None for n in loaded_set)
+
+    # Reading rows by ID copies only those rows out of the mapping
+    row_ids = neighbors.ids[[7, 2, 30]]
+    rows = loaded_set[1][row_ids]
+    assert not isinstance(rows, np.memmap)
+    assert np.array_equal(rows, other[row_ids])
+    assert all(isinstance(n.values, np.memmap) for n in loaded_set)
+
+
+@pytest.mark.parametrize("metric,store_distances", [('euclidean', True), ('euclidean', False), ('cosine', False), ('chebyshev', False)])
+def test_insert_matches_full_recompute(metric, store_distances):
+    rng = np.random.RandomState(4)
+    pos = rng.randn(120, 4)
+    # Non-contiguous IDs, with the new IDs filling gaps between existing ones
+    ids = np.arange(100) * 10 + 3
+    new_ids = np.arange(20) * 10 + 8
+    neighbors = Neighbors.compute(pos[:100], ids=ids, metric=metric, n_neighbors=6,
+                                  store_distances=store_distances)
+    inserted = neighbors.insert(pos[:100], pos[100:], new_ids)
+    expected = Neighbors.compute(pos, ids=np.concatenate([ids, new_ids]), metric=metric, n_neighbors=6)
+    assert np.array_equal(inserted.ids, expected.ids)
+    assert np.array_equal(inserted.values, expected.values)
+    if store_distances:
+        assert np.allclose(inserted.distances, expected.distances, atol=1e-5)
+    assert np.array_equal(inserted.calculate_neighbors(pos[:5], return_distance=False),
+                          expected.calculate_neighbors(pos[:5], return_distance=False))
+
+    with pytest.raises(AssertionError):
+        neighbors.insert(pos[:100], pos[100:102], [ids[5], 9999])
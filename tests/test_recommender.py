@@ -0,0 +1,223 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import scipy.sparse
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+
+import emblaze.recommender as recommender_module
+
+from emblaze.datasets import Embedding, EmbeddingSet
+from emblaze.recommender import SelectionRecommender
+from emblaze.utils import Field, process_pool_executor
+
+
+def _make_frames(num_points, num_frames, seed=0, n_neighbors=10):
+    rng = np.random.RandomState(seed)
+    base = rng.randn(num_points, 2)
+    frames = EmbeddingSet([
+        Embedding({Field.POSITION: base + rng.randn(num_points, 2) * 0.5 * i,
+                   Field.COLOR: np.zeros(num_points)}, n_neighbors=n_neighbors)
+        for i in range(num_frames)
+    ])
+    frames.compute_neighbors(n_neighbors=n_neighbors)
+    return frames
+
+
+def test_query_with_undefined_scores_terminates():
+    # Tiny inputs produce clusters whose consistency scores are NaN
+    recommender = SelectionRecommender(_make_frames(8, 3, seed=1, n_neighbors=3))
+    consistencies = [c["consistency"] for clusters in recommender.clusters.values() for c in clusters]
+    assert np.isnan(consistencies).any()
+
+    results = recommender.query(num_results=5)
+    assert 0 < len(results) <= 5
+    results = recommender.query(ids_of_interest=[0, 1], num_results=5)
+    assert 0 < len(results) <= 5
+    for (cluster, _), (other, _) in zip(results, results[1:]):
+        assert not (cluster["ids"] & other["ids"])
+
+
+def _random_similarities(num_points, density, rng, quantized=False):
+    # Quantized similarities are multiples of 1/1024 so that they are exact in
+    # float16, which the dense path uses
+    if quantized:
+        data_rvs = lambda size: rng.randint(1, 1025, size) / 1024
+    else:
+        data_rvs = lambda size: rng.uniform(1e-3, 1, size)
+    values = scipy.sparse.random(num_points, num_points, density=density, random_state=rng,
+                                 data_rvs=data_rvs)
+    values = scipy.sparse.triu(values, k=1)
+    return (values + values.T).tocsr()
+
+
+def _expected_labels(distances, threshold):
+    tree = linkage(squareform(distances, checks=False), method="average")
+    return fcluster(tree, np.nextafter(threshold, -np.inf), criterion="distance")
+
+
+def _same_partition(labels, other_labels):
+    pairs = set(zip(labels, other_labels))
+    return len(pairs) == len(np.unique(labels)) == len(np.unique(other_labels))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_dense_clustering_matches_scipy_linkage(seed):
+    rng = np.random.RandomState(seed)
+    gained_sim = _random_similarities(200, 0.2, rng, quantized=True)
+    lost_sim = _random_similarities(200, 0.2, rng, quantized=True)
+    thresholds = (0.7, 0.8, 0.9)
+    recommender = SelectionRecommender.__new__(SelectionRecommender)
+    all_labels = recommender._cluster_neighbor_changes(gained_sim, lost_sim, thresholds)
+
+    distances = ((1 - gained_sim.toarray()) + (1 - lost_sim.toarray())) / 2
+    np.fill_diagonal(distances, 0)
+    for labels, threshold in zip(all_labels, thresholds):
+        assert _same_partition(labels, _expected_labels(distances, threshold))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_sparse_clustering_matches_truncated_linkage(seed, monkeypatch):
+    # Force the approximate sparse path, which treats pairs at or above the
+    # largest threshold as maximally distant. Similarities are continuous so
+    # that there are no ties in the linkage.
+    monkeypatch.setattr(recommender_module, "DENSE_CLUSTERING_LIMIT", 10)
+    rng = np.random.RandomState(seed)
+    gained_sim = _random_similarities(200, 0.2, rng)
+    lost_sim = _random_similarities(200, 0.2, rng)
+    thresholds = (0.7, 0.8, 0.9)
+    recommender = SelectionRecommender.__new__(SelectionRecommender)
+    all_labels = recommender._cluster_neighbor_changes(gained_sim, lost_sim, thresholds)
+
+    distances = 1 - (gained_sim.toarray() + lost_sim.toarray()) / 2
+    distances[distances >= max(thresholds)] = 1
+    np.fill_diagonal(distances, 0)
+    for labels, threshold in zip(all_labels, thresholds):
+        assert _same_partition(labels, _expected_labels(distances, threshold))
+
+
+def _cluster_ids(recommender):
+    return {pair: [sorted(c["ids"]) for c in clusters] for pair, clusters in recommender.clusters.items()}
+
+
+def test_process_pool_matches_serial_clusters(monkeypatch):
+    frames = _make_frames(200, 3, seed=2)
+    expected = _cluster_ids(SelectionRecommender(frames))
+    # Workers receive memory-mapped neighbor arrays, not the embeddings
+    monkeypatch.setattr(SelectionRecommender, "__getstate__",
+                        lambda self: pytest.fail("recommender was pickled"), raising=False)
+    assert _cluster_ids(SelectionRecommender(frames, n_jobs=2)) == expected
+    with process_pool_executor(2) as executor:
+        assert _cluster_ids(SelectionRecommender(frames, executor=executor)) == expected
+    with ThreadPoolExecutor(2) as executor:
+        assert _cluster_ids(SelectionRecommender(frames, executor=executor)) == expected
+
+
+def _wait_for_input_removal(pairs, **kwargs):
+    # Every work item except the first blocks until the parent removes the
+    # worker inputs, which happens only after the pool stops waiting for it
+    if pairs[0] != (0, 1):
+        deadline = time.time() + 30
+        while os.path.exists(recommender_module._worker_directory) and time.time() < deadline:
+            time.sleep(0.05)
+    return recommender_module._make_clusters_worker(pairs, **kwargs)
+
+
+def test_closing_iter_compute_does_not_wait_for_workers(monkeypatch):
+    input_dirs = []
+    make_temp_dir = tempfile.mkdtemp
+    def mkdtemp(**kwargs):
+        input_dirs.append(make_temp_dir(**kwargs))
+        return input_dirs[-1]
+    monkeypatch.setattr(tempfile, "mkdtemp", mkdtemp)
+    monkeypatch.setattr(recommender_module, "_make_clusters_worker", _wait_for_input_removal)
+    recommender = SelectionRecommender(_make_frames(30, 3, seed=4), n_jobs=2, lazy=True)
+    results = recommender.iter_compute()
+    assert next(results) in [(0, 1), (1, 0)]
+
+    start = time.time()
+    results.close()
+    assert time.time() - start < 10
+    assert input_dirs and not os.path.exists(input_dirs[0])
+
+
+def test_suggestion_cache_is_opt_in(monkeypatch):
+    monkeypatch.delenv(recommender_module.CACHE_DIR_ENV_VAR, raising=False)
+    assert recommender_module.default_suggestion_cache_dir() is None
+    monkeypatch.setenv(recommender_module.CACHE_DIR_ENV_VAR, "/tmp/emblaze-cache")
+    assert recommender_module.default_suggestion_cache_dir() == "/tmp/emblaze-cache"
+
+
+def test_suggestion_cache_evicts_least_recently_used(tmp_path):
+    clusters = SelectionRecommender(_make_frames(100, 3, seed=3)).clusters
+    pairs = list(clusters.keys())[:3]
+    keys = ["{}-{}".format(*pair) for pair in pairs]
+    cache = recommender_module.SuggestionCache(str(tmp_path))
+    for age, (key, pair) in enumerate(zip(keys, pairs)):
+        cache.save(key, clusters[pair])
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+
+    # Reading the oldest entry makes it the most recently used
+    assert cache.load(keys[0], *pairs[0]) is not None
+    cache.max_size = 2 * max(os.path.getsize(cache._path(key)) for key in keys)
+    cache.save(keys[2], clusters[pairs[2]])
+    assert sorted(os.listdir(str(tmp_path))) == sorted([keys[0] + ".npz", keys[2] + ".npz"])
+
+    cache.clear()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_pairwise_jaccard_similarities_match_brute_force():
+    recommender = SelectionRecommender(_make_frames(40, 2, seed=3, n_neighbors=5))
+    gained_ids, _ = recommender._make_neighbor_changes(0, 1)
+    indptr, values = gained_ids
+    sets = [set(values[indptr[i]:indptr[i + 1]].tolist()) for i in range(len(indptr) - 1)]
+    expected = np.array([[len(a & b) / len(a | b) if a & b else 0.0 for b in sets] for a in sets])
+    similarities = recommender._pairwise_jaccard_similarities(gained_ids).toarray()
+    # Similarities are rounded to float16 precision
+    assert np.allclose(similarities, expected, atol=1e-3)
+
+
+def _cluster_scores(recommender):
+    return {pair: [[c[key] for key in ("consistency", "innerChange", "gain", "loss")] for c in clusters]
+            for pair, clusters in recommender.clusters.items()}
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_streamed_clusters_match_compute(n_jobs):
+    frames = _make_frames(120, 3, seed=5)
+    expected = SelectionRecommender(frames)
+    recommender = SelectionRecommender(frames, n_jobs=n_jobs, lazy=True)
+    streamed = []
+    for pair in recommender.iter_compute():
+        # Each pair is available as soon as it is yielded
+        assert pair in recommender.clusters
+        streamed.append(pair)
+    assert sorted(streamed) == sorted(expected.clusters.keys())
+    assert list(recommender.clusters.keys()) == list(expected.clusters.keys())
+    assert _cluster_ids(recommender) == _cluster_ids(expected)
+    assert np.allclose(np.array(sum(_cluster_scores(recommender).values(), []), dtype=float),
+                       np.array(sum(_cluster_scores(expected).values(), []), dtype=float), equal_nan=True)
+    assert ([sorted(c["ids"]) for c, _ in recommender.query(num_results=10)] ==
+            [sorted(c["ids"]) for c, _ in expected.query(num_results=10)])
+
+
+def test_restricted_recommender_reuses_parent_similarities():
+    frames = _make_frames(150, 3, seed=6)
+    rng = np.random.RandomState(6)
+    parent_points = sorted(rng.choice(150, size=80, replace=False).tolist())
+    # Keep most of the parent's points, drop a few and add some new ones
+    child_points = sorted(parent_points[5:] + [i for i in range(150) if i not in parent_points][:10])
+    parent = SelectionRecommender(frames, frame_idx=0, filter_points=parent_points)
+    assert parent._neighbor_change_cache
+
+    reused = SelectionRecommender(frames, frame_idx=0, filter_points=child_points, reuse_from=parent)
+    assert reused._neighbor_change_cache is parent._neighbor_change_cache
+    fresh = SelectionRecommender(frames, frame_idx=0, filter_points=child_points)
+    assert _cluster_ids(reused) == _cluster_ids(fresh)
+    assert np.allclose(np.array(sum(_cluster_scores(reused).values(), []), dtype=float),
+                       np.array(sum(_cluster_scores(fresh).values(), []), dtype=float), equal_nan=True)
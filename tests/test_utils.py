@@ -0,0 +1,183 @@
+import gc
+import os
+import subprocess
+import sys
+import threading
+import weakref
+
+import numpy as np
+import pytest
+
+from emblaze.datasets import Embedding, EmbeddingSet
+from emblaze.frame_colors import FrameColorCache, compute_colors
+from emblaze.utils import Field, IDIndex, SpatialIndex, compact_ids, id_mask, inverse_intersection
+
+
+def _set_inverse_intersection(seqs1, seqs2, mask_ids, outer):
+    mask_ids = set(mask_ids)
+    result = np.zeros(len(seqs1))
+    for i, (row_1, row_2) in enumerate(zip(seqs1, seqs2)):
+        row_1 = {x for x in row_1 if (x in mask_ids) != outer}
+        row_2 = {x for x in row_2 if (x in mask_ids) != outer}
+        if row_1 or row_2:
+            result[i] = 1 / (1 + len(row_1 & row_2))
+    return result
+
+
+def test_compact_ids():
+    ids = np.array([5, 3, 5, 1])
+    unique_ids, compact, size = compact_ids(ids)
+    assert unique_ids is None and size == 6
+    ids = np.array([10 ** 12, -4, 10 ** 12, 7])
+    unique_ids, compact, size = compact_ids(ids)
+    assert size == 3
+    assert np.array_equal(unique_ids[compact], ids)
+
+
+@pytest.mark.parametrize("outer", [False, True])
+@pytest.mark.parametrize("scale", [1, 10 ** 9, -10 ** 9])
+def test_inverse_intersection_with_sparse_ids(outer, scale):
+    rng = np.random.RandomState(0)
+    seqs1 = rng.randint(0, 100, (50, 10)) * scale
+    seqs2 = rng.randint(0, 100, (50, 10)) * scale
+    mask_ids = np.arange(0, 100, 3) * scale
+    expected = _set_inverse_intersection(seqs1, seqs2, mask_ids, outer)
+    assert np.allclose(inverse_intersection(seqs1, seqs2, mask_ids, outer), expected)
+    if scale == 1:
+        assert np.allclose(inverse_intersection(seqs1, seqs2, id_mask(mask_ids), outer), expected)
+
+
+def test_compute_colors_with_sparse_ids():
+    rng = np.random.RandomState(0)
+    base = rng.randn(200, 2)
+    positions = [base + rng.randn(200, 2) * 0.3 * i for i in range(3)]
+
+    def make_frames(ids):
+        frames = EmbeddingSet([Embedding({Field.POSITION: pos, Field.COLOR: np.zeros(200)}, ids=ids)
+                               for pos in positions])
+        frames.compute_neighbors(n_neighbors=10)
+        return frames
+
+    ids = np.arange(200)
+    sparse_ids = ids * 10 ** 9
+    colors = compute_colors(make_frames(ids), ids[:20].tolist(), use_cache=False)
+    sparse_colors = compute_colors(make_frames(sparse_ids), sparse_ids[:20].tolist(), use_cache=False)
+    assert colors == sparse_colors
+
+
+def _make_color_frames(num_points=30, num_frames=3, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = EmbeddingSet([
+        Embedding({Field.POSITION: rng.randn(num_points, 2), Field.COLOR: np.zeros(num_points)},
+                  n_neighbors=5)
+        for _ in range(num_frames)
+    ])
+    frames.compute_neighbors(n_neighbors=5)
+    return frames
+
+
+def test_color_cache_does_not_keep_frames_alive():
+    cache = FrameColorCache(maxsize=4)
+    frames = _make_color_frames()
+    key, refs = cache.make_key(frames, None, 1.0)
+    cache.put(key, refs, [(0, 0, 0)] * len(frames))
+    assert cache.get(key) is not None
+
+    frame_ref = weakref.ref(frames[0])
+    del frames
+    gc.collect()
+    assert frame_ref() is None
+    # The entry's objects are gone, so its key must no longer match
+    assert cache.get(key) is None
+    assert len(cache) == 0
+
+
+def test_color_cache_is_bounded_and_thread_safe():
+    cache = FrameColorCache(maxsize=8)
+    frames = _make_color_frames()
+
+    def worker(offset):
+        for i in range(200):
+            key, refs = cache.make_key(frames, [offset, i], 1.0)
+            if cache.get(key) is None:
+                cache.put(key, refs, [(i, 0, 0)])
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = cache.info()
+    assert info["size"] == 8
+    assert info["hits"] + info["misses"] == 800
+
+
+def test_numba_threads_start_with_first_background_task():
+    script = "\n".join([
+        "import numba.np.ufunc.parallel as parallel",
+        "import emblaze",
+        "from emblaze.utils import BackgroundTaskScheduler",
+        "assert not parallel._is_initialized",
+        "scheduler = BackgroundTaskScheduler(lambda fn, args=[], kwargs={}: fn(*args, **kwargs))",
+        "scheduler.submit('task', lambda cancel_token: None)",
+        "assert parallel._is_initialized",
+    ])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, "-c", script], check=True, env=env)
+
+
+@pytest.mark.parametrize("ids", [
+    np.arange(20),
+    np.arange(20) + 100,
+    np.random.RandomState(0).permutation(20) * 7 - 30,
+    np.array(["b", "a", "d", "c"]),
+])
+def test_id_index_lookup_and_find(ids):
+    index = IDIndex(ids)
+    order = np.random.RandomState(1).permutation(len(ids))
+    assert np.array_equal(index.lookup(ids[order]), order)
+    assert np.array_equal(index.lookup(list(ids[order])), order)
+    for row in order:
+        assert index.lookup(ids[row]) == row
+        assert ids[row] in index
+
+    missing = np.array([ids[0] + "z"]) if ids.dtype.kind == 'U' else np.array([ids.max() + 1, ids.min() - 1])
+    assert np.array_equal(index.find(np.concatenate([ids[order], missing])),
+                          np.concatenate([order, np.full(len(missing), -1)]))
+    assert missing[0] not in index
+    with pytest.raises(KeyError):
+        index.lookup(missing[0])
+    with pytest.raises(KeyError):
+        index.lookup(np.concatenate([ids[:2], missing]))
+
+
+def test_id_index_rejects_non_integral_ids():
+    for ids in (np.arange(10), np.arange(10) * 3):
+        index = IDIndex(ids)
+        assert index.lookup(3.0) == index.lookup(3)
+        assert np.array_equal(index.lookup(np.array([0.0, 3.0])), index.lookup([0, 3]))
+        with pytest.raises(ValueError):
+            index.lookup(1.5)
+        with pytest.raises(ValueError):
+            index.find([0, 1.5])
+        assert 1.5 not in index
+
+
+def test_spatial_index_matches_brute_force_mask():
+    rng = np.random.RandomState(0)
+    # Integer coordinates put many points exactly on the box edges
+    positions = rng.randint(-10, 11, size=(500, 2)).astype(np.float64)
+    positions[:5] = np.nan
+    index = SpatialIndex(positions, points_per_cell=4)
+    boxes = [tuple(np.sort(rng.randint(-12, 13, size=2)).tolist() + np.sort(rng.randint(-12, 13, size=2)).tolist())
+             for _ in range(50)]
+    boxes += [(3, 3, -2, -2), (-10, 10, -10, 10), (20, 30, 20, 30), (-np.inf, 0, 0, np.inf)]
+    for xmin, xmax, ymin, ymax in boxes:
+        with np.errstate(invalid='ignore'):
+            expected = np.flatnonzero((positions[:,0] >= xmin) & (positions[:,0] <= xmax) &
+                                      (positions[:,1] >= ymin) & (positions[:,1] <= ymax))
+        assert np.array_equal(index.query((xmin, xmax, ymin, ymax)), expected)
+
+    for empty_box in [(1, 0, -5, 5), (-5, 5, 2, 1), (np.nan, 5, -5, 5), (-5, 5, -5, np.nan)]:
+        assert len(index.query(empty_box)) == 0
+    assert len(SpatialIndex(np.zeros((0, 2))).query((-1, 1, -1, 1))) == 0
@@ -0,0 +1,166 @@
+import base64
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import emblaze
+import emblaze.viewer as viewer_module
+from emblaze.datasets import Embedding, EmbeddingSet
+from emblaze.utils import Field, decode_numerical_array
+from emblaze.viewer import synchronous_thread_starter
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.RandomState(0)
+    base = rng.randn(50, 2)
+    frames = EmbeddingSet([
+        Embedding({Field.POSITION: base + rng.randn(50, 2) * 0.2 * i,
+                   Field.COLOR: np.arange(50) % 3}, n_neighbors=5)
+        for i in range(2)
+    ])
+    frames.compute_neighbors(n_neighbors=5)
+    return frames
+
+
+@pytest.fixture
+def thumbnails():
+    rng = np.random.RandomState(0)
+    return emblaze.ImageThumbnails(rng.randint(0, 255, (50, 8, 8, 3)).astype(np.uint8))
+
+
+def _make_viewer(frames, thumbnails, **kwargs):
+    return emblaze.Viewer(embeddings=frames, thumbnails=thumbnails,
+                          thread_starter=synchronous_thread_starter,
+                          recomputeDebounceWindow=0, **kwargs)
+
+
+def test_default_trait_payloads_are_json_serializable(frames, thumbnails):
+    viewer = _make_viewer(frames, thumbnails)
+    for name in ("data", "neighborData", "thumbnailData"):
+        json.dumps(getattr(viewer, name))
+
+
+@pytest.fixture
+def binary_bundle(tmp_path, monkeypatch):
+    # A widget bundle built from the current client sources
+    (tmp_path / "widget-main.js").write_text("const v = '{}';".format(viewer_module.BINARY_TRANSPORT_VERSION))
+    (tmp_path / "style.css").write_text("")
+    monkeypatch.setattr(viewer_module, "BUNDLE_DIR", tmp_path)
+
+
+def test_binary_transport_requires_supporting_bundle(frames, thumbnails, tmp_path, monkeypatch):
+    (tmp_path / "widget-main.js").write_text("function decodeBase64String() {}")
+    (tmp_path / "style.css").write_text("")
+    monkeypatch.setattr(viewer_module, "BUNDLE_DIR", tmp_path)
+    viewer = _make_viewer(frames, thumbnails, binaryTransport=True)
+    assert not viewer.binaryTransport
+    json.dumps(viewer.data)
+
+
+def test_binary_transport_matches_base64(frames, thumbnails, binary_bundle):
+    viewer = _make_viewer(frames, thumbnails)
+    binary_viewer = _make_viewer(frames, thumbnails, binaryTransport=True)
+    assert binary_viewer.binaryTransport
+    with pytest.raises(TypeError):
+        json.dumps(binary_viewer.data)
+    for frame, binary_frame in zip(viewer.data["data"], binary_viewer.data["data"]):
+        for key in ("x", "y"):
+            assert np.array_equal(decode_numerical_array(frame[key]),
+                                  decode_numerical_array(binary_frame[key]))
+
+
+_NODE_DECODE_SCRIPT = """
+import { readFileSync } from 'fs';
+import { pathToFileURL } from 'url';
+globalThis.window = { atob: (s) => Buffer.from(s, 'base64').toString('binary') };
+const { ColumnarFrame, Neighbors } = await import(pathToFileURL(process.argv[2]).href);
+const payload = JSON.parse(readFileSync(process.argv[3], 'utf8'));
+// Binary buffers arrive in the widget as DataViews over the message buffers
+const revive = (value) => {
+  if (Array.isArray(value)) return value.map(revive);
+  if (value && typeof value === 'object') {
+    if ('__buffer__' in value) {
+      const bytes = Buffer.from(value.__buffer__, 'base64');
+      const padded = new Uint8Array(bytes.length + 1);
+      padded.set(bytes, 1);
+      return new DataView(padded.buffer, 1, bytes.length);
+    }
+    return Object.fromEntries(Object.entries(value).map(([k, v]) => [k, revive(v)]));
+  }
+  return value;
+};
+const result = ['base64', 'binary'].map((key) => {
+  const frame = new ColumnarFrame(revive(payload[key].frame), 'frame');
+  const neighbors = new Neighbors(revive(payload[key].neighbors));
+  const ids = frame.getIDs().map(Number);
+  return {
+    ids,
+    x: ids.map((id) => frame.get(id, 'x')),
+    y: ids.map((id) => frame.get(id, 'y')),
+    color: ids.map((id) => frame.get(id, 'color')),
+    neighbors: ids.map((id) => Array.from(neighbors.get(id, 'neighbors'), Number)),
+  };
+});
+console.log(JSON.stringify(result));
+"""
+
+
+def _buffers_to_json(value):
+    if isinstance(value, memoryview):
+        return {"__buffer__": base64.b64encode(value.tobytes()).decode('ascii')}
+    if isinstance(value, dict):
+        return {k: _buffers_to_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_buffers_to_json(v) for v in value]
+    return value
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="requires node")
+def test_client_decodes_binary_transport(frames, tmp_path):
+    frame = frames[0]
+    payload = {key: {"frame": _buffers_to_json(frame.to_json(save_neighbors=False, binary=binary)),
+                     "neighbors": _buffers_to_json(frame.get_neighbors().to_json(binary=binary))}
+               for key, binary in (("base64", False), ("binary", True))}
+    assert "__buffer__" in json.dumps(payload["binary"])
+    (tmp_path / "payload.json").write_text(json.dumps(payload))
+    (tmp_path / "decode.mjs").write_text(_NODE_DECODE_SCRIPT)
+    frames_js = os.path.join(os.path.dirname(__file__), os.pardir, "client", "src",
+                             "visualization", "models", "frames.js")
+    output = subprocess.run(["node", str(tmp_path / "decode.mjs"), os.path.abspath(frames_js),
+                             str(tmp_path / "payload.json")],
+                            check=True, capture_output=True, text=True).stdout
+    base64_result, binary_result = json.loads(output)
+    assert binary_result == base64_result
+    assert binary_result["ids"] == frame.ids.tolist()
+    assert np.allclose(binary_result["x"], frame.field(Field.POSITION)[:,0], atol=1e-5)
+    assert np.allclose(binary_result["y"], frame.field(Field.POSITION)[:,1], atol=1e-5)
+    assert binary_result["neighbors"] == frame.get_neighbors().values.tolist()
+
+
+def test_filter_points_do_not_build_neighbor_graph(frames, thumbnails):
+    viewer = _make_viewer(frames, thumbnails)
+    selection = [1, 2, 3]
+    expected = set(selection)
+    for frame in frames:
+        neighbors = frame.get_ancestor_neighbors()
+        neighbors._csr_cache.clear()
+        expected |= set(neighbors[selection][:,:viewer.numNeighbors].flatten().tolist())
+    assert viewer._get_filter_points(selection) == sorted(expected)
+    assert all(not frame.get_ancestor_neighbors()._csr_cache for frame in frames)
+
+
+def test_saved_comparison_loads_index_only_from_index_dir(frames, thumbnails, tmp_path):
+    viewer = _make_viewer(frames, thumbnails)
+    path = str(tmp_path / "comparison.json")
+    index_dir = str(tmp_path / "indexes")
+    viewer.save_comparison(path, index_dir=index_dir)
+
+    loaded = emblaze.Viewer(file=path, thread_starter=synchronous_thread_starter)
+    assert not any(emb.get_neighbors().has_clf() for emb in loaded.embeddings)
+    loaded = emblaze.Viewer(file=path, indexDir=index_dir, thread_starter=synchronous_thread_starter)
+    assert all(emb.get_neighbors().has_clf() for emb in loaded.embeddings)